@@ -0,0 +1,203 @@
+# Imports
+import argparse
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+try:
+    import resource
+except ImportError:
+    # Модуля resource нет на Windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+from handlers.json import JSONHandler
+from handlers.persons import PersonsStore
+from handlers.scheduler import Scheduler
+from handlers.tasks import TaskManager
+from services.assets import AssetCache
+from services.bodies import BodyCache
+from services.delivery import DeliveryEngine
+from services.journal import Journal
+from services.mailer import Mailer
+from services.metrics import metrics
+from services.render import RenderPool
+from services.spool import Spool
+from benchmarks.sink import SMTPSink
+
+# Defines
+def peak_rss():
+    """
+    Пиковый объем памяти процесса
+
+    Берется из resource (Unix) или psutil (если установлен), иначе не измеряется
+    :return: Объем в мегабайтах или None, если измерить его нельзя
+    """
+
+    if resource is not None:
+        # ru_maxrss на Linux в килобайтах, на macOS в байтах
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+    if psutil is not None:
+        memory = psutil.Process().memory_info()
+        # На Windows есть пиковый рабочий набор, на остальных платформах - только текущий
+        return getattr(memory, 'peak_wset', memory.rss) / 1024 / 1024
+    return None
+
+def generate(work_directory: str, size: int):
+    """
+    Генерация синтетических данных
+
+    Создает в рабочем каталоге базу персон, файл получателей, шаблоны письма и задание на рассылку
+    :param work_directory:  Рабочий каталог
+    :param size:            Количество получателей
+    :return: Имя файла задания
+    """
+
+    for directory in ("tasks/suspend/", "templates/files/", "mail/journal/", "logs/"):
+        os.makedirs(work_directory + directory, exist_ok=True)
+
+    # База персон и файл получателей (домены неравномерны, как в реальных списках)
+    domains = ["mail.ru", "inbox.ru", "yandex.ru", "gmail.com", "gov39.ru"] + [f"company{i}.ru" for i in range(50)]
+    persons = dict()
+    for i in range(size):
+        domain = domains[i % 10] if i % 10 < 5 else domains[5 + i % 50]
+        persons[f"user{i}@{domain}"] = {'Название компании': f"Общество с ограниченной ответственностью 'Компания {i}'",
+                                        'Имя': f"Имя{i} Отчество{i}", 'Проект': f"Проект номер {i % 97}",
+                                        'Ссылка': f"company{i}"}
+    with open(work_directory + "persons.json", 'w', encoding='utf-8') as file:
+        json.dump(persons, file, ensure_ascii=False)
+    with open(work_directory + "recipients.csv", 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["email"])
+        writer.writerows([rcpt] for rcpt in persons)
+
+    # Шаблоны письма
+    paragraph = ("Уважаемый [Имя]! Компания [Название компании] приглашает вас к участию в проекте «[Проект]». "
+                 "Подробности по ссылке https://example.com/[Ссылка]. ")
+    with open(work_directory + "templates/bench.txt", 'w', encoding='utf-8') as file:
+        file.write(paragraph * 8 + "\n[Имя Фамилия], [Должность], [Телефон]\n")
+    with open(work_directory + "templates/bench.html", 'w', encoding='utf-8') as file:
+        file.write("<html><body>" + f"<p>{paragraph}</p>" * 16 +
+                   "<p>[Имя Фамилия]<br>[Должность]<br>[Телефон]</p></body></html>")
+
+    # Задание
+    task = {'service': 'mailer', 'from': "bench@example.com", 'to-file': work_directory + "recipients.csv",
+            'subject': "Предложение для [Название компании]", 'template': "bench",
+            'replaces': {'Имя Фамилия': "Имя Фамилия", 'Должность': "Менеджер", 'Телефон': "+7 000 000-00-00"}}
+    with open(work_directory + "tasks/bench.json", 'w', encoding='utf-8') as file:
+        json.dump(task, file, ensure_ascii=False)
+    return "bench.json"
+
+def run(size: int, work_directory: str, sink: SMTPSink, concurrency: int = 1, render_workers: int = 0,
+        segments: bool = False):
+    """
+    Замер конвейера отправки
+
+    Генерирует данные и прогоняет их тем же путем, что и run.py: TaskManager (обработка шаблонов), RenderPool
+    (сборка сообщений) и DeliveryEngine (очередь доменов, отправка на локальный приемник, спул и журнал доставки).
+    Время этапов берется из метрик: render - обработка шаблонов, build - сборка сообщения (при сборке в рабочих
+    процессах - ожидание собранного пакета), deliver - отправка сообщения
+    :param size:            Количество получателей
+    :param work_directory:  Рабочий каталог
+    :param sink:            Локальный приемник SMTP
+    :param concurrency:     Количество потоков отправки (и соединений с приемником)
+    :param render_workers:  Количество процессов сборки сообщений (0 - сборка в основном процессе)
+    :param segments:        Признак спула в режиме сегментов
+    :return: Результат {recipients, concurrency, render_workers, sent, failed, seconds, msgs_per_sec, stages,
+             peak_rss_mb, sink}
+    """
+
+    started = time.perf_counter()
+    task_file = generate(work_directory, size)
+    generated = time.perf_counter() - started
+
+    task_manager = TaskManager(work_directory + "tasks/", work_directory + "templates/",
+                               JSONHandler(work_directory + "logs/"), PersonsStore(work_directory + "persons.json"),
+                               Scheduler(work_directory + "tasks/suspend/"))
+    task_manager.parse([task_file])
+    mail_directory = work_directory + "mail/"
+    mailer = Mailer(*sink.server_address, "bench", "bench", work_directory + "logs/", False, False,
+                    pool_size=concurrency)
+
+    metrics.enable()
+    metrics.reset()
+    # Процессы сборки сообщений запускаются до потоков отправки, спула и журнала
+    with (RenderPool(work_directory + "templates/files/", AssetCache(64 * 1024 * 1024), render_workers,
+                     bodies=BodyCache()) as renderer,
+          mailer, Spool(mail_directory, True, segments) as spool,
+          Journal(mail_directory + "journal/") as journal,
+          DeliveryEngine(mailer, spool, journal, concurrency, concurrency * 4) as delivery):
+        started = time.perf_counter()
+        for task_file, message, content in renderer.mix(task_manager.stream("mailer", journal.completed)):
+            if message is not None:
+                delivery.submit(message, content['replaces'], task_file)
+        delivery.drain()
+        seconds = time.perf_counter() - started
+
+    stats = metrics.stats()
+    stages = {stage: stats['stages'].get(name, {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p99': 0.0, 'max': 0.0})
+              for stage, name in (('render', 'render'), ('build', 'build_wait' if render_workers else 'build'),
+                                  ('deliver', 'deliver'))}
+    sent = stats['events'].get('sent', 0)
+    failed = stats['events'].get('failed', 0)
+    return {'recipients': size, 'concurrency': concurrency, 'render_workers': render_workers, 'sent': sent,
+            'failed': failed, 'generate_seconds': generated, 'seconds': seconds,
+            'msgs_per_sec': (sent + failed) / seconds if seconds else 0.0, 'stages': stages,
+            # Пиковый объем памяти процесса за все время работы (None - измерить нельзя)
+            'peak_rss_mb': peak_rss(),
+            'sink': sink.stats()}
+
+if __name__ == '__main__':
+    cmd = argparse.ArgumentParser(prog="benchmarks.pipeline", description="End-to-end mailer throughput")
+    cmd.add_argument("-s", "--sizes", default="1000,10000,100000", help="comma separated numbers of recipients")
+    cmd.add_argument("-w", "--work-dir", default="", help="work directory (default - temporary, removed after run)")
+    cmd.add_argument("--latency", default=0, type=float, help="sink reply delay per message, s")
+    cmd.add_argument("--transient", default=0, type=float, help="share of 451 replies (0..1)")
+    cmd.add_argument("--permanent", default=0, type=float, help="share of 550 replies (0..1)")
+    cmd.add_argument("--max-connections", default=0, type=int, help="sink connection limit (0 - unlimited)")
+    cmd.add_argument("--concurrency", default=1, type=int, help="number of parallel delivery workers")
+    cmd.add_argument("--render-workers", default=0, type=int,
+                     help="number of message build processes (0 - build in main process)")
+    cmd.add_argument("--spool-segments", action="store_true", help="use the segment spool instead of files")
+    cmd.add_argument("-o", "--output", default="", help="write results as JSON to the file")
+    cmd.add_argument("-j", "--json", action="store_true", help="print results as JSON")
+    args = cmd.parse_args()
+
+    rows = list()
+    root = args.work_dir or tempfile.mkdtemp(prefix="mailer-bench-")
+    try:
+        for size in [int(value) for value in args.sizes.split(',')]:
+            sink = SMTPSink(latency=args.latency, transient=args.transient, permanent=args.permanent,
+                            max_connections=args.max_connections)
+            sink.start()
+            try:
+                rows.append(run(size, root.rstrip('/') + f"/{size}/", sink, args.concurrency, args.render_workers,
+                                args.spool_segments))
+            finally:
+                sink.stop()
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(rows, file, ensure_ascii=False, indent=4)
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=4))
+    else:
+        print(f"{'recipients':>10} {'msgs/s':>9} {'render p50/p99, ms':>19} {'build p50/p99, ms':>18} "
+              f"{'deliver p50/p99, ms':>20} {'failed':>7} {'peak RSS, MB':>13}")
+        for row in rows:
+            stages = row['stages']
+            print(f"{row['recipients']:>10} {row['msgs_per_sec']:>9.1f} "
+                  f"{stages['render']['p50']:>9.3f}/{stages['render']['p99']:<9.3f} "
+                  f"{stages['build']['p50']:>8.3f}/{stages['build']['p99']:<9.3f} "
+                  f"{stages['deliver']['p50']:>9.3f}/{stages['deliver']['p99']:<10.3f} "
+                  f"{row['failed']:>7} "
+                  f"{f'{row['peak_rss_mb']:.1f}' if row['peak_rss_mb'] is not None else 'n/a':>13}")
@@ -0,0 +1,240 @@
+# Imports
+import argparse
+import random
+import socketserver
+import threading
+import time
+
+# Defines
+class SinkHandler(socketserver.StreamRequestHandler):
+    """
+    Класс обработчика соединения приемника SMTP
+
+    Объект класса обслуживает одно соединение: отвечает на команды SMTP (EHLO, AUTH, MAIL, RCPT, DATA, RSET,
+    NOOP, QUIT), принимает и отбрасывает сообщения. Параметры (задержка, доли ошибок, лимит соединений) берутся
+    из сервера
+
+    Методы
+    ----------------
+        handle(self)
+            Обработка соединения
+        __reply(self, line: str)
+            Отправка ответа
+    """
+
+    def handle(self):
+        """
+        Обработка соединения
+
+        :return: None
+        """
+
+        server = self.server
+        if not server.open_connection():
+            self.__reply("421 Too many connections, try again later")
+            return
+        try:
+            self.__reply("220 sink ESMTP")
+            while line := self.rfile.readline():
+                command = line.decode(errors='replace').strip()
+                verb = command[:4].upper()
+                if verb == "EHLO":
+                    self.__reply("250-sink")
+                    self.__reply("250-AUTH PLAIN LOGIN")
+                    self.__reply("250 8BITMIME")
+                elif verb == "HELO":
+                    self.__reply("250 sink")
+                elif verb == "AUTH":
+                    self.__reply("235 Authentication succeeded")
+                elif verb in ("MAIL", "RSET", "NOOP"):
+                    self.__reply("250 OK")
+                elif verb == "RCPT":
+                    # Постоянный отказ получателю
+                    if random.random() < server.permanent:
+                        server.count('rejected')
+                        self.__reply("550 Mailbox unavailable")
+                    else:
+                        self.__reply("250 OK")
+                elif verb == "DATA":
+                    self.__reply("354 End data with <CR><LF>.<CR><LF>")
+                    size = 0
+                    while (data := self.rfile.readline()) not in (b".\r\n", b""):
+                        size += len(data)
+                    if server.latency:
+                        time.sleep(server.latency)
+                    # Временный отказ
+                    if random.random() < server.transient:
+                        server.count('deferred')
+                        self.__reply("451 Temporary failure, try again later")
+                    else:
+                        server.count('messages', size)
+                        self.__reply("250 OK queued")
+                elif verb == "QUIT":
+                    self.__reply("221 Bye")
+                    return
+                else:
+                    self.__reply("500 Command not recognized")
+        except OSError:
+            pass
+        finally:
+            server.close_connection()
+
+    def __reply(self, line: str):
+        """
+        Отправка ответа
+
+        :param line: Строка ответа без окончания
+        :return: None
+        """
+
+        self.wfile.write(line.encode() + b"\r\n")
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """
+    Класс локального приемника SMTP
+
+    Объект класса - сервер SMTP, который принимает сообщения и отбрасывает их, не доставляя. Используется для
+    измерения производительности отправки без обращения к настоящему серверу. Позволяет задать задержку ответа на
+    сообщение, долю временных (451) и постоянных (550) отказов и максимальное количество одновременных соединений
+    (сверх него сервер отвечает 421)
+
+    Методы
+    ----------------
+        __init__(self, address: str = "127.0.0.1", port: int = 0, latency: float = 0, transient: float = 0,
+                 permanent: float = 0, max_connections: int = 0)
+            Конструктор: Инициализация
+        start(self)
+            Запуск сервера в фоновом потоке
+        stop(self)
+            Остановка сервера
+        open_connection(self)
+            Учет нового соединения
+        close_connection(self)
+            Учет закрытого соединения
+        count(self, key: str, size: int = 0)
+            Увеличение счетчика
+        stats(self)
+            Счетчики сервера
+    Атрибуты
+    ----------------
+        :ivar {float} latency:          Задержка ответа на сообщение в секундах
+        :ivar {float} transient:        Доля временных отказов (0..1)
+        :ivar {float} permanent:        Доля постоянных отказов (0..1)
+        :ivar {int} max_connections:    Максимальное количество одновременных соединений (0 - без ограничения)
+        :ivar {dict} __stats:           Счетчики {connections, refused, messages, bytes, deferred, rejected}
+        :ivar {int} __connections:      Количество открытых соединений
+        :ivar {any} __lock:             Блокировка доступа к счетчикам
+        :ivar {any} __thread:           Фоновый поток сервера
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address: str = "127.0.0.1", port: int = 0, latency: float = 0, transient: float = 0,
+                 permanent: float = 0, max_connections: int = 0):
+        """
+        Конструктор: Инициализация
+
+        :param address:         Адрес сервера
+        :param port:            Порт сервера (0 - любой свободный)
+        :param latency:         Задержка ответа на сообщение в секундах
+        :param transient:       Доля временных отказов (0..1)
+        :param permanent:       Доля постоянных отказов (0..1)
+        :param max_connections: Максимальное количество одновременных соединений (0 - без ограничения)
+        """
+
+        super().__init__((address, port), SinkHandler)
+        self.latency = latency
+        self.transient = transient
+        self.permanent = permanent
+        self.max_connections = max_connections
+        self.__stats = {'connections': 0, 'refused': 0, 'messages': 0, 'bytes': 0, 'deferred': 0, 'rejected': 0}
+        self.__connections = 0
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def start(self):
+        """
+        Запуск сервера в фоновом потоке
+
+        :return: Порт сервера
+        """
+
+        self.__thread = threading.Thread(target=self.serve_forever, name="smtp-sink", daemon=True)
+        self.__thread.start()
+        return self.server_address[1]
+
+    def stop(self):
+        """
+        Остановка сервера
+
+        :return: None
+        """
+
+        self.shutdown()
+        self.server_close()
+
+    def open_connection(self):
+        """
+        Учет нового соединения
+
+        :return: False, если превышено максимальное количество соединений
+        """
+
+        with self.__lock:
+            if self.max_connections and self.__connections >= self.max_connections:
+                self.__stats['refused'] += 1
+                return False
+            self.__connections += 1
+            self.__stats['connections'] += 1
+            return True
+
+    def close_connection(self):
+        """
+        Учет закрытого соединения
+
+        :return: None
+        """
+
+        with self.__lock:
+            self.__connections -= 1
+
+    def count(self, key: str, size: int = 0):
+        """
+        Увеличение счетчика
+
+        :param key:     Имя счетчика
+        :param size:    Размер принятого сообщения в байтах
+        :return: None
+        """
+
+        with self.__lock:
+            self.__stats[key] += 1
+            self.__stats['bytes'] += size
+
+    def stats(self):
+        """
+        Счетчики сервера
+
+        :return: Копия счетчиков {connections, refused, messages, bytes, deferred, rejected}
+        """
+
+        with self.__lock:
+            return dict(self.__stats)
+
+if __name__ == '__main__':
+    cmd = argparse.ArgumentParser(prog="benchmarks.sink", description="Local SMTP sink")
+    cmd.add_argument("-a", "--address", default="127.0.0.1", help="listen address")
+    cmd.add_argument("-p", "--port", default=2525, type=int, help="listen port")
+    cmd.add_argument("--latency", default=0, type=float, help="reply delay per message, s")
+    cmd.add_argument("--transient", default=0, type=float, help="share of 451 replies (0..1)")
+    cmd.add_argument("--permanent", default=0, type=float, help="share of 550 replies (0..1)")
+    cmd.add_argument("--max-connections", default=0, type=int, help="connection limit (0 - unlimited)")
+    args = cmd.parse_args()
+
+    sink = SMTPSink(args.address, args.port, args.latency, args.transient, args.permanent, args.max_connections)
+    print(f"SMTP sink listening on {args.address}:{args.port}")
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        print(sink.stats())
@@ -0,0 +1,65 @@
+# Imports
+import argparse
+import json
+import os
+import timeit
+from handlers.tasks import transform
+from handlers.templates import Template
+
+# Defines
+def run(templates_directory: str, persons_file: str, number: int):
+    """
+    Сравнение обработки шаблонов
+
+    Измеряет время обработки каждого шаблона из каталога функцией transform и скомпилированным шаблоном на
+    словарях замен из базы персон. Перед замером проверяет совпадение результатов
+    :param templates_directory: Директория шаблонов
+    :param persons_file:        Файл базы персон
+    :param number:              Количество повторений
+    :return: Список результатов [{template, transform, compile, render, speedup}]
+    """
+
+    # Формируем словари замен
+    with open(persons_file, 'r', encoding='utf-8') as file:
+        persons = list(json.load(file).values())
+    common = {'Ваш телефон': '+7 000 000-00-00', 'Имя Фамилия': 'Имя Фамилия', 'Должность': 'Должность',
+              'Телефон': '+7 000 000-00-00', 'Адрес для ответа': 'reply@example.com'}
+    replaces = [common | person for person in persons]
+
+    results = list()
+    for template_file in sorted(os.listdir(templates_directory)):
+        if not template_file.endswith(('.txt', '.html')):
+            continue
+        with open(templates_directory + template_file, 'r', encoding='utf-8') as file:
+            text = file.read()
+        template = Template(text)
+        # Результаты обработки должны совпадать
+        for person in replaces:
+            assert template.render(person) == transform(text, person), template_file
+
+        time_transform = timeit.timeit(lambda: [transform(text, person) for person in replaces], number=number)
+        time_compile = timeit.timeit(lambda: Template(text), number=number)
+        time_render = timeit.timeit(lambda: [template.render(person) for person in replaces], number=number)
+        results.append({'template': template_file,
+                        'transform': time_transform / (number * len(replaces)) * 1e6,
+                        'compile': time_compile / number * 1e6,
+                        'render': time_render / (number * len(replaces)) * 1e6,
+                        'speedup': time_transform / time_render})
+    return results
+
+if __name__ == '__main__':
+    cmd = argparse.ArgumentParser(prog="benchmarks.templates", description="transform() vs compiled Template")
+    cmd.add_argument("-t", "--templates-dir", default="templates/", help="templates directory")
+    cmd.add_argument("-d", "--persons", default="db/persons.json", help="persons database")
+    cmd.add_argument("-n", "--number", default=200, type=int, help="number of repetitions")
+    cmd.add_argument("-j", "--json", action="store_true", help="print results as JSON")
+    args = cmd.parse_args()
+
+    rows = run(args.templates_dir, args.persons, args.number)
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=4))
+    else:
+        print(f"{'template':<60} {'transform, us':>14} {'compile, us':>12} {'render, us':>11} {'speedup':>8}")
+        for row in rows:
+            print(f"{row['template']:<60} {row['transform']:>14.2f} {row['compile']:>12.2f} "
+                  f"{row['render']:>11.2f} {row['speedup']:>7.1f}x")
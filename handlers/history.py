@@ -0,0 +1,339 @@
+# Imports
+import argparse
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+
+# Defines
+class BloomFilter:
+    """
+    Класс фильтра Блума
+
+    Объект класса за постоянное время отвечает, мог ли ключ быть добавлен ранее. Ответ "нет" точный, ответ "да"
+    может быть ложным с заданной вероятностью, поэтому он проверяется по дисковому хранилищу
+
+    Методы
+    ----------------
+        __init__(self, capacity: int, error_rate: float = 0.01)
+            Конструктор: Инициализация
+        add(self, key: str)
+            Добавление ключа
+        __contains__(self, key: str)
+            Проверка ключа
+        __len__(self)
+            Количество добавленных ключей
+        capacity(self)
+            Расчетное количество ключей
+        __positions(self, key: str)
+            Позиции битов ключа
+    Атрибуты
+    ----------------
+        :ivar {int} __capacity:     Расчетное количество ключей
+        :ivar {int} __size:         Количество битов
+        :ivar {int} __hashes:       Количество хеш-функций
+        :ivar {bytearray} __bits:   Битовый массив
+        :ivar {int} __count:        Количество добавленных ключей
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        """
+        Конструктор: Инициализация
+
+        :param capacity:    Расчетное количество ключей
+        :param error_rate:  Допустимая доля ложных ответов "да" при расчетном количестве ключей
+        """
+
+        self.__capacity = max(1024, capacity)
+        self.__size = math.ceil(-self.__capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.__hashes = max(1, round(self.__size / self.__capacity * math.log(2)))
+        self.__bits = bytearray((self.__size + 7) // 8)
+        self.__count = 0
+
+    def add(self, key: str):
+        """
+        Добавление ключа
+
+        :param key: Ключ
+        :return: None
+        """
+
+        for position in self.__positions(key):
+            self.__bits[position >> 3] |= 1 << (position & 7)
+        self.__count += 1
+
+    def __contains__(self, key: str):
+        """
+        Проверка ключа
+
+        :param key: Ключ
+        :return: False, если ключ точно не добавлялся
+        """
+
+        return all(self.__bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(key))
+
+    def __len__(self):
+        """
+        Количество добавленных ключей
+
+        :return: Количество ключей
+        """
+
+        return self.__count
+
+    def capacity(self):
+        """
+        Расчетное количество ключей
+
+        :return: Количество ключей, при котором соблюдается доля ложных ответов
+        """
+
+        return self.__capacity
+
+    def __positions(self, key: str):
+        """
+        Позиции битов ключа
+
+        Позиции получаются из двух половин одного хеша (двойное хеширование)
+        :param key: Ключ
+        :return: Генератор позиций
+        """
+
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.__size for i in range(self.__hashes))
+
+class SendHistory:
+    """
+    Класс истории отправки
+
+    Объект класса хранит в базе SQLite время последней отправки по ключу (получатель, шаблон, проект) и список
+    подавления (адреса с постоянным отказом доставки и отказавшиеся от рассылки). Проверка повторной отправки
+    выполняется в памяти: фильтр Блума отсекает ключи, которых нет в истории, а к базе обращается только при
+    положительном ответе фильтра. Список подавления хранится в памяти целиком. Новые записи истории копятся в
+    памяти и записываются в базу пачками
+
+    Методы
+    ----------------
+        __init__(self, filename: str, window: float = 86400, batch_size: int = 256)
+            Конструктор: Инициализация
+        key(rcpt: str, template: str, project: str)
+            Ключ истории
+        duplicate(self, rcpt: str, template: str, project: str)
+            Проверка повторной отправки
+        suppressed(self, rcpt: str)
+            Проверка адреса по списку подавления
+        add(self, rcpt: str, template: str, project: str)
+            Добавление записи об отправке
+        suppress(self, rcpt: str, reason: str)
+            Добавление адреса в список подавления
+        unsuppress(self, rcpt: str)
+            Удаление адреса из списка подавления
+        flush(self)
+            Запись накопленных записей в базу
+        close(self)
+            Закрытие базы
+        __load(self)
+            Загрузка фильтра и списка подавления
+    Атрибуты
+    ----------------
+        :ivar {float} __window:         Интервал, в течение которого повторная отправка запрещена, в секундах
+                                        (0 - проверка истории выключена)
+        :ivar {int} __batch_size:       Количество записей, при котором они записываются в базу
+        :ivar {any} __db:               Соединение с базой
+        :ivar {BloomFilter} __bloom:    Фильтр ключей истории
+        :ivar {dict} __pending:         Записи, ожидающие записи в базу {ключ: (получатель, шаблон, проект, время)}
+        :ivar {dict} __suppressed:      Список подавления {адрес: причина}
+        :ivar {any} __lock:             Блокировка доступа к состоянию
+    """
+
+    def __init__(self, filename: str, window: float = 86400, batch_size: int = 256):
+        """
+        Конструктор: Инициализация
+
+        Открывает (создает) базу, строит фильтр по записям в пределах интервала и загружает список подавления
+        :param filename:    Файл базы истории
+        :param window:      Интервал, в течение которого повторная отправка запрещена, в секундах
+        :param batch_size:  Количество записей, при котором они записываются в базу
+        """
+
+        self.__window = window
+        self.__batch_size = batch_size
+        self.__pending = dict()
+        self.__suppressed = dict()
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(filename, check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS history (rcpt TEXT NOT NULL, template TEXT NOT NULL, "
+                          "project TEXT NOT NULL, sent REAL NOT NULL, PRIMARY KEY (rcpt, template, project)) "
+                          "WITHOUT ROWID")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS history_sent ON history (sent)")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS suppression (rcpt TEXT PRIMARY KEY, reason TEXT, added REAL)")
+        self.__db.commit()
+        self.__bloom = None
+        self.__load()
+
+    @staticmethod
+    def key(rcpt: str, template: str, project: str):
+        """
+        Ключ истории
+
+        :param rcpt:        Адрес получателя
+        :param template:    Имя шаблона
+        :param project:     Проект
+        :return: Строка ключа
+        """
+
+        return f"{rcpt.lower()}\x1f{template}\x1f{project}"
+
+    def duplicate(self, rcpt: str, template: str, project: str):
+        """
+        Проверка повторной отправки
+
+        :param rcpt:        Адрес получателя
+        :param template:    Имя шаблона
+        :param project:     Проект
+        :return: True, если получателю уже отправлялся этот шаблон по этому проекту в пределах интервала
+        """
+
+        if not self.__window:
+            return False
+        key = self.key(rcpt, template, project)
+        since = time.time() - self.__window
+        with self.__lock:
+            pending = self.__pending.get(key)
+            if pending is not None:
+                return pending[3] >= since
+            if key not in self.__bloom:
+                return False
+            row = self.__db.execute("SELECT sent FROM history WHERE rcpt = ? AND template = ? AND project = ?",
+                                    (rcpt.lower(), template, project)).fetchone()
+        return row is not None and row[0] >= since
+
+    def suppressed(self, rcpt: str):
+        """
+        Проверка адреса по списку подавления
+
+        :param rcpt: Адрес получателя
+        :return: Причина подавления или None, если адреса в списке нет
+        """
+
+        return self.__suppressed.get(rcpt.lower())
+
+    def add(self, rcpt: str, template: str, project: str):
+        """
+        Добавление записи об отправке
+
+        :param rcpt:        Адрес получателя
+        :param template:    Имя шаблона
+        :param project:     Проект
+        :return: None
+        """
+
+        key = self.key(rcpt, template, project)
+        with self.__lock:
+            self.__pending[key] = (rcpt.lower(), template, project, time.time())
+            self.__bloom.add(key)
+            flush = len(self.__pending) >= self.__batch_size
+        if flush:
+            self.flush()
+
+    def suppress(self, rcpt: str, reason: str):
+        """
+        Добавление адреса в список подавления
+
+        :param rcpt:    Адрес получателя
+        :param reason:  Причина (например, "bounce 550", "unsubscribe")
+        :return: None
+        """
+
+        with self.__lock:
+            self.__suppressed[rcpt.lower()] = reason
+            self.__db.execute("INSERT OR REPLACE INTO suppression VALUES (?, ?, ?)", (rcpt.lower(), reason, time.time()))
+            self.__db.commit()
+
+    def unsuppress(self, rcpt: str):
+        """
+        Удаление адреса из списка подавления
+
+        :param rcpt: Адрес получателя
+        :return: None
+        """
+
+        with self.__lock:
+            self.__suppressed.pop(rcpt.lower(), None)
+            self.__db.execute("DELETE FROM suppression WHERE rcpt = ?", (rcpt.lower(),))
+            self.__db.commit()
+
+    def flush(self):
+        """
+        Запись накопленных записей в базу
+
+        Если фильтр заполнен сверх расчетного количества ключей, он перестраивается с большей емкостью
+        :return: None
+        """
+
+        with self.__lock:
+            if self.__pending:
+                self.__db.executemany("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?)", self.__pending.values())
+                self.__db.commit()
+                self.__pending.clear()
+            rebuild = len(self.__bloom) > self.__bloom.capacity()
+        if rebuild:
+            self.__load()
+
+    def close(self):
+        """
+        Закрытие базы
+
+        :return: None
+        """
+
+        self.flush()
+        with self.__lock:
+            self.__db.close()
+
+    def __load(self):
+        """
+        Загрузка фильтра и списка подавления
+
+        В фильтр попадают только записи в пределах интервала - более старые не могут быть повторной отправкой
+        :return: None
+        """
+
+        with self.__lock:
+            since = time.time() - self.__window
+            count = self.__db.execute("SELECT COUNT(*) FROM history WHERE sent >= ?", (since,)).fetchone()[0]
+            bloom = BloomFilter(max(count * 2, 65536))
+            for rcpt, template, project in self.__db.execute(
+                    "SELECT rcpt, template, project FROM history WHERE sent >= ?", (since,)):
+                bloom.add(self.key(rcpt, template, project))
+            for key in self.__pending:
+                bloom.add(key)
+            self.__bloom = bloom
+            self.__suppressed = dict(self.__db.execute("SELECT rcpt, reason FROM suppression"))
+
+if __name__ == '__main__':
+    cmd = argparse.ArgumentParser(prog="handlers.history", description="Manage the send suppression list")
+    cmd.add_argument("history", help="send history SQLite file")
+    cmd.add_argument("action", choices=["suppress", "unsuppress"], help="add or remove addresses")
+    cmd.add_argument("addresses", nargs="+", help="e-mail addresses or a file with one address per line (@file)")
+    cmd.add_argument("-r", "--reason", default="unsubscribe", help="suppression reason")
+    args = cmd.parse_args()
+
+    history = SendHistory(args.history)
+    count = 0
+    for value in args.addresses:
+        if value.startswith('@'):
+            with open(value[1:], 'r', encoding='utf-8') as file:
+                addresses = [line.strip() for line in file if line.strip()]
+        else:
+            addresses = [value]
+        for address in addresses:
+            if args.action == "suppress":
+                history.suppress(address, args.reason)
+            else:
+                history.unsuppress(address)
+            count += 1
+    history.close()
+    print(f"{count} addresses {args.action}ed")
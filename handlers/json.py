@@ -1,6 +1,7 @@
 # Imports
 import json
 import logging
+import os
 from json import JSONDecodeError
 
 # Defines
@@ -40,10 +41,13 @@ class JSONHandler:
         self.logs_directory = logs_directory
         self.__logger = logging.getLogger(__name__)
         self.__logger.setLevel(logging.INFO)
-        logger_handler = logging.FileHandler(f"{logs_directory}/{__name__}.log", mode='a')
-        logger_formatter = logging.Formatter("%(name)s %(asctime)s %(levelname)s %(message)s")
-        logger_handler.setFormatter(logger_formatter)
-        self.__logger.addHandler(logger_handler)
+        # Логгер модуля общий для всех объектов - обработчик файла добавляется только один раз
+        log_filename = os.path.abspath(f"{logs_directory}/{__name__}.log")
+        if not any(getattr(handler, 'baseFilename', None) == log_filename for handler in self.__logger.handlers):
+            logger_handler = logging.FileHandler(log_filename, mode='a')
+            logger_formatter = logging.Formatter("%(name)s %(asctime)s %(levelname)s %(message)s")
+            logger_handler.setFormatter(logger_formatter)
+            self.__logger.addHandler(logger_handler)
         # Инициализируем данные
         self.__data = dict()
 
@@ -56,6 +60,8 @@ class JSONHandler:
         :return: None
         """
 
+        # Сбрасываем данные предыдущего файла, чтобы при ошибке чтения не вернуть их повторно
+        self.__data = dict()
         # Открываем файл
         try:
             with open(filename, 'r', encoding='utf-8') as file:
@@ -0,0 +1,144 @@
+# Imports
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+# Defines
+class PersonsStore:
+    """
+    Класс хранилища персон
+
+    Объект класса отдает персональные словари замен по адресу электронной почты. Хранилище открывается один раз
+    на процесс. Файл SQLite (.db, .sqlite) используется как дисковый индекс с точечными запросами по адресу - в
+    памяти находятся только недавно запрошенные записи. Файл JSON загружается в память целиком. Одинаковые блоки
+    данных (компания, проект) хранятся в одном экземпляре
+
+    Методы
+    ----------------
+        __init__(self, filename: str, cache_size: int = 65536)
+            Конструктор: Инициализация
+        get(self, email: str)
+            Получение словаря замен персоны
+        close(self)
+            Закрытие хранилища
+        convert(json_filename: str, db_filename: str)
+            Импорт базы персон из JSON в SQLite
+    Атрибуты
+    ----------------
+        :ivar {any} __db:           Соединение с SQLite (None для JSON)
+        :ivar {dict} __persons:     Персоны, загруженные из JSON {адрес: словарь замен}
+        :ivar {any} __profiles:     Кеш блоков данных, прочитанных из SQLite {ид блока: словарь замен}
+        :ivar {int} __cache_size:   Максимальное количество блоков в кеше
+        :ivar {any} __lock:         Блокировка доступа к соединению
+    """
+
+    def __init__(self, filename: str, cache_size: int = 65536):
+        """
+        Конструктор: Инициализация
+
+        Открывает хранилище персон. Тип хранилища определяется расширением файла
+        :param filename:    Файл базы персон (JSON или SQLite)
+        :param cache_size:  Максимальное количество блоков данных в кеше
+        """
+
+        self.__db = None
+        self.__persons = dict()
+        self.__profiles = OrderedDict()
+        self.__cache_size = cache_size
+        self.__lock = threading.Lock()
+
+        if filename.endswith(('.db', '.sqlite')):
+            self.__db = sqlite3.connect(f"file:{filename}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            # Загружаем JSON один раз, одинаковые блоки данных храним в одном экземпляре
+            profiles = dict()
+            with open(filename, 'r', encoding='utf-8') as file:
+                for email, person in json.load(file).items():
+                    key = tuple((sys.intern(k), sys.intern(v)) for k, v in person.items())
+                    self.__persons[email] = profiles.setdefault(key, dict(key))
+
+    def get(self, email: str):
+        """
+        Получение словаря замен персоны
+
+        :param email:   Адрес электронной почты
+        :return: Словарь замен или None, если персона не найдена
+        """
+
+        if self.__db is None:
+            return self.__persons.get(email)
+
+        with self.__lock:
+            row = self.__db.execute("SELECT profile FROM persons WHERE email = ?", (email,)).fetchone()
+            if row is None:
+                return None
+            profile = self.__profiles.get(row[0])
+            if profile is None:
+                fields = self.__db.execute("SELECT fields FROM profiles WHERE id = ?", (row[0],)).fetchone()[0]
+                profile = json.loads(fields)
+                self.__profiles[row[0]] = profile
+                # Вытесняем давно не использованные блоки
+                if len(self.__profiles) > self.__cache_size:
+                    self.__profiles.popitem(last=False)
+            else:
+                self.__profiles.move_to_end(row[0])
+            return profile
+
+    def close(self):
+        """
+        Закрытие хранилища
+
+        :return: None
+        """
+
+        if self.__db is not None:
+            self.__db.close()
+            self.__db = None
+
+    @staticmethod
+    def convert(json_filename: str, db_filename: str):
+        """
+        Импорт базы персон из JSON в SQLite
+
+        Создает файл SQLite с индексом по адресу. Одинаковые блоки данных записываются в таблицу профилей один раз,
+        персоны ссылаются на них по идентификатору
+        :param json_filename:   Исходный файл JSON
+        :param db_filename:     Файл SQLite (перезаписывается)
+        :return: Количество импортированных персон
+        """
+
+        with open(json_filename, 'r', encoding='utf-8') as file:
+            persons = json.load(file)
+
+        # Записываем во временный файл и подменяем им базу после успешного импорта
+        temp_filename = db_filename + ".tmp"
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        db = sqlite3.connect(temp_filename)
+        try:
+            db.execute("CREATE TABLE profiles (id INTEGER PRIMARY KEY, fields TEXT NOT NULL UNIQUE)")
+            db.execute("CREATE TABLE persons (email TEXT PRIMARY KEY, profile INTEGER NOT NULL) WITHOUT ROWID")
+            profiles = dict()
+            for email, person in persons.items():
+                fields = json.dumps(person, ensure_ascii=False, sort_keys=True)
+                if fields not in profiles:
+                    profiles[fields] = db.execute("INSERT INTO profiles (fields) VALUES (?)", (fields,)).lastrowid
+                db.execute("INSERT OR REPLACE INTO persons VALUES (?, ?)", (email, profiles[fields]))
+            db.commit()
+        finally:
+            db.close()
+        os.replace(temp_filename, db_filename)
+
+        return len(persons)
+
+if __name__ == '__main__':
+    cmd = argparse.ArgumentParser(prog="handlers.persons", description="Import persons database from JSON to SQLite")
+    cmd.add_argument("source", help="persons JSON file")
+    cmd.add_argument("target", help="persons SQLite file")
+    args = cmd.parse_args()
+
+    print(f"{PersonsStore.convert(args.source, args.target)} persons imported to {args.target}")
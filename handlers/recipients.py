@@ -0,0 +1,71 @@
+# Imports
+import csv
+import gzip
+import json
+
+# Defines
+class RecipientSource:
+    """
+    Класс источника получателей
+
+    Объект класса построчно читает файл со списком получателей (CSV с заголовком или JSONL, в том числе сжатые
+    gzip) и отдает адрес и персональный словарь замен для каждой строки. Файл читается при каждом переборе заново и
+    в памяти находится только текущая строка
+
+    Формат строк:
+        CSV:    email,Имя,Проект,...        (столбец email обязателен, остальные столбцы - замены)
+        JSONL:  {"email": "...", "Имя": "...", ...}
+
+    Методы
+    ----------------
+        __init__(self, filename: str)
+            Конструктор: Инициализация
+        __iter__(self)
+            Перебор получателей (генератор)
+        __open(self)
+            Открытие файла
+    Атрибуты
+    ----------------
+        :cvar {str} EMAIL:          Имя поля адреса получателя
+        :ivar {str} filename:       Файл со списком получателей
+    """
+
+    EMAIL = "email"
+
+    def __init__(self, filename: str):
+        """
+        Конструктор: Инициализация
+
+        :param filename: Файл со списком получателей (.csv, .jsonl, с необязательным расширением .gz)
+        """
+
+        self.filename = filename
+
+    def __iter__(self):
+        """
+        Перебор получателей (генератор)
+
+        Пропускает пустые строки и строки без адреса
+        :return: Пары (адрес получателя, словарь замен из строки)
+        """
+
+        with self.__open() as file:
+            if self.filename.removesuffix('.gz').endswith('.jsonl'):
+                rows = (json.loads(line) for line in file if line.strip())
+            else:
+                rows = csv.DictReader(file)
+            for row in rows:
+                email = (row.pop(self.EMAIL, None) or '').strip()
+                if email:
+                    yield email, {k: str(v) for k, v in row.items() if k is not None and v not in (None, '')}
+
+    def __open(self):
+        """
+        Открытие файла
+
+        :return: Текстовый поток файла
+        """
+
+        if self.filename.endswith('.gz'):
+            return gzip.open(self.filename, 'rt', encoding='utf-8', newline='')
+        return open(self.filename, 'r', encoding='utf-8', newline='')
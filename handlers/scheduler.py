@@ -0,0 +1,163 @@
+# Imports
+import datetime
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+# Defines
+def interval(value):
+    """
+    Разбор интервала повтора
+
+    Число трактуется как количество дней (как раньше), строка - как набор частей с единицами измерения:
+    d - дни, h - часы, m - минуты (например "1d12h", "3h", "30m")
+    :param value: Интервал повтора
+    :return: Интервал в виде timedelta
+    """
+
+    if isinstance(value, (int, float)):
+        return datetime.timedelta(days=value)
+
+    # Строка должна целиком состоять из частей с единицами измерения
+    value = value.lower().replace(' ', '')
+    if not re.fullmatch(r'(\d+(\.\d+)?[dhm])+', value):
+        raise ValueError(f"Invalid repeat interval {value!r}")
+    units = {'d': 'days', 'h': 'hours', 'm': 'minutes'}
+    result = datetime.timedelta()
+    for amount, unit in re.findall(r'(\d+(?:\.\d+)?)([dhm])', value):
+        result += datetime.timedelta(**{units[unit]: float(amount)})
+    return result
+
+class Scheduler:
+    """
+    Класс планировщика отложенных заданий
+
+    Объект класса хранит индекс отложенных заданий по времени их запуска в базе SQLite в каталоге отложенных
+    заданий. Поиск заданий, время которых наступило, выполняется по индексу без просмотра каталога. Задания,
+    время которых прошло (например, пока программа не работала), также считаются наступившими. Файлы каталога,
+    отсутствующие в индексе (записанные до его появления, с префиксом DDMMYYYY), добавляются при открытии
+
+    Методы
+    ----------------
+        __init__(self, suspend_directory: str)
+            Конструктор: Инициализация
+        add(self, task_file: str, due: datetime.datetime)
+            Добавление задания
+        due(self, now: datetime.datetime = None)
+            Задания, время которых наступило
+        remove(self, task_file: str)
+            Удаление задания
+        next(self)
+            Время ближайшего задания
+        close(self)
+            Закрытие индекса
+        __recover(self)
+            Добавление в индекс файлов каталога
+    Атрибуты
+    ----------------
+        :cvar {str} INDEX:              Имя файла индекса
+        :ivar {str} __directory:        Директория отложенных заданий
+        :ivar {any} __db:               Соединение с базой индекса
+        :ivar {any} __lock:             Блокировка доступа к соединению
+    """
+
+    INDEX = "schedule.db"
+
+    def __init__(self, suspend_directory: str):
+        """
+        Конструктор: Инициализация
+
+        Открывает (создает) индекс и добавляет в него файлы каталога, которых в нем нет
+        :param suspend_directory: Директория отложенных заданий
+        """
+
+        self.__directory = suspend_directory
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(suspend_directory + self.INDEX, check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS schedule (file TEXT PRIMARY KEY, due REAL NOT NULL)")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS schedule_due ON schedule (due)")
+        self.__db.commit()
+        self.__recover()
+
+    def add(self, task_file: str, due: datetime.datetime):
+        """
+        Добавление задания
+
+        :param task_file:   Имя файла задания в каталоге отложенных заданий
+        :param due:         Время запуска
+        :return: None
+        """
+
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO schedule VALUES (?, ?)", (task_file, due.timestamp()))
+            self.__db.commit()
+
+    def due(self, now: datetime.datetime = None):
+        """
+        Задания, время которых наступило
+
+        :param now: Текущее время (по умолчанию - системное)
+        :return: Список имен файлов заданий в порядке времени запуска
+        """
+
+        now = now or datetime.datetime.now()
+        with self.__lock:
+            return [row[0] for row in
+                    self.__db.execute("SELECT file FROM schedule WHERE due <= ? ORDER BY due", (now.timestamp(),))]
+
+    def remove(self, task_file: str):
+        """
+        Удаление задания
+
+        :param task_file: Имя файла задания
+        :return: None
+        """
+
+        with self.__lock:
+            self.__db.execute("DELETE FROM schedule WHERE file = ?", (task_file,))
+            self.__db.commit()
+
+    def next(self):
+        """
+        Время ближайшего задания
+
+        :return: Время запуска ближайшего задания или None, если заданий нет
+        """
+
+        with self.__lock:
+            due = self.__db.execute("SELECT MIN(due) FROM schedule").fetchone()[0]
+        return None if due is None else datetime.datetime.fromtimestamp(due)
+
+    def close(self):
+        """
+        Закрытие индекса
+
+        :return: None
+        """
+
+        with self.__lock:
+            self.__db.close()
+
+    def __recover(self):
+        """
+        Добавление в индекс файлов каталога
+
+        Добавляет в индекс файлы заданий, которых в нем нет. Время запуска определяется по префиксу имени файла
+        (DDMMYYYY или DDMMYYYYHHMM), а при его отсутствии задание считается наступившим
+        :return: None
+        """
+
+        with self.__lock:
+            known = {row[0] for row in self.__db.execute("SELECT file FROM schedule")}
+        for task_file in os.listdir(self.__directory):
+            if not task_file.endswith('.json') or task_file in known:
+                continue
+            prefix = task_file.split('_', 1)[0]
+            try:
+                due = datetime.datetime.strptime(prefix, '%d%m%Y%H%M' if len(prefix) == 12 else '%d%m%Y')
+            except ValueError:
+                due = datetime.datetime.now()
+            logging.info(f"Suspended task {task_file} added to schedule at {due}")
+            self.add(task_file, due)
@@ -1,6 +1,13 @@
 # Imports
+import logging
+import os
 import uuid
 import datetime
+import heapq
+import itertools
+from handlers.templates import Template, TemplateStore
+from handlers.recipients import RecipientSource
+from handlers.scheduler import interval
 
 # Defines
 def transform(text: str, replaces: dict):
@@ -26,31 +33,69 @@ class TaskManager:
     Класс обработчика заданий (синглетон)
 
     Объект класса обрабатывает задания из рабочего каталога и создает очередь заданий. В процессе формирования
-    очереди выполняются операции, специфичные для каждого задания определенного типа
+    очереди выполняются операции, специфичные для каждого задания определенного типа. Задания выдаются в порядке
+    класса (транзакционные раньше массовых) и приоритета, а получатели нескольких заданий могут выдаваться
+    вперемешку - каждому заданию достается доля, пропорциональная его весу. Ошибка в одном задании (например,
+    отсутствующий шаблон или файл получателей) завершает только это задание
 
     Методы
     ----------------
         __new__(cls, *args, **kwargs)
             Конструктор: Создание
-        __init__(self, tasks_directory: str, templates_directory: str, parser
+        __init__(self, tasks_directory: str, templates_directory: str, parser, persons, scheduler, history=None)
             Конструктор: Инициализация
-        parse(self, files: list)
+        parse(self, files: list, fail = None)
             Парсинг заданий
-        get(self, service: str = None)
+        add(self, file: str, content: dict)
+            Добавление задания
+        repeat(self, file: str)
+            Планирование вторичной рассылки
+        validate(content: dict)
+            Проверка задания почтовой рассылки
+        get(self, service: str = None, skip = None)
             Получение содержимого задания
+        stream(self, service: str, skip = None, done = None, active: int = 16, fail = None)
+            Чередование получателей заданий (генератор)
+        cancel(self, task_file: str)
+            Снятие задания с выполнения
         count(self)
             Количество заданий
-        __from_template(self, template_file: str, replaces: dict)
-            Считывание шаблона и подготовка текста
+        template_stats(self)
+            Счетчики хранилища шаблонов
+        __pop(self, service: str)
+            Извлечение первого задания из очереди
+        __start(self, task_file: str, task: dict, skip)
+            Подготовка задания к выполнению
+        __fail(self, task_file: str, error: Exception, fail)
+            Завершение задания с ошибкой
+        __render(self, task_file: str, task: dict, recipients, skip: set)
+            Обработка получателей почтовой рассылки (генератор)
+        __filter(self, task_file: str, task: dict, recipients)
+            Отбор получателей по истории отправки (генератор)
+        __person(self, task: dict, rcpt: str, row: dict)
+            Персональный словарь замен и проект получателя
     Атрибуты
     ----------------
         :cvar {any} __instance:                 Экземпляр класса (синглетон)
+        :cvar {dict} CLASSES:                   Веса классов заданий {класс: вес}
         :ivar {str} __tasks_directory:          Директория заданий
-        :ivar {str} __templates_directory:      Директория шаблонов
-        :ivar {dict} __tasks:                   Очередь заданий
+        :ivar {str} __files_directory:          Директория c прикрепляемыми файлами
+        :ivar {any} __templates:                Хранилище скомпилированных шаблонов
+        :ivar {any} __persons:                  Хранилище персон
+        :ivar {any} __scheduler:                Планировщик отложенных заданий
+        :ivar {any} __history:                  История отправки (None - без проверки повторов)
+        :ivar {set} __planned:                  Ключи истории получателей, принятых в работу в текущем цикле
+        :ivar {dict} __repeats:                 Вторичные рассылки, которые планируются по завершении заданий
+                                                {имя файла: (задание вторичной рассылки, время запуска)}
+        :ivar {dict} __tasks:                   Задания в очереди {имя файла: задание}
+        :ivar {dict} __queue:                   Очереди с приоритетом (кучи) по сервисам
+                                                {сервис: [(ранг, номер, имя файла)]}
+        :ivar {dict} __active:                  Задания, получатели которых перебираются {имя файла: состояние}
+        :ivar {any} __sequence:                 Счетчик для сохранения порядка поступления
     """
 
     __instance = None
+    CLASSES = {'transactional': 100, 'bulk': 1}
 
     def __new__(cls, *args, **kwargs):
         """
@@ -67,130 +112,437 @@ class TaskManager:
             cls.__instance = super().__new__(cls)
         return cls.__instance
 
-    def __init__(self, tasks_directory: str, templates_directory: str, parser):
+    def __init__(self, tasks_directory: str, templates_directory: str, parser, persons, scheduler, history=None):
         """
         Конструктор: Инициализация
 
         Инициализирует объект класса путями рабочего каталога и каталога шаблонов, создаем переменную класса для
-        хранимых данных. В объект передается экземпляр стороннего парсера для обработки связанных данных
+        хранимых данных. В объект передается экземпляр стороннего парсера для обработки связанных данных и
+        хранилище персон для получения персональных словарей замен, планировщик вторичных рассылок и история
+        отправки для отсева повторных отправок
         :param tasks_directory:     Директория заданий
         :param templates_directory: Директория шаблонов
         :param parser:              Сторонний обработчик
+        :param persons:             Хранилище персон
+        :param scheduler:           Планировщик отложенных заданий
+        :param history:             История отправки
         """
 
         self.__tasks_directory = tasks_directory
-        self.__templates_directory = templates_directory
+        self.__files_directory = templates_directory + "files/"
+        self.__templates = TemplateStore(templates_directory)
         self.__parser = parser
+        self.__persons = persons
+        self.__scheduler = scheduler
+        self.__history = history
+        self.__planned = set()
+        self.__repeats = dict()
         self.__tasks = dict()
+        self.__queue = dict()
+        self.__active = dict()
+        self.__sequence = itertools.count()
 
-    def parse(self, files: list):
+    def parse(self, files: list, fail = None):
         """
         Парсинг заданий
 
         Парсит рабочую директорию и отрабатывает задания, находящиеся в ней. Работа по чтению файлов заданий и
-        их первичная обработка передается стороннему парсеру
+        их первичная обработка передается стороннему парсеру. Получатели, которым шаблон задания уже отправлялся
+        (в том числе в другом задании), и адреса из списка подавления отсеиваются до обработки шаблонов.
+        Задание может содержать класс (class: transactional или bulk, по умолчанию bulk) и приоритет (priority:
+        целое число, по умолчанию 0, больше - срочнее). Задания, уже находящиеся в очереди или в работе, пропускаются.
+        Задание, которое не удалось разобрать, не останавливает разбор остальных
         :param files:   Список файлов заданий
+        :param fail:    Функция, которая вызывается при ошибке задания с именем файла задания и описанием ошибки
         :return: None
         """
 
         # Парсим список файлов и разбираем задания
         for file in files:
-            # Получаем содержимое задания
-            self.__parser.parse(self.__tasks_directory + file)
-            content = self.__parser.get()
-
-            # Определяем контекст задания
-            if content["service"] == "mailer":
-                # Собираем задание из существующих полей генератором словаря
-                task = dict({x: content[x] for x in
-                             ['service', 'from', 'to', 'subject', 'images', 'template', 'repeat', 'repeat-subject',
-                              'repeat-images', 'repeat-template', 'replaces'] if x in content})
-                # Загружаем персональный словарь замен
-                self.__parser.parse("db/persons.json")
-                persons = self.__parser.get()
-                # Разделяем получателей
-                recipients = dict()
-                for rcpt in task['to'].replace(' ', '').split(','):
-                    # Формируем индивидуальные блоки под каждого получателя
-                    recipients[rcpt] = {'subject': task['subject'], 'replaces': persons[rcpt],
-                                        'txt_body': '', 'html_body': ''}
-                # Записываем блоки получателей
-                task['to'] = recipients
-                # Удаляем элемент с общей темой сообщения
-                task.pop('subject')
-                # Помещаем задание в очередь
-                self.__tasks[file] = task
-
-                # Обрабатываем вторичную рассылку
-                if 'repeat' in task:
-                    suspended = {'service': 'mailer', 'from': task['from'], 'to': content['to'],
-                                 'subject': content['repeat-subject'], 'images': content['repeat-images'], 'template': content['repeat-template'],
-                                 'replaces': content['replaces']}
-                    # Записываем задание в файл
-                    self.__parser.set(suspended)
-                    self.__parser.dump(self.__tasks_directory +
-                                       f'suspend/{(datetime.datetime.now() + 
-                                                   datetime.timedelta(content['repeat'])).strftime('%d%m%Y')}_{uuid.uuid4()}.json')
-
-    def get(self, service: str = None):
+            if file in self.__tasks or file in self.__active:
+                continue
+            try:
+                # Получаем содержимое задания
+                self.__parser.parse(self.__tasks_directory + file)
+                self.add(file, self.__parser.get())
+            except Exception as error:
+                self.__fail(file, error, fail)
+
+    def add(self, file: str, content: dict):
+        """
+        Добавление задания
+
+        Разбирает содержимое задания, полученное не из файла (например, через интерфейс постановки заданий), и
+        помещает его в очередь так же, как задания рабочего каталога. Задание, уже находящееся в очереди или в
+        работе, пропускается. Для некорректного задания почтовой рассылки вызывается исключение ValueError
+        :param file:    Имя задания
+        :param content: Содержимое задания
+        :return: None
+        """
+
+        if file in self.__tasks or file in self.__active:
+            return
+        # Задания предыдущего цикла отправлены - их получатели уже в истории отправки
+        if not self.__tasks and not self.__active:
+            self.__planned.clear()
+
+        # Определяем контекст задания
+        if content.get("service") == "mailer":
+            error = self.validate(content)
+            if error is not None:
+                raise ValueError(error)
+            # Собираем задание из существующих полей генератором словаря
+            task = dict({x: content[x] for x in
+                         ['service', 'from', 'to', 'to-file', 'subject', 'images', 'template', 'repeat',
+                          'repeat-subject', 'repeat-images', 'repeat-template', 'replaces', 'class', 'priority']
+                         if x in content})
+            # Определяем класс и приоритет задания
+            if task.setdefault('class', 'bulk') not in self.CLASSES:
+                logging.warning(f"Task {file}: unknown class {task['class']!r}, bulk is used")
+                task['class'] = 'bulk'
+            try:
+                task['priority'] = int(task.get('priority', 0))
+            except (ValueError, TypeError):
+                logging.warning(f"Task {file}: invalid priority {task['priority']!r}, 0 is used")
+                task['priority'] = 0
+            task.setdefault('replaces', dict())
+            if 'to-file' in task:
+                # Получатели читаются из файла и отбираются по истории по мере отправки
+                task['to'] = RecipientSource(task.pop('to-file'))
+                if self.__history is not None:
+                    task['to'] = self.__filter(file, task, task['to'])
+            else:
+                # Разделяем получателей (без повторов) и сразу отбираем их по истории
+                task['to'] = [(rcpt, dict()) for rcpt in dict.fromkeys(task['to'].replace(' ', '').split(','))]
+                if self.__history is not None:
+                    task['to'] = list(self.__filter(file, task, task['to']))
+            # Помещаем задание в очередь (по классу, затем по приоритету, затем в порядке поступления)
+            self.__tasks[file] = task
+            heapq.heappush(self.__queue.setdefault(task['service'], list()),
+                           ((-self.CLASSES[task['class']], -task['priority']), next(self.__sequence), file))
+
+            # Готовим вторичную рассылку (планируется по завершении задания, поэтому повторный разбор прерванного
+            # задания не создает ее копию)
+            if 'repeat' in task:
+                suspended = {'service': 'mailer', 'from': task['from'],
+                             'subject': content['repeat-subject'], 'images': content.get('repeat-images'),
+                             'template': content['repeat-template'], 'replaces': task['replaces']}
+                # Вторичная рассылка сохраняет класс и приоритет задания
+                for field in ('class', 'priority'):
+                    if field in content:
+                        suspended[field] = content[field]
+                # Файл со списком получателей передается ссылкой, а не копией списка
+                if 'to-file' in content:
+                    suspended['to-file'] = content['to-file']
+                else:
+                    suspended['to'] = content['to']
+                # Определяем время запуска (дни числом или строка вида "1d12h", "3h", "30m")
+                try:
+                    due = datetime.datetime.now() + interval(content['repeat'])
+                except (ValueError, TypeError):
+                    logging.error(f"Task {file}: invalid repeat {content['repeat']!r}, repeat skipped")
+                    return
+                self.__repeats[file] = (suspended, due)
+
+    def repeat(self, file: str):
+        """
+        Планирование вторичной рассылки
+
+        Вызывается по завершении задания: записывает вторичную рассылку задания (если она есть) в каталог
+        отложенных заданий и вносит ее в планировщик
+        :param file:    Имя задания
+        :return: None
+        """
+
+        if file not in self.__repeats:
+            return
+        suspended, due = self.__repeats.pop(file)
+        # Записываем задание в файл и вносим его в планировщик
+        suspend_file = f'{due.strftime('%d%m%Y%H%M')}_{uuid.uuid4()}.json'
+        self.__parser.set(suspended)
+        self.__parser.dump(self.__tasks_directory + f'suspend/{suspend_file}')
+        self.__scheduler.add(suspend_file, due)
+
+    @staticmethod
+    def validate(content: dict):
+        """
+        Проверка задания почтовой рассылки
+
+        Проверяет наличие и тип полей, без которых задание не может быть выполнено
+        :param content: Содержимое задания
+        :return: Описание ошибки или None, если задание корректно
+        """
+
+        for field in ('from', 'subject', 'template'):
+            if not isinstance(content.get(field), str) or not content[field]:
+                return f"field {field!r} is required"
+        if not isinstance(content.get('to'), str) and not isinstance(content.get('to-file'), str):
+            return "field 'to' or 'to-file' is required"
+        if 'replaces' in content and not isinstance(content['replaces'], dict):
+            return "field 'replaces' must be an object"
+        for field in ('images', 'attachments'):
+            if content.get(field) is not None and not isinstance(content[field], dict):
+                return f"field {field!r} must be an object"
+        if 'repeat' in content:
+            for field in ('repeat-subject', 'repeat-template'):
+                if not isinstance(content.get(field), str) or not content[field]:
+                    return f"field {field!r} is required for a repeated task"
+        return None
+
+    def get(self, service: str = None, skip = None):
         """
         Получение содержимого задания
 
-        Возвращает первое задание, которое отвечает условию (задание убирается из очереди). В процессе производится
-        обработка дополнительных полей задания в зависимости от контекста. Если контекст задания не указан,
-        то возвращает первое задание в очереди без его отработки
+        Возвращает первое по классу и приоритету задание, которое отвечает условию (задание убирается из очереди).
+        В процессе производится обработка дополнительных полей задания в зависимости от контекста. Для почтовой
+        рассылки поле получателей заменяется генератором, который обрабатывает шаблоны для очередного получателя
+        только по запросу
         :param service: Имя сервиса
-        :return: Отработанное задание в виде пары {имя_фала | задание}
+        :param skip:    Функция, возвращающая по имени файла задания множество адресов получателей, которых следует
+                        пропустить (например, уже обработанных до сбоя)
+        :return: Отработанное задание в виде пары {имя_фала | задание} или None, если подходящих заданий нет
         """
 
         # Отбираем задание по имени сервиса
-        for task_file, task in self.__tasks.items():
-            if task['service'] == service:
-                # Если контекст задания почтовая рассылка
-                if task['service'] == "mailer":
-
-                    for rcpt in task['to']:
-                        # Обрабатываем тему письма
-                        task['to'][rcpt]['subject'] = transform(task['to'][rcpt]['subject'],
-                                                                task['to'][rcpt]['replaces'])
-                        # Загружаем шаблоны (текстовой и html) и производим обработку текста
-                        task['to'][rcpt]['txt_body'] = self.__from_template(task['template'] + '.txt',
-                                                                            task['replaces'] | task['to'][rcpt][
-                                                                                'replaces'])
-                        task['to'][rcpt]['html_body'] = self.__from_template(task['template'] + '.html',
-                                                                             task['replaces'] | task['to'][rcpt][
-                                                                                 'replaces'])
-                    # Возвращаем отработанное задание
-                    return task_file, self.__tasks.pop(task_file)
-                else:
-                    # Возвращаем задание без отработки
-                    return task_file, self.__tasks.pop(task_file)
+        picked = self.__pop(service)
+        if picked is not None:
+            self.__start(*picked, skip)
+        return picked
+
+    def stream(self, service: str, skip = None, done = None, active: int = 16, fail = None):
+        """
+        Чередование получателей заданий (генератор)
+
+        Берет задания в работу в порядке класса и приоритета и выдает их получателей вперемешку: задание получает
+        долю, пропорциональную весу класса, умноженному на (1 + приоритет), поэтому срочное задание, появившееся
+        во время массовой рассылки, выполняется почти сразу, а рассылка при этом не останавливается. Одновременно
+        в работе не более active заданий (транзакционные берутся в работу сверх ограничения). Задания, добавленные
+        в очередь во время перебора, также берутся в работу. Задание, при подготовке или переборе получателей
+        которого произошла ошибка, исключается из работы, остальные задания продолжают выполняться
+        :param service: Имя сервиса
+        :param skip:    Функция, возвращающая по имени файла задания множество адресов получателей, которых следует
+                        пропустить (например, уже обработанных до сбоя)
+        :param done:    Функция, которая вызывается, когда получатели задания исчерпаны, с именем файла задания и
+                        количеством получателей всех заданий, выданных до этого момента
+        :param active:  Максимальное количество массовых заданий в работе
+        :param fail:    Функция, которая вызывается при ошибке задания с именем файла задания и описанием ошибки
+        :return: Четверки (имя файла задания, задание, адрес получателя, {subject, replaces, txt_body, html_body,
+                 history})
+        """
+
+        # Очередь заданий в работе по виртуальному времени (взвешенное справедливое чередование): задание с весом w
+        # после выдачи получателя сдвигается на 1/w, следующим выдается задание с наименьшим временем
+        turns = list()
+        clock = 0.0
+        position = 0
+        try:
+            while True:
+                # Берем в работу задания из очереди
+                queue = self.__queue.get(service)
+                while queue and (len(self.__active) < active or self.__tasks[queue[0][2]]['class'] == 'transactional'):
+                    picked = self.__pop(service)
+                    if picked is None:
+                        break
+                    task_file, task = picked
+                    try:
+                        self.__start(task_file, task, skip)
+                    except Exception as error:
+                        self.__fail(task_file, error, fail)
+                        continue
+                    stride = 1 / (self.CLASSES[task['class']] * (1 + max(0, task['priority'])))
+                    self.__active[task_file] = {'task': task, 'recipients': iter(task['to']), 'stride': stride}
+                    heapq.heappush(turns, (clock + stride, next(self.__sequence), task_file))
+                if not turns:
+                    return
+
+                # Выдаем получателя задания, чья очередь наступила (снятое с выполнения задание пропускается)
+                clock, _, task_file = heapq.heappop(turns)
+                state = self.__active.get(task_file)
+                if state is None:
+                    continue
+                try:
+                    rcpt, content = next(state['recipients'])
+                except StopIteration:
+                    del self.__active[task_file]
+                    if done is not None:
+                        done(task_file, position)
+                    continue
+                except Exception as error:
+                    del self.__active[task_file]
+                    self.__fail(task_file, error, fail)
+                    continue
+                heapq.heappush(turns, (clock + state['stride'], next(self.__sequence), task_file))
+                position += 1
+                yield task_file, state['task'], rcpt, content
+        finally:
+            # Прерванные задания остаются в рабочем каталоге и будут разобраны повторно
+            self.__active.clear()
+
+    def cancel(self, task_file: str):
+        """
+        Снятие задания с выполнения
+
+        Задание в работе (например, после ошибки сборки его сообщения) убирается из перебора, его оставшиеся
+        получатели не выдаются, а вторичная рассылка не планируется
+        :param task_file: Имя файла задания
+        :return: None
+        """
+
+        self.__active.pop(task_file, None)
+        self.__repeats.pop(task_file, None)
 
     def count(self):
         """
         Количество заданий
 
-        Возвращает количество заданий в списке
+        Возвращает количество заданий в очереди и в работе
         :return: Количество заданий
         """
 
-        return len(self.__tasks)
+        return len(self.__tasks) + len(self.__active)
 
-    def __from_template(self, template_file: str, replaces: dict):
+    def template_stats(self):
         """
-        Считывание шаблона и подготовка текста
+        Счетчики хранилища шаблонов
 
-        Открывает файл-шаблон, считывает из него информацию и заменяет в ней значения согласно словарю замен
-        :param template_file: Исходный файл шаблона
-        :param replaces: Словарь замен
-        :return: Обработанный текст
+        Возвращает количество обращений к шаблонам, обслуженных из памяти, и количество загрузок с диска
+        :return: Словарь {hits: попадания, misses: промахи, templates: количество шаблонов в памяти}
         """
 
-        # Открываем файл шаблона
-        with open(self.__templates_directory + template_file, "r", encoding="utf-8") as template:
-            content = template.read()
+        return self.__templates.stats()
+
+    def __pop(self, service: str):
+        """
+        Извлечение первого задания из очереди
+
+        :param service: Имя сервиса
+        :return: Пара (имя файла задания, задание) первого по классу и приоритету задания сервиса или None
+        """
+
+        queue = self.__queue.get(service)
+        if not queue:
+            return None
+        task_file = heapq.heappop(queue)[2]
+        return task_file, self.__tasks.pop(task_file)
+
+    def __start(self, task_file: str, task: dict, skip):
+        """
+        Подготовка задания к выполнению
+
+        Для почтовой рассылки проверяет наличие изображений и вложений и заменяет поле получателей генератором
+        обработки шаблонов
+        :param task_file:   Имя файла задания
+        :param task:        Задание
+        :param skip:        Функция, возвращающая по имени файла задания множество адресов получателей, которых
+                            следует пропустить
+        :return: None
+        """
+
+        # Если контекст задания почтовая рассылка
+        if task['service'] == "mailer":
+            for file_name in list((task.get('images') or dict()).values()) + \
+                             list((task.get('attachments') or dict()).values()):
+                if not os.path.isfile(self.__files_directory + file_name):
+                    raise FileNotFoundError(f"file {file_name!r} not found")
+            # Получатели обрабатываются по мере перебора
+            skipped = skip(task_file) if skip is not None else set()
+            if skipped:
+                logging.info(f"Task {task_file}: {len(skipped)} recipients already processed, skipped")
+            task['to'] = self.__render(task_file, task, task['to'], skipped)
+
+    def __fail(self, task_file: str, error: Exception, fail):
+        """
+        Завершение задания с ошибкой
+
+        :param task_file:   Имя файла задания
+        :param error:       Исключение
+        :param fail:        Функция, которая вызывается с именем файла задания и описанием ошибки
+        :return: None
+        """
+
+        logging.error(f"Task {task_file} failed and was skipped: {error}", exc_info=True)
+        if fail is not None:
+            fail(task_file, f"{type(error).__name__}: {error}")
+
+    def __render(self, task_file: str, task: dict, recipients, skip: set):
+        """
+        Обработка получателей почтовой рассылки
+
+        Генератор: по запросу получает персональный словарь замен и обрабатывает тему и шаблоны (текстовой и html)
+        для очередного получателя. В памяти находится только текст текущего получателя
+        :param task_file:   Имя файла задания
+        :param task:        Задание
+        :param recipients:  Получатели в виде пар (адрес, словарь замен из списка получателей)
+        :param skip:        Адреса получателей, которых следует пропустить
+        :return: Пары (адрес получателя, {subject, replaces, txt_body, html_body, history})
+        """
+
+        # Получаем скомпилированные шаблоны задания (текстовой и html) и тему письма
+        txt_template = self.__templates.get(task['template'] + '.txt')
+        html_template = self.__templates.get(task['template'] + '.html')
+        subject = Template(task['subject'])
+        missing = set()
+
+        for rcpt, row in recipients:
+            if rcpt in skip:
+                continue
+            # Загружаем персональный словарь замен (дополненный заменами из списка получателей)
+            person, project = self.__person(task, rcpt, row)
+            if person is None:
+                logging.error(f"Task {task_file}: recipient {rcpt} not found in persons database, skipped")
+                continue
+            replaces = task['replaces'] | person
+            # Собираем ключевые слова, для которых нет значений
+            missing.update(txt_template.missing(replaces), html_template.missing(replaces), subject.missing(person))
+            # Производим обработку темы и текста шаблонов
+            yield rcpt, {'subject': subject.render(person), 'replaces': person,
+                         'txt_body': txt_template.render(replaces), 'html_body': html_template.render(replaces),
+                         'history': (rcpt, task['template'], project)}
+
+        if missing:
+            logging.warning(f"Task {task_file}: no replaces for placeholders {sorted(missing)}")
+
+    def __filter(self, task_file: str, task: dict, recipients):
+        """
+        Отбор получателей по истории отправки (генератор)
+
+        Пропускает адреса из списка подавления и получателей, которым шаблон задания по тому же проекту уже
+        отправлялся в пределах интервала истории или принят в работу в другом задании текущего цикла
+        :param task_file:   Имя файла задания
+        :param task:        Задание
+        :param recipients:  Получатели в виде пар (адрес, словарь замен из списка получателей)
+        :return: Пары (адрес, словарь замен из списка получателей)
+        """
+
+        duplicates = suppressed = 0
+        for rcpt, row in recipients:
+            if self.__history.suppressed(rcpt) is not None:
+                suppressed += 1
+                continue
+            _, project = self.__person(task, rcpt, row)
+            key = self.__history.key(rcpt, task['template'], project)
+            if key in self.__planned or self.__history.duplicate(rcpt, task['template'], project):
+                duplicates += 1
+                continue
+            self.__planned.add(key)
+            yield rcpt, row
+
+        if duplicates or suppressed:
+            logging.info(f"Task {task_file}: {duplicates} recipients already received {task['template']!r}, "
+                         f"{suppressed} suppressed, skipped")
+
+    def __person(self, task: dict, rcpt: str, row: dict):
+        """
+        Персональный словарь замен и проект получателя
+
+        :param task:    Задание
+        :param rcpt:    Адрес получателя
+        :param row:     Словарь замен из списка получателей
+        :return: Кортеж (словарь замен или None, если персона не найдена, проект)
+        """
 
-        # Производим его обработку, заменяя значения из списка замены
-        content = transform(content, replaces)
-        # Возвращаем обработанный текст
-        return content
+        person = self.__persons.get(rcpt)
+        if row:
+            person = (person or dict()) | row
+        project = (person or dict()).get('Проект') or task['replaces'].get('Проект', '')
+        return person, project
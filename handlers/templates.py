@@ -0,0 +1,162 @@
+# Imports
+import os
+import re
+import threading
+
+# Defines
+class Template:
+    """
+    Класс скомпилированного шаблона
+
+    Объект класса разбирает текст шаблона один раз на последовательность литеральных фрагментов и мест подстановки
+    ключевых слов вида [ключ]. Обработка текста сводится к подстановке значений в места и одному объединению строк.
+    Ключевые слова, для которых нет значения в словаре замен, остаются в тексте без изменений
+
+    Методы
+    ----------------
+        __init__(self, text: str)
+            Конструктор: Инициализация (компиляция)
+        placeholders(self)
+            Ключевые слова шаблона
+        missing(self, keys)
+            Ключевые слова без значений
+        render(self, replaces: dict)
+            Обработка текста
+    Атрибуты
+    ----------------
+        :cvar {any} PATTERN:        Регулярное выражение ключевого слова
+        :ivar {list} __parts:       Фрагменты текста (места подстановки хранят исходное ключевое слово)
+        :ivar {list} __slots:       Места подстановки в виде пар (индекс фрагмента, ключ)
+    """
+
+    PATTERN = re.compile(r'\[([^\[\]\r\n]+)]')
+
+    def __init__(self, text: str):
+        """
+        Конструктор: Инициализация (компиляция)
+
+        Разбирает текст шаблона на литеральные фрагменты и места подстановки
+        :param text: Текст шаблона
+        """
+
+        self.__parts = list()
+        self.__slots = list()
+        position = 0
+        for match in self.PATTERN.finditer(text):
+            if match.start() > position:
+                self.__parts.append(text[position:match.start()])
+            self.__slots.append((len(self.__parts), match.group(1)))
+            self.__parts.append(match.group(0))
+            position = match.end()
+        if position < len(text):
+            self.__parts.append(text[position:])
+
+    def placeholders(self):
+        """
+        Ключевые слова шаблона
+
+        :return: Множество ключевых слов, найденных в шаблоне
+        """
+
+        return {key for _, key in self.__slots}
+
+    def missing(self, keys):
+        """
+        Ключевые слова без значений
+
+        Сравнивает ключевые слова шаблона с набором ключей словаря замен
+        :param keys: Ключи словаря замен
+        :return: Отсортированный список ключевых слов шаблона, для которых нет значения
+        """
+
+        return sorted(self.placeholders().difference(keys))
+
+    def render(self, replaces: dict):
+        """
+        Обработка текста
+
+        Подставляет значения из словаря замен в места подстановки за один проход
+        :param replaces: Словарь замен
+        :return: Обработанный текст
+        """
+
+        parts = self.__parts.copy()
+        for index, key in self.__slots:
+            value = replaces.get(key)
+            if value is not None:
+                parts[index] = value
+        return ''.join(parts)
+
+class TemplateStore:
+    """
+    Класс хранилища шаблонов
+
+    Объект класса загружает и компилирует файлы шаблонов при первом обращении и отдает скомпилированные шаблоны
+    из памяти при последующих. Шаблон перечитывается, если время модификации файла изменилось. Ведет счетчики
+    попаданий и промахов
+
+    Методы
+    ----------------
+        __init__(self, templates_directory: str)
+            Конструктор: Инициализация
+        get(self, template_file: str)
+            Получение шаблона
+        stats(self)
+            Счетчики хранилища
+    Атрибуты
+    ----------------
+        :ivar {str} __templates_directory:  Директория шаблонов
+        :ivar {dict} __templates:           Шаблоны {имя файла: (mtime, шаблон)}
+        :ivar {int} __hits:                 Количество обращений, обслуженных из памяти
+        :ivar {int} __misses:               Количество загрузок шаблонов с диска
+        :ivar {any} __lock:                 Блокировка доступа к хранилищу
+    """
+
+    def __init__(self, templates_directory: str):
+        """
+        Конструктор: Инициализация
+
+        :param templates_directory: Директория шаблонов
+        """
+
+        self.__templates_directory = templates_directory
+        self.__templates = dict()
+        self.__hits = 0
+        self.__misses = 0
+        self.__lock = threading.Lock()
+
+    def get(self, template_file: str):
+        """
+        Получение шаблона
+
+        Возвращает скомпилированный шаблон, при необходимости загружая его с диска
+        :param template_file: Имя файла шаблона
+        :return: Скомпилированный шаблон
+        """
+
+        path = self.__templates_directory + template_file
+        mtime = os.stat(path).st_mtime_ns
+        with self.__lock:
+            entry = self.__templates.get(template_file)
+            if entry is not None and entry[0] == mtime:
+                self.__hits += 1
+                return entry[1]
+            self.__misses += 1
+
+        # Открываем файл шаблона и компилируем его
+        with open(path, "r", encoding="utf-8") as file:
+            template = Template(file.read())
+
+        with self.__lock:
+            self.__templates[template_file] = (mtime, template)
+        return template
+
+    def stats(self):
+        """
+        Счетчики хранилища
+
+        :return: Словарь {hits: попадания, misses: промахи, templates: количество шаблонов в памяти}
+        """
+
+        with self.__lock:
+            return {'hits': self.__hits, 'misses': self.__misses, 'templates': len(self.__templates)}
@@ -1,15 +1,188 @@
 # Import
-import datetime
 import os
 from handlers.json import JSONHandler
 from handlers.args import ArgsHandler
 from handlers.tasks import TaskManager
-from services.mailer import make, Mailer
+from handlers.persons import PersonsStore
+from handlers.scheduler import Scheduler
+from handlers.history import SendHistory
+from services.mailer import Mailer
+from services.relays import RelayPool
+from services.delivery import DeliveryEngine
+from services.domains import DomainQueue
+from services.spool import Spool
+from services.assets import AssetCache
+from services.bodies import BodyCache
+from services.render import RenderPool
+from services.watcher import TaskWatcher
+from services.submit import SubmitServer
+from services.journal import Journal
+from services.metrics import metrics
+from services.logs import LogWriter, DeliveryLog
+from services.retry import RetryQueue
+import contextlib
 import logging
+import signal
+import threading
+import time
 
 # Defines
 DEBUG = False    # Директива препроцессора (аналог)
 
+# Признак остановки по сигналу
+stopping = threading.Event()
+
+def stop(signum, frame):
+    """
+    Обработчик сигнала остановки
+
+    Запрещает брать в работу новые сообщения. Сообщения, уже поставленные в очередь, будут отправлены
+    :param signum:  Номер сигнала
+    :param frame:   Текущий кадр стека
+    :return: None
+    """
+
+    logging.info(f"Signal {signum} received, finishing in-flight messages")
+    stopping.set()
+
+def finish(task_file: str):
+    """
+    Завершение задания
+
+    Переносит задание в отработанные, планирует его вторичную рассылку и удаляет его журнал
+    :param task_file: Имя файла задания
+    :return: None
+    """
+
+    task_manager.repeat(task_file)
+    if task_file.endswith('.json'):
+        os.rename(args.get("tasks_dir") + task_file, args.get("tasks_dir") + "complete/" + task_file)
+    elif submissions is not None:
+        # Задание интерфейса постановки: сохраняем итоги для запросов состояния
+        journal.flush()
+        submissions.complete(task_file, journal.status(task_file))
+    journal.finish(task_file)
+
+def reject(task_file: str, error: str):
+    """
+    Отклонение задания
+
+    Переносит задание, которое не удалось выполнить, в каталог ошибок заданий (задание интерфейса постановки
+    отмечается в журнале как отклоненное)
+    :param task_file:   Имя файла задания
+    :param error:       Описание ошибки
+    :return: None
+    """
+
+    task_manager.cancel(task_file)
+    if task_file.endswith('.json'):
+        try:
+            os.rename(args.get("tasks_dir") + task_file, args.get("tasks_dir") + "bad/" + task_file)
+        except OSError:
+            logging.error(f"Task {task_file} could not be moved to bad/", exc_info=True)
+    else:
+        journal.reject(task_file, error)
+        if submissions is not None:
+            submissions.fail(task_file, error)
+
+def accept():
+    """
+    Прием заданий интерфейса постановки
+
+    Передает обработчику заданий задания, поставленные через интерфейс постановки после предыдущего вызова
+    :return: None
+    """
+
+    if submissions is not None:
+        for task_id, task in submissions.take():
+            try:
+                task_manager.add(task_id, task)
+            except Exception as error:
+                logging.error(f"Submitted task {task_id} could not be added", exc_info=True)
+                reject(task_id, f"{type(error).__name__}: {error}")
+
+def execute():
+    """
+    Цикл обработки заданий
+
+    Повторно отправляет сообщения, время повтора которых наступило, переносит в рабочий каталог наступившие
+    отложенные задания, разбирает задания рабочего каталога и выполняет их. Задания выполняются одновременно,
+    срочные (транзакционные и с большим приоритетом) получают большую долю отправки, каждое задание завершается, как
+    только отправлены его сообщения.
+    Задание, прерванное сигналом остановки или сбоем, остается в рабочем каталоге, а при повторном выполнении
+    получатели, обработанные по журналу доставки, пропускаются
+    :return: None
+    """
+
+    if stopping.is_set():
+        return
+    # Повторно отправляем сообщения с временной ошибкой
+    if retry is not None:
+        for message in retry.due(read=spool.read):
+            delivery.submit(message, dict(), None, message['history'])
+        delivery.drain()
+    # Переносим в рабочий каталог отложенные задания, время которых наступило (в том числе пропущенные)
+    for suspend_file in scheduler.due():
+        try:
+            os.rename(args.get("tasks_dir") + f'suspend/{suspend_file}', args.get("tasks_dir") + suspend_file)
+        except FileNotFoundError:
+            logging.error(f"Suspended task {suspend_file} not found", exc_info=True)
+        scheduler.remove(suspend_file)
+    # Создаем генератор списка для файлов заданий
+    tasks_files = [f for f in os.listdir(args.get("tasks_dir")) if f.endswith('.json')]
+    # Отрабатываем задания
+    task_manager.parse(tasks_files, fail=reject)
+    accept()
+
+    # Выполняем задания: получатели заданий чередуются по классу и приоритету заданий, а задания, появившиеся в
+    # рабочем каталоге во время рассылки, берутся в работу без ее остановки
+    finishing = dict()
+    submitted = 0
+    scanned = time.monotonic()
+    recipients = task_manager.stream("mailer", journal.completed, finishing.__setitem__, fail=reject)
+
+    def failed(task_file: str, error: str):
+        """
+        Отклонение задания с ошибкой сборки сообщения
+
+        Получатели задания могли быть уже перебраны, поэтому задание больше не ожидает завершения
+        :param task_file:   Имя файла задания
+        :param error:       Описание ошибки
+        :return: None
+        """
+
+        finishing.pop(task_file, None)
+        reject(task_file, error)
+
+    # Собираем сообщения по мере перебора получателей и ставим их в очередь на отправку (сообщения задания с
+    # ошибкой сборки не ставятся, но учитываются в количестве перебранных получателей)
+    for task_file, message, content in renderer.mix(recipients, failed):
+        if message is not None:
+            delivery.submit(message, content['replaces'], task_file, content.get('history'))
+        submitted += 1
+        if stopping.is_set():
+            break
+        accept()
+        # Завершаем задания, все получатели которых перебраны, а сообщения отправлены
+        for task_file in [task_file for task_file, position in finishing.items()
+                          if position <= submitted and not delivery.pending(task_file)]:
+            finish(task_file)
+            del finishing[task_file]
+        # Разбираем задания, появившиеся в рабочем каталоге
+        if time.monotonic() - scanned >= args.get("poll_interval"):
+            scanned = time.monotonic()
+            task_manager.parse([f for f in os.listdir(args.get("tasks_dir"))
+                                if f.endswith('.json') and f not in finishing], fail=reject)
+    recipients.close()
+    # Дожидаемся отправки всех сообщений и завершаем оставшиеся задания
+    delivery.drain()
+    if not stopping.is_set():
+        for task_file in finishing:
+            finish(task_file)
+    # Обновляем файл метрик
+    if args.get("metrics_file"):
+        metrics.write(args.get("metrics_file"))
+
 # Code
 # Получаем аргументы командной строки
 args = ArgsHandler("mailer", "Mailer Queue(cl)LQ@2025 Free to use")
@@ -31,66 +204,146 @@ else:
   "templates-dir": {"flag": "-t", "help": "templates directory", "default": "templates/"},
   "tasks-dir": {"flag": "-w", "help": "tasks directory", "default": "tasks/"},
   "mail-dir": {"flag": "-m", "help": "mail directory", "default": "mail/"},
-  "logs-dir": {"flag": "-l", "help": "logs directory", "default": "logs/"}
+  "logs-dir": {"flag": "-l", "help": "logs directory", "default": "logs/"},
+  "pool-size": {"flag": "-n", "help": "SMTP connection pool size", "default": 1, "type": "int"},
+  "session-limit": {"flag": "-x", "help": "maximum messages per SMTP session", "default": 100, "type": "int"},
+  "concurrency": {"flag": "-j", "help": "number of parallel delivery workers", "default": 1, "type": "int"},
+  "no-spool": {"flag": "-S", "help": "do not keep message copies in the mail directory (disables delivery retries)", "default": False, "action": "store_true"},
+  "assets-cache": {"flag": "-C", "help": "encoded images and attachments cache size, MB", "default": 64, "type": "int"},
+  "persons": {"flag": "-d", "help": "persons database (JSON or SQLite .db)", "default": "db/persons.json"},
+  "render-workers": {"flag": "-r", "help": "number of message build processes (0 - build in main process)", "default": 0, "type": "int"},
+  "daemon": {"flag": "-D", "help": "keep running and watch the tasks directory", "default": False, "action": "store_true"},
+  "poll-interval": {"flag": "-i", "help": "tasks directory check interval in daemon mode, s", "default": 5, "type": "int"},
+  "retry-attempts": {"flag": "-R", "help": "maximum delivery retries after a temporary SMTP error", "default": 5, "type": "int"},
+  "retry-delay": {"flag": "-b", "help": "delay before the first delivery retry (doubled for each next one), s", "default": 60, "type": "int"},
+  "rate": {"flag": "-q", "help": "maximum sending rate, messages/s (0 - unlimited)", "default": 0, "type": "float"},
+  "hourly-limit": {"flag": "-H", "help": "maximum messages per hour (0 - unlimited)", "default": 0, "type": "int"},
+  "relays": {"flag": "-y", "help": "SMTP relay pool config (JSON list of servers), replaces the single server options", "default": ""},
+  "domain-concurrency": {"flag": "-g", "help": "maximum parallel deliveries to one recipient domain (0 - unlimited)", "default": 0, "type": "int"},
+  "domain-delay": {"flag": "-e", "help": "pause between deliveries to one recipient domain, s", "default": 0, "type": "float"},
+  "domain-limits": {"flag": "-k", "help": "per-domain limits config (JSON {domain: {concurrency, delay}})", "default": ""},
+  "metrics": {"flag": "-M", "help": "collect per-stage timings and counters, log a summary at the end", "default": False, "action": "store_true"},
+  "metrics-file": {"flag": "-o", "help": "write metrics in Prometheus text format to the file (implies --metrics)", "default": ""},
+  "metrics-port": {"flag": "-u", "help": "serve metrics over HTTP on localhost port (implies --metrics, 0 - off)", "default": 0, "type": "int"},
+  "delivery-log": {"flag": "-f", "help": "per-message delivery log (JSONL) file name in the logs directory, empty - text lines in mail.log", "default": "delivery.jsonl"},
+  "history": {"flag": "-z", "help": "send history and suppression list (SQLite), empty - no history", "default": "db/history.db"},
+  "dedup-window": {"flag": "-W", "help": "do not resend a template to a recipient within the window, h (0 - only suppression list)", "default": 24, "type": "float"},
+  "api-port": {"flag": "-A", "help": "accept tasks over HTTP on localhost port (POST /tasks, GET /tasks/<id>), 0 - off", "default": 0, "type": "int"},
+  "spool-segments": {"flag": "-E", "help": "append message copies to segment files with an index instead of one file per message", "default": False, "action": "store_true"},
+  "body-cache": {"flag": "-B", "help": "cache of identical rendered message bodies, MB (0 - build every message)", "default": 32, "type": "int"}
 })
 
 # Создаем директории (если еще не созданы)
 os.makedirs(args.get("templates_dir") + "files/images/", exist_ok = True)
 os.makedirs(args.get("tasks_dir") + "complete/", exist_ok = True)
 os.makedirs(args.get("tasks_dir") + "suspend/", exist_ok = True)
+os.makedirs(args.get("tasks_dir") + "bad/", exist_ok = True)
 os.makedirs(args.get("mail_dir") + "out/", exist_ok = True)
 os.makedirs(args.get("mail_dir") + "send", exist_ok = True)
 os.makedirs(args.get("mail_dir") + "bad/", exist_ok = True)
+os.makedirs(args.get("mail_dir") + "journal/", exist_ok = True)
 os.makedirs(args.get("logs_dir"), exist_ok = True)
 
 # Настраиваем логгер
 logging.basicConfig(level=logging.INFO, filename=args.get("logs_dir") + 'mail.log', filemode="a",
                     format="%(asctime)s %(levelname)s %(message)s")
+# Включаем сбор метрик (выключенный сбор ничего не стоит)
+if args.get("metrics") or args.get("metrics_file") or args.get("metrics_port"):
+    metrics.enable()
+# Создаем планировщик отложенных заданий
+scheduler = Scheduler(args.get("tasks_dir") + "suspend/")
+# Открываем историю отправки (повторные отправки и список подавления)
+history = SendHistory(args.get("history"), args.get("dedup_window") * 3600) if args.get("history") else None
 # Создаем объект для обработки заданий
-task_manager = TaskManager(args.get("tasks_dir"), args.get("templates_dir"), JSONHandler(args.get("logs_dir")))
-# Создаем объект для отправки почты
-mailer = Mailer(args.get("address"), args.get("port"), args.get("login"), args.get("password"), args.get("logs_dir"),
-                args.get("cypher"), args.get("ssl"))
-
-# Создаем генератор списка для файлов отложенных заданий
-suspend_task_files = [f for f in os.listdir(args.get("tasks_dir") + 'suspend/')
-                      if f.endswith('.json') and f[0:8] == datetime.datetime.now().strftime('%d%m%Y')]
-# Переносим файлы отложенных заданий в рабочий каталог
-for suspend_file in suspend_task_files:
-    os.rename(args.get("tasks_dir") + f'suspend/{suspend_file}', args.get("tasks_dir") + suspend_file)
-# Создаем генератор списка для файлов заданий
-tasks_files = [f for f in os.listdir(args.get("tasks_dir")) if f.endswith('.json')]
-# Отрабатываем задания
-task_manager.parse(tasks_files)
-
-# Выполняем задания
-for i in range(0, task_manager.count()):
-    # Выбираем для исполнения только задания на почтовую рассылку
-    task_file, task = task_manager.get("mailer")
-    # Проходимся по отправителям
-    for rcpt, content in task['to'].items():
-        # Создаем сообщение
-        message_filename =  make(task['from'], rcpt, content['subject'], content['txt_body'], content['html_body'],
-                                 args.get('templates_dir') + "files/", args.get("mail_dir") + "out/",
-                                 task['images'] if 'images' in task else None,
-                                 task['attachments'] if 'attachment' in task else None)
-        # Отправляем
-        result = mailer.send(args.get("mail_dir") + "out/" + message_filename)
-        if result:
-            # Переносим файл почтового сообщения в отправленные
-            os.rename(args.get("mail_dir") + "out/" + message_filename,
-                      args.get("mail_dir") + "send/" + message_filename)
-            # Вносим запись в логгер об успешной отправке письма
-            logging.info(f'Message was sent from {task['from']} '
-                         f'to {content['replaces']['Название компании']}<{rcpt}>, '
-                         f'project {content['replaces']['Проект']}, message file {message_filename}')
-        else:
-            # Переносим файл почтового сообщения в ошибки
-            os.rename(args.get("mail_dir") + "out/" + message_filename,
-                      args.get("mail_dir") + "bad/" + message_filename)
-            # Вносим запись в логгер об ошибке
-            logging.error(f'Message from {task['from']} '
-                          f'to {content['replaces']['Название компании']}<{rcpt}> was not sent, '
-                          f'project {content['replaces']['Проект']}, message file {message_filename}')
-    # Переносим задание в отработанные
-    os.rename(args.get("tasks_dir") + task_file, args.get("tasks_dir") + "complete/" + task_file)
\ No newline at end of file
+task_manager = TaskManager(args.get("tasks_dir"), args.get("templates_dir"), JSONHandler(args.get("logs_dir")),
+                           PersonsStore(args.get("persons")), scheduler, history)
+# Создаем объект для отправки почты (через один сервер или пул серверов)
+if args.get("relays"):
+    mailer = RelayPool.load(args.get("relays"), args.get("logs_dir"),
+                            max(args.get("pool_size"), args.get("concurrency")), args.get("session_limit"))
+else:
+    mailer = Mailer(args.get("address"), args.get("port"), args.get("login"), args.get("password"),
+                    args.get("logs_dir"), args.get("cypher"), args.get("ssl"),
+                    max(args.get("pool_size"), args.get("concurrency")), args.get("session_limit"),
+                    rate=args.get("rate"), hourly_limit=args.get("hourly_limit"))
+# Создаем очередь повторной отправки (сообщения для повтора берутся из спула)
+retry = RetryQueue(args.get("mail_dir"), args.get("retry_attempts"), args.get("retry_delay")) \
+    if not args.get("no_spool") else None
+if retry is None:
+    logging.warning("Delivery retries are disabled by --no-spool: messages with temporary errors will not be resent")
+# Счетчики хранилища шаблонов получаем в момент выгрузки метрик
+metrics.collector(lambda: {f"templates_{key}": value for key, value in task_manager.template_stats().items()
+                           if key in ('hits', 'misses')})
+# Загружаем ограничения отправки по доменам получателей
+limits = DomainQueue.load(args.get("domain_limits"), args.get("domain_concurrency"), args.get("domain_delay"))
+# Создаем общий кеш закодированных изображений и вложений
+assets = AssetCache(args.get("assets_cache") * 1024 * 1024)
+# Создаем кеш тел сообщений: получатели с одинаковым содержимым получают одно тело
+bodies = BodyCache(args.get("body_cache") * 1024 * 1024) if args.get("body_cache") > 0 else None
+
+# Создаем наблюдатель за каталогом заданий (в режиме демона)
+watcher = TaskWatcher(args.get("tasks_dir"), args.get("poll_interval")) if args.get("daemon") else None
+
+# Останавливаемся по сигналу после отправки сообщений, уже поставленных в очередь
+signal.signal(signal.SIGTERM, stop)
+signal.signal(signal.SIGINT, stop)
+
+# Выполняем задания (по завершении очередь отправки дорабатывается, спул и журналы дописываются, а пул соединений
+# закрывается)
+# Процессы сборки сообщений запускаются до потоков отправки, спула и записи логов
+delivery_log = DeliveryLog(args.get("logs_dir") + args.get("delivery_log")) if args.get("delivery_log") else None
+with (RenderPool(args.get('templates_dir') + "files/", assets, args.get("render_workers"),
+                 bodies=bodies) as renderer,
+      LogWriter(), delivery_log or contextlib.nullcontext(),
+      mailer, Spool(args.get("mail_dir"), not args.get("no_spool"), args.get("spool_segments")) as spool,
+      Journal(args.get("mail_dir") + "journal/") as journal,
+      DeliveryEngine(mailer, spool, journal, args.get("concurrency"), args.get("concurrency") * 4, retry,
+                     limits, delivery_log, history) as delivery,
+      watcher or contextlib.nullcontext(),
+      SubmitServer(journal, args.get("api_port"), wakeup=watcher.notify if watcher is not None else None,
+                   templates_directory=args.get("templates_dir"))
+      if args.get("api_port") else contextlib.nullcontext() as submissions):
+    # Сервер метрик - это поток, поэтому он запускается после процессов сборки сообщений
+    if args.get("metrics_port"):
+        metrics.serve(args.get("metrics_port"))
+    # Восстанавливаем незавершенные задания интерфейса постановки (задание, которое не удается разобрать,
+    # отмечается в журнале как отклоненное и больше не восстанавливается)
+    for task_id, task in journal.submitted().items():
+        error = SubmitServer.validate(task, args.get("templates_dir"))
+        if error is None:
+            try:
+                task_manager.add(task_id, task)
+            except Exception as exc:
+                error = f"{type(exc).__name__}: {exc}"
+        if error is not None:
+            logging.error(f"Submitted task {task_id} could not be restored, rejected: {error}")
+            journal.reject(task_id, error)
+            if submissions is not None:
+                submissions.fail(task_id, error)
+        elif submissions is not None:
+            submissions.restore(task_id)
+    execute()
+    # В режиме демона ожидаем новые задания до получения сигнала остановки
+    if watcher is not None:
+        while not stopping.is_set():
+            watcher.wait(args.get("poll_interval"))
+            execute()
+
+# Вносим в лог скорость отправки, на которой завершилась работа
+if mailer.rate():
+    logging.info(f"Sending rate: {mailer.rate():.2f} messages/s")
+# Закрываем очередь повторной отправки
+if retry is not None:
+    logging.info(f"Retry queue: {retry.count()} messages pending")
+    retry.close()
+# Дописываем и закрываем историю отправки
+if history is not None:
+    history.close()
+# Вносим в лог статистику хранилища шаблонов
+logging.info(f"Template store: {task_manager.template_stats()}")
+# Вносим в лог сводку метрик и выгружаем их в последний раз
+if metrics.enabled:
+    logging.info(f"Metrics summary:\n{metrics.summary()}")
+    if args.get("metrics_file"):
+        metrics.write(args.get("metrics_file"))
+    metrics.close()
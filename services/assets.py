@@ -0,0 +1,127 @@
+# Imports
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from email import base64mime
+from email.message import MIMEPart
+from services.metrics import metrics
+
+
+# Defines
+class AssetCache:
+    """
+    Класс кеша вложений
+
+    Объект класса хранит прочитанные и уже закодированные в base64 файлы изображений и вложений. Ключом служит путь
+    к файлу, запись считается устаревшей при изменении времени модификации файла. Объем кеша ограничен, при
+    переполнении вытесняются давно не использованные записи. Все сообщения получают один и тот же закодированный
+    текст, различаются только заголовки части (Content-ID)
+
+    Методы
+    ----------------
+        __init__(self, capacity: int = 64 * 1024 * 1024)
+            Конструктор: Инициализация
+        part(self, path: str, cid: str = None)
+            Получение части сообщения
+        get(self, path: str)
+            Получение закодированного файла
+        size(self)
+            Объем кеша
+        capacity(self)
+            Максимальный объем кеша
+    Атрибуты
+    ----------------
+        :ivar {int} __capacity:     Максимальный объем кеша в байтах
+        :ivar {int} __size:         Текущий объем кеша в байтах
+        :ivar {any} __entries:      Записи кеша в порядке использования {путь: (mtime, maintype, subtype, текст)}
+        :ivar {any} __lock:         Блокировка доступа к записям
+    """
+
+    def __init__(self, capacity: int = 64 * 1024 * 1024):
+        """
+        Конструктор: Инициализация
+
+        :param capacity: Максимальный объем кеша в байтах (0 - кеширование выключено)
+        """
+
+        self.__capacity = capacity
+        self.__size = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def part(self, path: str, cid: str = None):
+        """
+        Получение части сообщения
+
+        Формирует встраиваемую часть сообщения с закодированным содержимым файла
+        :param path:    Путь к файлу
+        :param cid:     Идентификатор содержимого (Content-ID) в угловых скобках
+        :return: Часть сообщения
+        """
+
+        maintype, subtype, encoded = self.get(path)
+        part = MIMEPart()
+        part['Content-Type'] = f"{maintype}/{subtype}"
+        part['Content-Transfer-Encoding'] = "base64"
+        if cid is not None:
+            part['Content-ID'] = cid
+        part['Content-Disposition'] = "inline"
+        part.set_payload(encoded)
+        return part
+
+    def get(self, path: str):
+        """
+        Получение закодированного файла
+
+        Возвращает тип и закодированное в base64 содержимое файла. Файл читается с диска только при первом обращении
+        или после его изменения
+        :param path:    Путь к файлу
+        :return: Кортеж (maintype, subtype, текст base64)
+        """
+
+        mtime = os.stat(path).st_mtime_ns
+        with self.__lock:
+            entry = self.__entries.get(path)
+            if entry is not None and entry[0] == mtime:
+                self.__entries.move_to_end(path)
+                metrics.inc('assets_hits')
+                return entry[1:]
+        metrics.inc('assets_misses')
+
+        # Определяем тип файла и кодируем его содержимое
+        with open(path, "r+b") as file:
+            encoded = base64mime.body_encode(file.read())
+        # Файл неизвестного типа передается как двоичные данные
+        maintype, subtype = (mimetypes.guess_type(path)[0] or "application/octet-stream").split('/')
+
+        with self.__lock:
+            # Убираем устаревшую запись
+            if path in self.__entries:
+                self.__size -= len(self.__entries.pop(path)[3])
+            if len(encoded) <= self.__capacity:
+                self.__entries[path] = (mtime, maintype, subtype, encoded)
+                self.__size += len(encoded)
+                # Вытесняем давно не использованные записи
+                while self.__size > self.__capacity:
+                    self.__size -= len(self.__entries.popitem(last=False)[1][3])
+
+        return maintype, subtype, encoded
+
+    def size(self):
+        """
+        Объем кеша
+
+        :return: Текущий объем закодированных данных в кеше в байтах
+        """
+
+        return self.__size
+
+    def capacity(self):
+        """
+        Максимальный объем кеша
+
+        :return: Максимальный объем закодированных данных в кеше в байтах
+        """
+
+        return self.__capacity
@@ -0,0 +1,121 @@
+# Imports
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from services.metrics import metrics
+
+
+# Defines
+class BodyCache:
+    """
+    Класс кеша тел сообщений
+
+    Объект класса хранит собранные и сериализованные тела сообщений (все, кроме заголовка To) по хешу содержимого:
+    отправителя, темы, текстов и файлов изображений и вложений (путь и время модификации). Получатели, для которых
+    шаблоны обработаны в одинаковый текст, получают одно и то же тело, которое собирается один раз. Объем кеша
+    ограничен, при переполнении вытесняются давно не использованные записи
+
+    Методы
+    ----------------
+        __init__(self, capacity: int = 32 * 1024 * 1024)
+            Конструктор: Инициализация
+        key(from_sender: str, subject: str, plain: str, html: str, files_directory: str, images: dict = None,
+            attachments: dict = None)
+            Хеш содержимого
+        get(self, digest: str)
+            Получение тела
+        put(self, digest: str, body: bytes)
+            Добавление тела
+        capacity(self)
+            Максимальный объем кеша
+    Атрибуты
+    ----------------
+        :ivar {int} __capacity:     Максимальный объем кеша в байтах
+        :ivar {int} __size:         Текущий объем кеша в байтах
+        :ivar {any} __entries:      Записи кеша в порядке использования {хеш: тело}
+        :ivar {any} __lock:         Блокировка доступа к записям
+    """
+
+    def __init__(self, capacity: int = 32 * 1024 * 1024):
+        """
+        Конструктор: Инициализация
+
+        :param capacity: Максимальный объем кеша в байтах
+        """
+
+        self.__capacity = capacity
+        self.__size = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(from_sender: str, subject: str, plain: str, html: str, files_directory: str, images: dict = None,
+            attachments: dict = None):
+        """
+        Хеш содержимого
+
+        :param from_sender:     Адрес отправителя
+        :param subject:         Тема письма
+        :param plain:           Текст без разметки
+        :param html:            Текст в разметке html
+        :param files_directory: Директория c прикрепляемыми файлами
+        :param images:          Словарь изображений
+        :param attachments:     Словарь вложений
+        :return: Хеш в шестнадцатеричном виде
+        """
+
+        digest = hashlib.blake2b(digest_size=16)
+        for text in (from_sender, subject, plain, html):
+            digest.update(text.encode(errors='surrogatepass'))
+            digest.update(b"\0")
+        # Изменение файла изображения или вложения меняет хеш
+        for kind, files in ((b"i", images), (b"a", attachments)):
+            for name, file_name in (files or dict()).items():
+                digest.update(kind + f"{name}\0{file_name}\0".encode())
+                digest.update(str(os.stat(files_directory + file_name).st_mtime_ns).encode() + b"\0")
+        return digest.hexdigest()
+
+    def get(self, digest: str):
+        """
+        Получение тела
+
+        :param digest: Хеш содержимого
+        :return: Байты тела или None, если тела нет в кеше
+        """
+
+        with self.__lock:
+            body = self.__entries.get(digest)
+            if body is not None:
+                self.__entries.move_to_end(digest)
+        metrics.inc('bodies_hits' if body is not None else 'bodies_misses')
+        return body
+
+    def put(self, digest: str, body: bytes):
+        """
+        Добавление тела
+
+        :param digest:  Хеш содержимого
+        :param body:    Байты тела
+        :return: None
+        """
+
+        if len(body) > self.__capacity:
+            return
+        with self.__lock:
+            if digest in self.__entries:
+                return
+            self.__entries[digest] = body
+            self.__size += len(body)
+            # Вытесняем давно не использованные записи
+            while self.__size > self.__capacity:
+                self.__size -= len(self.__entries.popitem(last=False)[1])
+
+    def capacity(self):
+        """
+        Максимальный объем кеша
+
+        :return: Максимальный объем кеша в байтах
+        """
+
+        return self.__capacity
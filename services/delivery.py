@@ -0,0 +1,294 @@
+# Imports
+import logging
+import threading
+import time
+from services.domains import DomainQueue
+from services.metrics import metrics
+
+
+# Defines
+class DeliveryEngine:
+    """
+    Класс конкурентной отправки почтовых сообщений
+
+    Объект класса принимает собранные почтовые сообщения в очередь и отправляет их пулом рабочих потоков
+    через общий объект отправки почты. Каждое сообщение извлекается из очереди ровно один раз и, независимо от
+    результата, его копия в спуле переносится в каталог отправленных или в каталог ошибок. Состояние каждого
+    получателя вносится в журнал доставки. Сообщения с временной ошибкой передаются в очередь повторной отправки,
+    повторно отправляемые сообщения поступают из каталога ошибок. Очередь разбита по доменам получателей: домены
+    обслуживаются по кругу с учетом ограничений на количество одновременных отправок и паузу между ними. Успешная
+    отправка вносится в историю отправки, адрес с постоянным отказом почтового ящика - в список подавления
+
+    Методы
+    ----------------
+        __init__(self, mailer, spool, journal, concurrency: int = 1, queue_size: int = 0, retry=None,
+                 limits: dict = None, log=None, history=None)
+            Конструктор: Инициализация
+        __enter__(self)
+            Вход в контекстный менеджер (запуск рабочих потоков)
+        __exit__(self, exc_type, exc_val, exc_tb)
+            Выход из контекстного менеджера (остановка рабочих потоков)
+        start(self)
+            Запуск рабочих потоков
+        submit(self, message: dict, replaces: dict, task_file: str, history: tuple = None)
+            Постановка сообщения в очередь
+        drain(self)
+            Ожидание отправки всех сообщений в очереди
+        pending(self, task_file: str)
+            Количество неотправленных сообщений задания
+        stop(self)
+            Остановка рабочих потоков
+        __work(self)
+            Цикл рабочего потока
+        __deliver(self, job: dict)
+            Отправка одного сообщения
+        __fail(self, job: dict, result, latency: float)
+            Обработка ошибки отправки
+        __record(self, job: dict, result, latency: float, state: str)
+            Запись в журнал отправки
+    Атрибуты
+    ----------------
+        :cvar {set} BOUNCE:             Коды постоянного отказа, при которых адрес вносится в список подавления
+        :ivar {any} __mailer:           Объект отправки почты
+        :ivar {any} __spool:            Спул почтовых сообщений
+        :ivar {any} __journal:          Журнал доставки
+        :ivar {any} __retry:            Очередь повторной отправки (None - без повторов)
+        :ivar {any} __log:              Журнал отправки JSONL (None - только текстовый лог)
+        :ivar {any} __history:          История отправки (None - без истории)
+        :ivar {int} __concurrency:      Количество рабочих потоков
+        :ivar {any} __queue:            Очередь сообщений на отправку
+        :ivar {list} __workers:         Рабочие потоки
+        :ivar {dict} __pending:         Количество неотправленных сообщений заданий {имя файла задания: количество}
+        :ivar {any} __lock:             Блокировка доступа к счетчикам заданий
+    """
+
+    BOUNCE = {550, 551, 553}
+
+    def __init__(self, mailer, spool, journal, concurrency: int = 1, queue_size: int = 0, retry=None,
+                 limits: dict = None, log=None, history=None):
+        """
+        Конструктор: Инициализация
+
+        Инициализирует объект класса объектом отправки почты и создает очередь сообщений
+        :param mailer:          Объект отправки почты
+        :param spool:           Спул почтовых сообщений
+        :param journal:         Журнал доставки
+        :param concurrency:     Количество рабочих потоков
+        :param queue_size:      Максимальный размер очереди (0 - без ограничения)
+        :param retry:           Очередь повторной отправки
+        :param limits:          Ограничения доменов получателей {домен: {concurrency, delay}} (см. DomainQueue)
+        :param log:             Журнал отправки JSONL (services.logs.DeliveryLog)
+        :param history:         История отправки (handlers.history.SendHistory)
+        """
+
+        self.__mailer = mailer
+        self.__spool = spool
+        self.__journal = journal
+        self.__retry = retry
+        self.__log = log
+        self.__history = history
+        self.__concurrency = max(1, concurrency)
+        # Очередь одного домена не должна занимать всю очередь, иначе она задержит остальные домены; сообщения
+        # домена сверх его доли откладываются, не останавливая постановку сообщений других доменов
+        self.__queue = DomainQueue(limits, queue_size, max(1, queue_size // 4) if queue_size else 0,
+                                   queue_size * 8)
+        self.__workers = list()
+        self.__pending = dict()
+        self.__lock = threading.Lock()
+
+    def __enter__(self):
+        """
+        Вход в контекстный менеджер
+
+        Запускает рабочие потоки
+        :return: Объект класса
+        """
+
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Выход из контекстного менеджера
+
+        Дожидается отправки сообщений из очереди и останавливает рабочие потоки
+        :return: None
+        """
+
+        self.stop()
+
+    def start(self):
+        """
+        Запуск рабочих потоков
+
+        :return: None
+        """
+
+        for i in range(len(self.__workers), self.__concurrency):
+            worker = threading.Thread(target=self.__work, name=f"delivery-{i}", daemon=True)
+            worker.start()
+            self.__workers.append(worker)
+
+    def submit(self, message: dict, replaces: dict, task_file: str, history: tuple = None):
+        """
+        Постановка сообщения в очередь
+
+        Передает копию сообщения в спул, отмечает получателя в журнале и помещает сообщение в очередь на отправку.
+        Повторно отправляемое сообщение (из очереди повторной отправки) уже находится в каталоге ошибок и
+        в журнал не вносится. Если очередь ограничена и заполнена, то блокируется до освобождения места
+        :param message:     Собранное сообщение (см. services.mailer.build) или сообщение из очереди повторной отправки
+        :param replaces:    Персональный словарь замен получателя (для записи в лог)
+        :param task_file:   Имя файла задания (None для повторной отправки)
+        :param history:     Ключ истории отправки (получатель, шаблон, проект)
+        :return: None
+        """
+
+        if 'attempt' not in message:
+            self.__spool.store(message['file'], message['data'], message.get('body'), message.get('head', 0))
+        if task_file is not None:
+            self.__journal.record(task_file, message['to'], 'rendered', message_file=message['file'])
+            with self.__lock:
+                self.__pending[task_file] = self.__pending.get(task_file, 0) + 1
+        self.__queue.put(message | {'replaces': replaces, 'task': task_file, 'history': history})
+
+    def drain(self):
+        """
+        Ожидание отправки всех сообщений в очереди
+
+        :return: None
+        """
+
+        self.__queue.join()
+
+    def pending(self, task_file: str):
+        """
+        Количество неотправленных сообщений задания
+
+        Позволяет завершить задание, не дожидаясь отправки сообщений других заданий
+        :param task_file: Имя файла задания
+        :return: Количество сообщений задания в очереди и в отправке
+        """
+
+        with self.__lock:
+            return self.__pending.get(task_file, 0)
+
+    def stop(self):
+        """
+        Остановка рабочих потоков
+
+        Закрывает очередь и дожидается остановки потоков. Сообщения, поставленные в очередь ранее, будут отправлены
+        :return: None
+        """
+
+        self.__queue.close()
+        for worker in self.__workers:
+            worker.join()
+        self.__workers.clear()
+
+    def __work(self):
+        """
+        Цикл рабочего потока
+
+        Извлекает сообщения из очереди и отправляет их до закрытия очереди. Ошибка при обработке сообщения
+        не останавливает поток и не возвращает сообщение в очередь
+        :return: None
+        """
+
+        while (job := self.__queue.get()) is not None:
+            try:
+                self.__deliver(job)
+            except Exception:
+                logging.error(f"Message file {job['file']} to {job['to']} failed in delivery", exc_info=True)
+                metrics.inc('failed')
+                self.__spool.move(job['file'], "bad/", job.get('source', "out/"))
+                if job['task'] is not None:
+                    self.__journal.record(job['task'], job['to'], 'failed', message_file=job['file'])
+            finally:
+                if job['task'] is not None:
+                    with self.__lock:
+                        self.__pending[job['task']] -= 1
+                        if not self.__pending[job['task']]:
+                            del self.__pending[job['task']]
+                self.__queue.task_done(job)
+
+    def __deliver(self, job: dict):
+        """
+        Отправка одного сообщения
+
+        Отправляет сообщение, переносит его копию в спуле в каталог отправленных или ошибок и вносит запись в лог.
+        При ведении журнала отправки успешная отправка вносится только в него
+        :param job: Сообщение в очереди
+        :return: None
+        """
+
+        # Отправляем
+        started = time.perf_counter()
+        result = self.__mailer.send_raw(job['from'], job['to'], job['data'])
+        latency = time.perf_counter() - started
+        if metrics.enabled:
+            metrics.observe('deliver', latency)
+        if not result:
+            self.__fail(job, result, latency)
+            return
+
+        # Переносим файл почтового сообщения в отправленные
+        self.__spool.move(job['file'], "send/", job.get('source', "out/"))
+        if job['task'] is not None:
+            self.__journal.record(job['task'], job['to'], 'sent', result.code, job['file'])
+        if 'attempt' in job:
+            self.__retry.complete(job['file'])
+        if self.__history is not None and job.get('history'):
+            self.__history.add(*job['history'])
+        metrics.inc('sent')
+        if self.__log is not None:
+            self.__record(job, result, latency, 'sent')
+            return
+        # Вносим запись в логгер об успешной отправке письма
+        logging.info(f'Message was sent from {job['from']} '
+                     f'to {job['replaces'].get('Название компании', '')}<{job['to']}>, '
+                     f'project {job['replaces'].get('Проект', '')}, message file {job['file']}'
+                     f'{f', relay {result.relay}' if result.relay else ''}')
+
+    def __fail(self, job: dict, result, latency: float):
+        """
+        Обработка ошибки отправки
+
+        Переносит копию сообщения в каталог ошибок и при временной ошибке ставит его в очередь повторной отправки.
+        Адрес, почтовый ящик которого не существует, вносится в список подавления
+        :param job:     Сообщение в очереди
+        :param result:  Результат отправки
+        :param latency: Время отправки в секундах
+        :return: None
+        """
+
+        # Переносим файл почтового сообщения в ошибки
+        self.__spool.move(job['file'], "bad/", job.get('source', "out/"))
+        if job['task'] is not None:
+            self.__journal.record(job['task'], job['to'], 'failed', result.code, job['file'])
+        retry = self.__retry is not None and self.__retry.schedule(job, result)
+        metrics.inc('retried' if retry else 'failed')
+        if self.__history is not None and not result.transient and result.code in self.BOUNCE:
+            self.__history.suppress(job['to'], f"bounce {result.code}")
+        if self.__log is not None:
+            self.__record(job, result, latency, 'retry' if retry else 'failed')
+        # Вносим запись в логгер об ошибке
+        logging.error(f'Message from {job['from']} '
+                      f'to {job['replaces'].get('Название компании', '')}<{job['to']}> was not sent, '
+                      f'code {result.code}, {'will be retried' if retry else 'not retried'}, '
+                      f'project {job['replaces'].get('Проект', '')}, message file {job['file']}'
+                      f'{f', relay {result.relay}' if result.relay else ''}')
+
+    def __record(self, job: dict, result, latency: float, state: str):
+        """
+        Запись в журнал отправки
+
+        :param job:     Сообщение в очереди
+        :param result:  Результат отправки
+        :param latency: Время отправки в секундах
+        :param state:   Состояние (sent, retry, failed)
+        :return: None
+        """
+
+        self.__log.record({'from': job['from'], 'rcpt': job['to'], 'project': job['replaces'].get('Проект', ''),
+                           'task': job['task'], 'file': job['file'], 'relay': result.relay, 'code': result.code,
+                           'latency': round(latency, 6), 'attempt': job.get('attempt', 0), 'state': state})
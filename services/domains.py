@@ -0,0 +1,233 @@
+# Imports
+import json
+import threading
+import time
+from collections import deque
+
+
+# Defines
+class DomainQueue:
+    """
+    Класс очереди отправки с разбиением по доменам получателей
+
+    Объект класса хранит сообщения в отдельных очередях для каждого домена получателя и выдает их рабочим потокам
+    по кругу: каждый следующий запрос получает сообщение следующего домена, у которого есть готовые сообщения.
+    Для домена ограничивается количество одновременно отправляемых сообщений и задается пауза между началом
+    отправки соседних сообщений. Домен, упершийся в ограничения, пропускается и не задерживает остальные.
+    Сообщения домена сверх его доли очереди не блокируют постановку: они откладываются и переходят в очередь
+    домена по мере отправки его сообщений, поэтому медленный домен не останавливает постановку сообщений других
+    доменов. Постановка ждет, только если заполнена общая очередь или исчерпан запас отложенных сообщений.
+    Ограничения задаются словарем {домен: {concurrency, delay}}, ключ "*" задает ограничения по умолчанию.
+    Интерфейс ожидания совпадает с queue.Queue (put, get, task_done, join)
+
+    Методы
+    ----------------
+        __init__(self, limits: dict = None, maxsize: int = 0, domain_maxsize: int = 0, overflow: int = 0)
+            Конструктор: Инициализация
+        load(filename: str, concurrency: int = 0, delay: float = 0)
+            Загрузка ограничений из файла
+        domain(rcpt: str)
+            Домен получателя
+        put(self, job: dict)
+            Постановка сообщения в очередь
+        get(self)
+            Получение сообщения для отправки
+        task_done(self, job: dict)
+            Отметка о завершении отправки сообщения
+        join(self)
+            Ожидание отправки всех сообщений
+        close(self)
+            Закрытие очереди
+        __limit(self, domain: str)
+            Ограничения домена
+    Атрибуты
+    ----------------
+        :ivar {dict} __limits:          Ограничения доменов {домен: {concurrency, delay}}
+        :ivar {int} __maxsize:          Максимальное количество сообщений в очереди (0 - без ограничения)
+        :ivar {int} __domain_maxsize:   Максимальное количество сообщений одного домена (0 - без ограничения)
+        :ivar {int} __overflow:         Максимальное количество отложенных сообщений (0 - без ограничения)
+        :ivar {dict} __domains:         Состояние доменов {домен: {items, parked, inflight, next}}
+        :ivar {any} __active:           Домены, у которых есть сообщения, в порядке обхода
+        :ivar {int} __size:             Количество сообщений в очереди (без отложенных)
+        :ivar {int} __parked:           Количество отложенных сообщений
+        :ivar {int} __unfinished:       Количество сообщений, отправка которых не завершена
+        :ivar {bool} __closed:          Признак закрытой очереди
+        :ivar {any} __condition:        Условие для ожидания изменений состояния
+    """
+
+    def __init__(self, limits: dict = None, maxsize: int = 0, domain_maxsize: int = 0, overflow: int = 0):
+        """
+        Конструктор: Инициализация
+
+        :param limits:          Ограничения доменов {домен: {concurrency, delay}} (concurrency 0 - без ограничения,
+                                delay - пауза в секундах)
+        :param maxsize:         Максимальное количество сообщений в очереди (0 - без ограничения)
+        :param domain_maxsize:  Максимальное количество сообщений одного домена (0 - без ограничения)
+        :param overflow:        Максимальное количество сообщений, отложенных сверх доли доменов (0 - без ограничения)
+        """
+
+        self.__limits = {domain.lower(): limit for domain, limit in (limits or dict()).items()}
+        self.__maxsize = maxsize
+        self.__domain_maxsize = domain_maxsize
+        self.__overflow = overflow
+        self.__domains = dict()
+        self.__active = deque()
+        self.__size = 0
+        self.__parked = 0
+        self.__unfinished = 0
+        self.__closed = False
+        self.__condition = threading.Condition()
+
+    @staticmethod
+    def load(filename: str, concurrency: int = 0, delay: float = 0):
+        """
+        Загрузка ограничений из файла
+
+        :param filename:    Файл JSON с ограничениями доменов (пустая строка - только ограничения по умолчанию)
+        :param concurrency: Количество одновременных отправок в домен по умолчанию (0 - без ограничения)
+        :param delay:       Пауза между отправками в домен по умолчанию в секундах
+        :return: Ограничения доменов {домен: {concurrency, delay}}
+        """
+
+        limits = dict()
+        if filename:
+            with open(filename, 'r', encoding='utf-8') as file:
+                limits = json.load(file)
+        limits.setdefault("*", {'concurrency': concurrency, 'delay': delay})
+        return limits
+
+    @staticmethod
+    def domain(rcpt: str):
+        """
+        Домен получателя
+
+        :param rcpt: Адрес получателя
+        :return: Домен в нижнем регистре
+        """
+
+        return rcpt.rsplit('@', 1)[-1].strip().lower()
+
+    def put(self, job: dict):
+        """
+        Постановка сообщения в очередь
+
+        Сообщение домена, очередь которого заполнена, откладывается. Блокируется, пока заполнена общая очередь
+        (для сообщения домена с местом в очереди) или исчерпан запас отложенных сообщений
+        :param job: Сообщение (адрес получателя в поле to)
+        :return: None
+        """
+
+        domain = self.domain(job['to'])
+        with self.__condition:
+            while True:
+                state = self.__domains.get(domain)
+                # Сообщения домена выдаются по порядку: при наличии отложенных новое сообщение тоже откладывается
+                full = self.__domain_maxsize and state is not None and \
+                       (state['parked'] or len(state['items']) >= self.__domain_maxsize)
+                if full and (not self.__overflow or self.__parked < self.__overflow):
+                    break
+                if not full and (not self.__maxsize or self.__size < self.__maxsize):
+                    break
+                self.__condition.wait()
+            if state is None:
+                state = self.__domains[domain] = {'items': deque(), 'parked': deque(), 'inflight': 0, 'next': 0.0}
+            if full:
+                state['parked'].append(job)
+                self.__parked += 1
+            else:
+                if not state['items']:
+                    self.__active.append(domain)
+                state['items'].append(job)
+                self.__size += 1
+                self.__condition.notify_all()
+            self.__unfinished += 1
+
+    def get(self):
+        """
+        Получение сообщения для отправки
+
+        Обходит домены по кругу и выдает первое сообщение домена, не упершегося в ограничения. Если таких доменов
+        нет, то ждет завершения отправки или окончания паузы
+        :return: Сообщение или None, если очередь закрыта и пуста
+        """
+
+        with self.__condition:
+            while True:
+                if self.__closed and not self.__size:
+                    return None
+                now = time.monotonic()
+                wait = None
+                for _ in range(len(self.__active)):
+                    domain = self.__active.popleft()
+                    state = self.__domains[domain]
+                    concurrency, delay = self.__limit(domain)
+                    if (not concurrency or state['inflight'] < concurrency) and state['next'] <= now:
+                        job = state['items'].popleft()
+                        # Место в очереди домена занимает его отложенное сообщение
+                        if state['parked']:
+                            state['items'].append(state['parked'].popleft())
+                            self.__parked -= 1
+                            self.__size += 1
+                        if state['items']:
+                            self.__active.append(domain)
+                        state['inflight'] += 1
+                        state['next'] = now + delay
+                        self.__size -= 1
+                        self.__condition.notify_all()
+                        return job
+                    self.__active.append(domain)
+                    if state['next'] > now:
+                        wait = state['next'] - now if wait is None else min(wait, state['next'] - now)
+                self.__condition.wait(wait)
+
+    def task_done(self, job: dict):
+        """
+        Отметка о завершении отправки сообщения
+
+        :param job: Сообщение, полученное из очереди
+        :return: None
+        """
+
+        domain = self.domain(job['to'])
+        with self.__condition:
+            state = self.__domains[domain]
+            state['inflight'] -= 1
+            # Забываем домен без сообщений, чтобы состояние не росло с количеством доменов
+            if not state['items'] and not state['inflight'] and state['next'] <= time.monotonic():
+                del self.__domains[domain]
+            self.__unfinished -= 1
+            self.__condition.notify_all()
+
+    def join(self):
+        """
+        Ожидание отправки всех сообщений
+
+        :return: None
+        """
+
+        with self.__condition:
+            while self.__unfinished:
+                self.__condition.wait()
+
+    def close(self):
+        """
+        Закрытие очереди
+
+        После отправки оставшихся сообщений get возвращает None
+        :return: None
+        """
+
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+    def __limit(self, domain: str):
+        """
+        Ограничения домена
+
+        :param domain: Домен
+        :return: Кортеж (количество одновременных отправок, пауза в секундах)
+        """
+
+        limit = self.__limits.get(domain) or self.__limits.get("*") or dict()
+        return limit.get('concurrency', 0), limit.get('delay', 0)
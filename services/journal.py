@@ -0,0 +1,358 @@
+# Imports
+import json
+import logging
+import os
+import threading
+import time
+from services.metrics import metrics
+
+# Defines
+class Journal:
+    """
+    Класс журнала доставки
+
+    Объект класса ведет для каждого задания журнал состояний получателей в виде файла JSONL, в который записи только
+    добавляются: rendered (сообщение собрано), sent (отправлено), failed (ошибка отправки, с кодом ответа сервера).
+    Записи копятся в памяти и сбрасываются на диск фоновым потоком пачками с одним вызовом fsync, поэтому поток
+    отправки не ждет диска. После сбоя журнал позволяет пропустить получателей, обработка которых завершена.
+    Задание, поставленное через интерфейс постановки (services.submit), хранится первой записью своего журнала
+    (submitted) и после сбоя восстанавливается из него. Журнал завершенного задания удаляется, а журнал задания,
+    которое не удалось выполнить, сохраняется с расширением .rejected и больше не восстанавливается
+
+    Методы
+    ----------------
+        __init__(self, journal_directory: str, interval: float = 0.2, batch_size: int = 256)
+            Конструктор: Инициализация
+        __enter__(self)
+            Вход в контекстный менеджер (запуск фонового потока)
+        __exit__(self, exc_type, exc_val, exc_tb)
+            Выход из контекстного менеджера (сброс записей и остановка фонового потока)
+        start(self)
+            Запуск фонового потока
+        stop(self)
+            Сброс записей и остановка фонового потока
+        record(self, task_file: str, rcpt: str, state: str, code: int = None, message_file: str = None)
+            Добавление записи
+        submit(self, task_file: str, task: dict)
+            Сохранение задания
+        wait(self)
+            Ожидание сброса добавленных записей на диск
+        completed(self, task_file: str)
+            Получатели с завершенной обработкой
+        status(self, task_file: str)
+            Количество получателей по состояниям
+        submitted(self)
+            Сохраненные задания
+        finish(self, task_file: str)
+            Удаление журнала завершенного задания
+        reject(self, task_file: str, error: str)
+            Отметка об ошибке задания
+        flush(self)
+            Сброс записей на диск
+        __work(self)
+            Цикл фонового потока
+        __states(self, task_file: str)
+            Последние состояния получателей
+        __path(self, task_file: str)
+            Путь к журналу задания
+    Атрибуты
+    ----------------
+        :cvar {set} DONE:               Состояния завершенной обработки получателя
+        :ivar {str} __directory:        Директория журналов
+        :ivar {float} __interval:       Максимальное время нахождения записи в памяти в секундах
+        :ivar {int} __batch_size:       Количество записей, при котором сброс выполняется немедленно
+        :ivar {list} __buffer:          Записи, ожидающие сброса
+        :ivar {any} __condition:        Условие для пробуждения фонового потока
+        :ivar {any} __flush_lock:       Блокировка записи в файлы
+        :ivar {bool} __running:         Признак работы фонового потока
+        :ivar {any} __worker:           Фоновый поток
+        :ivar {int} __appended:         Количество добавленных записей
+        :ivar {int} __flushed:          Количество записей, сброшенных на диск
+    """
+
+    DONE = {'sent', 'failed'}
+
+    def __init__(self, journal_directory: str, interval: float = 0.2, batch_size: int = 256):
+        """
+        Конструктор: Инициализация
+
+        :param journal_directory:   Директория журналов
+        :param interval:            Максимальное время нахождения записи в памяти в секундах
+        :param batch_size:          Количество записей, при котором сброс выполняется немедленно
+        """
+
+        self.__directory = journal_directory
+        self.__interval = interval
+        self.__batch_size = batch_size
+        self.__buffer = list()
+        self.__condition = threading.Condition()
+        self.__flush_lock = threading.Lock()
+        self.__running = False
+        self.__worker = None
+        self.__appended = 0
+        self.__flushed = 0
+
+    def __enter__(self):
+        """
+        Вход в контекстный менеджер
+
+        :return: Объект класса
+        """
+
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Выход из контекстного менеджера
+
+        :return: None
+        """
+
+        self.stop()
+
+    def start(self):
+        """
+        Запуск фонового потока
+
+        :return: None
+        """
+
+        if self.__worker is None:
+            self.__running = True
+            self.__worker = threading.Thread(target=self.__work, name="journal", daemon=True)
+            self.__worker.start()
+
+    def stop(self):
+        """
+        Сброс записей и остановка фонового потока
+
+        :return: None
+        """
+
+        if self.__worker is not None:
+            with self.__condition:
+                self.__running = False
+                self.__condition.notify()
+            self.__worker.join()
+            self.__worker = None
+        self.flush()
+
+    def record(self, task_file: str, rcpt: str, state: str, code: int = None, message_file: str = None):
+        """
+        Добавление записи
+
+        :param task_file:       Имя файла задания
+        :param rcpt:            Адрес получателя
+        :param state:           Состояние (rendered, sent, failed)
+        :param code:            Код ответа сервера
+        :param message_file:    Имя файла почтового сообщения
+        :return: None
+        """
+
+        entry = {'time': time.time(), 'rcpt': rcpt, 'state': state, 'code': code, 'file': message_file}
+        with self.__condition:
+            self.__buffer.append((task_file, entry))
+            self.__appended += 1
+            if len(self.__buffer) >= self.__batch_size:
+                self.__condition.notify()
+
+    def submit(self, task_file: str, task: dict):
+        """
+        Сохранение задания
+
+        Добавляет в журнал запись с содержимым задания. Запись сбрасывается на диск вместе с остальными, для
+        ожидания сброса следует вызвать wait
+        :param task_file:   Имя задания
+        :param task:        Содержимое задания
+        :return: None
+        """
+
+        with self.__condition:
+            self.__buffer.append((task_file, {'time': time.time(), 'state': 'submitted', 'task': task}))
+            self.__appended += 1
+            self.__condition.notify()
+
+    def wait(self):
+        """
+        Ожидание сброса добавленных записей на диск
+
+        Записи нескольких потоков, ожидающих одновременно, сбрасываются одним вызовом fsync для каждого файла
+        :return: None
+        """
+
+        with self.__condition:
+            target = self.__appended
+            self.__condition.notify()
+            while self.__flushed < target:
+                if self.__worker is None:
+                    break
+                self.__condition.wait(self.__interval)
+        if self.__flushed < target:
+            self.flush()
+
+    def completed(self, task_file: str):
+        """
+        Получатели с завершенной обработкой
+
+        Читает журнал задания и возвращает получателей, последнее состояние которых - отправлено или ошибка.
+        Неполная последняя строка (сбой во время записи) пропускается
+        :param task_file: Имя файла задания
+        :return: Множество адресов получателей
+        """
+
+        self.flush()
+        return {rcpt for rcpt, state in self.__states(task_file).items() if state in self.DONE}
+
+    def status(self, task_file: str):
+        """
+        Количество получателей по состояниям
+
+        Журнал читается без сброса записей, поэтому последние изменения могут быть не учтены
+        :param task_file: Имя файла задания
+        :return: Словарь {rendered, sent, failed}
+        """
+
+        counts = {'rendered': 0, 'sent': 0, 'failed': 0}
+        for state in self.__states(task_file).values():
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def submitted(self):
+        """
+        Сохраненные задания
+
+        Возвращает задания, поставленные через интерфейс постановки и не завершенные (их журнал не удален)
+        :return: Словарь {имя задания: содержимое задания} в порядке постановки
+        """
+
+        tasks = list()
+        for name in os.listdir(self.__directory):
+            if not name.endswith(".jsonl"):
+                continue
+            try:
+                with open(self.__directory + name, 'r', encoding='utf-8') as file:
+                    entry = json.loads(file.readline())
+            except (OSError, json.JSONDecodeError):
+                continue
+            if entry.get('state') == 'submitted':
+                tasks.append((entry['time'], name.removesuffix(".jsonl"), entry['task']))
+        return {task_file: task for _, task_file, task in sorted(tasks, key=lambda item: item[0])}
+
+    def finish(self, task_file: str):
+        """
+        Удаление журнала завершенного задания
+
+        :param task_file: Имя файла задания
+        :return: None
+        """
+
+        self.flush()
+        try:
+            os.remove(self.__path(task_file))
+        except FileNotFoundError:
+            pass
+
+    def reject(self, task_file: str, error: str):
+        """
+        Отметка об ошибке задания
+
+        Дописывает в журнал запись об ошибке и переименовывает журнал, чтобы задание не восстанавливалось при
+        следующем запуске
+        :param task_file:   Имя файла задания
+        :param error:       Описание ошибки
+        :return: None
+        """
+
+        with self.__condition:
+            self.__buffer.append((task_file, {'time': time.time(), 'state': 'rejected', 'error': error}))
+            self.__appended += 1
+        self.flush()
+        path = self.__path(task_file)
+        try:
+            os.replace(path, path.removesuffix(".jsonl") + ".rejected")
+        except OSError:
+            logging.error(f"Journal of task {task_file} could not be marked as rejected", exc_info=True)
+
+    def flush(self):
+        """
+        Сброс записей на диск
+
+        Дописывает накопленные записи в журналы заданий и вызывает fsync один раз для каждого затронутого файла
+        :return: None
+        """
+
+        with self.__flush_lock:
+            with self.__condition:
+                entries, self.__buffer = self.__buffer, list()
+                appended = self.__appended
+            if not entries:
+                self.__flushed = max(self.__flushed, appended)
+                return
+
+            # Группируем записи по заданиям
+            lines = dict()
+            for task_file, entry in entries:
+                lines.setdefault(task_file, list()).append(json.dumps(entry, ensure_ascii=False) + "\n")
+            with metrics.timer('journal_flush'):
+                for task_file, task_lines in lines.items():
+                    try:
+                        with open(self.__path(task_file), 'a', encoding='utf-8') as file:
+                            file.writelines(task_lines)
+                            file.flush()
+                            os.fsync(file.fileno())
+                    except OSError:
+                        logging.error(f"Journal of task {task_file} could not be written", exc_info=True)
+            with self.__condition:
+                self.__flushed = max(self.__flushed, appended)
+                self.__condition.notify_all()
+
+    def __work(self):
+        """
+        Цикл фонового потока
+
+        Сбрасывает записи по истечении интервала или при накоплении пачки
+        :return: None
+        """
+
+        while True:
+            with self.__condition:
+                if self.__running and len(self.__buffer) < self.__batch_size:
+                    self.__condition.wait(self.__interval)
+                running = self.__running
+            self.flush()
+            if not running:
+                return
+
+    def __states(self, task_file: str):
+        """
+        Последние состояния получателей
+
+        Неполная последняя строка (сбой во время записи) пропускается
+        :param task_file: Имя файла задания
+        :return: Словарь {адрес получателя: состояние}
+        """
+
+        states = dict()
+        try:
+            with open(self.__path(task_file), 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if 'rcpt' in entry:
+                        states[entry['rcpt']] = entry['state']
+        except FileNotFoundError:
+            pass
+        return states
+
+    def __path(self, task_file: str):
+        """
+        Путь к журналу задания
+
+        :param task_file: Имя файла задания
+        :return: Путь к файлу журнала (<имя задания>.jsonl)
+        """
+
+        return self.__directory + task_file.removesuffix('.json') + ".jsonl"
@@ -0,0 +1,266 @@
+# Imports
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# Defines
+class LogWriter:
+    """
+    Класс фоновой записи логов
+
+    Объект класса переводит запись логов в фоновый поток: на корневой логгер устанавливается обработчик, который
+    только помещает запись в очередь, а файловые обработчики всех логгеров переносятся в фоновый поток. Обработчик
+    лога модуля (например, services.mailer.log) получает только записи своего логгера, как и до переноса, поэтому
+    каждая запись ставится в очередь один раз и попадает в те же файлы, что и при синхронной записи
+
+    Методы
+    ----------------
+        __init__(self)
+            Конструктор: Инициализация
+        __enter__(self)
+            Вход в контекстный менеджер (запуск фоновой записи)
+        __exit__(self, exc_type, exc_val, exc_tb)
+            Выход из контекстного менеджера (дозапись очереди и возврат обработчиков)
+        start(self)
+            Запуск фоновой записи
+        stop(self)
+            Дозапись очереди и возврат обработчиков логгерам
+    Атрибуты
+    ----------------
+        :ivar {any} __queue:        Очередь записей
+        :ivar {any} __listener:     Фоновый поток записи
+        :ivar {list} __moved:       Перенесенные обработчики в виде пар (логгер, обработчик)
+    """
+
+    def __init__(self):
+        """
+        Конструктор: Инициализация
+        """
+
+        self.__queue = queue.SimpleQueue()
+        self.__listener = None
+        self.__moved = list()
+
+    def __enter__(self):
+        """
+        Вход в контекстный менеджер
+
+        :return: Объект класса
+        """
+
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Выход из контекстного менеджера
+
+        :return: None
+        """
+
+        self.stop()
+
+    def start(self):
+        """
+        Запуск фоновой записи
+
+        Переносит файловые обработчики корневого логгера и логгеров модулей в фоновый поток. Обработчики модулей
+        получают фильтр по имени логгера
+        :return: None
+        """
+
+        if self.__listener is not None:
+            return
+        root = logging.getLogger()
+        loggers = [root] + [logger for logger in logging.root.manager.loggerDict.values()
+                            if isinstance(logger, logging.Logger)]
+        handlers = list()
+        for logger in loggers:
+            for handler in list(logger.handlers):
+                if not isinstance(handler, logging.FileHandler):
+                    continue
+                logger.removeHandler(handler)
+                if logger is not root:
+                    handler.addFilter(logging.Filter(logger.name))
+                handlers.append(handler)
+                self.__moved.append((logger, handler))
+
+        root.addHandler(logging.handlers.QueueHandler(self.__queue))
+        self.__listener = logging.handlers.QueueListener(self.__queue, *handlers, respect_handler_level=True)
+        self.__listener.start()
+
+    def stop(self):
+        """
+        Дозапись очереди и возврат обработчиков логгерам
+
+        :return: None
+        """
+
+        if self.__listener is None:
+            return
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            if isinstance(handler, logging.handlers.QueueHandler):
+                root.removeHandler(handler)
+        self.__listener.stop()
+        self.__listener = None
+        for logger, handler in self.__moved:
+            handler.filters.clear()
+            logger.addHandler(handler)
+        self.__moved.clear()
+
+class DeliveryLog:
+    """
+    Класс журнала отправки в формате JSONL
+
+    Объект класса записывает по одной строке JSON на каждое отправленное или не отправленное сообщение: время,
+    отправитель, получатель, проект, файл сообщения, сервер, код ответа, время отправки, номер повтора, состояние.
+    Записи копятся в памяти и дописываются в файл фоновым потоком пачками, поэтому поток отправки не ждет диска.
+    Файл предназначен для последующего анализа (не требует разбора текстовых строк лога)
+
+    Методы
+    ----------------
+        __init__(self, filename: str, interval: float = 1, batch_size: int = 1024)
+            Конструктор: Инициализация
+        __enter__(self)
+            Вход в контекстный менеджер (запуск фонового потока)
+        __exit__(self, exc_type, exc_val, exc_tb)
+            Выход из контекстного менеджера (дозапись и остановка фонового потока)
+        start(self)
+            Запуск фонового потока
+        stop(self)
+            Дозапись и остановка фонового потока
+        record(self, entry: dict)
+            Добавление записи
+        flush(self)
+            Запись накопленных записей в файл
+        __work(self)
+            Цикл фонового потока
+    Атрибуты
+    ----------------
+        :ivar {str} __filename:         Имя файла журнала
+        :ivar {float} __interval:       Максимальное время нахождения записи в памяти в секундах
+        :ivar {int} __batch_size:       Количество записей, при котором запись выполняется немедленно
+        :ivar {list} __buffer:          Записи, ожидающие записи
+        :ivar {any} __condition:        Условие для пробуждения фонового потока
+        :ivar {any} __flush_lock:       Блокировка записи в файл
+        :ivar {bool} __running:         Признак работы фонового потока
+        :ivar {any} __worker:           Фоновый поток
+    """
+
+    def __init__(self, filename: str, interval: float = 1, batch_size: int = 1024):
+        """
+        Конструктор: Инициализация
+
+        :param filename:    Имя файла журнала
+        :param interval:    Максимальное время нахождения записи в памяти в секундах
+        :param batch_size:  Количество записей, при котором запись выполняется немедленно
+        """
+
+        self.__filename = filename
+        self.__interval = interval
+        self.__batch_size = batch_size
+        self.__buffer = list()
+        self.__condition = threading.Condition()
+        self.__flush_lock = threading.Lock()
+        self.__running = False
+        self.__worker = None
+
+    def __enter__(self):
+        """
+        Вход в контекстный менеджер
+
+        :return: Объект класса
+        """
+
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Выход из контекстного менеджера
+
+        :return: None
+        """
+
+        self.stop()
+
+    def start(self):
+        """
+        Запуск фонового потока
+
+        :return: None
+        """
+
+        if self.__worker is None:
+            self.__running = True
+            self.__worker = threading.Thread(target=self.__work, name="delivery-log", daemon=True)
+            self.__worker.start()
+
+    def stop(self):
+        """
+        Дозапись и остановка фонового потока
+
+        :return: None
+        """
+
+        if self.__worker is not None:
+            with self.__condition:
+                self.__running = False
+                self.__condition.notify()
+            self.__worker.join()
+            self.__worker = None
+        self.flush()
+
+    def record(self, entry: dict):
+        """
+        Добавление записи
+
+        Сериализация выполняется фоновым потоком
+        :param entry: Поля записи (from, rcpt, project, file, relay, code, latency, attempt, state)
+        :return: None
+        """
+
+        entry['time'] = time.time()
+        with self.__condition:
+            self.__buffer.append(entry)
+            if len(self.__buffer) >= self.__batch_size:
+                self.__condition.notify()
+
+    def flush(self):
+        """
+        Запись накопленных записей в файл
+
+        :return: None
+        """
+
+        with self.__flush_lock:
+            with self.__condition:
+                entries, self.__buffer = self.__buffer, list()
+            if not entries:
+                return
+            try:
+                with open(self.__filename, 'a', encoding='utf-8') as file:
+                    file.writelines(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries)
+            except OSError:
+                logging.error(f"Delivery log {self.__filename} could not be written", exc_info=True)
+
+    def __work(self):
+        """
+        Цикл фонового потока
+
+        Записывает накопленные записи по истечении интервала или при накоплении пачки
+        :return: None
+        """
+
+        while True:
+            with self.__condition:
+                if self.__running and len(self.__buffer) < self.__batch_size:
+                    self.__condition.wait(self.__interval)
+                running = self.__running
+            self.flush()
+            if not running:
+                return
@@ -1,112 +1,474 @@
 # Imports
 import logging
+import os
 import uuid
 import smtplib
+import queue
+import threading
+import time
+from collections import deque
 from email.message import EmailMessage
 from email.policy import default
 from email.parser import BytesParser
 from email.utils import make_msgid
-import mimetypes
 from smtplib import SMTPConnectError
+from services.assets import AssetCache
+from services.metrics import metrics
 
 
 # Defines
-def make(from_sender:str, to_rcpt:str, subject:str, plain: str, html: str,
-         files_directory: str, mail_directory: str, images: dict = None, attachments: dict = None):
+# Политика сериализации сообщений в формат передачи (окончания строк CRLF)
+POLICY = default.clone(linesep="\r\n")
+
+def body(from_sender: str, subject: str, plain: str, html: str, files_directory: str, images: dict = None,
+         attachments: dict = None, assets: AssetCache = None, bodies = None):
     """
-    Создание сообщения
+    Сборка тела сообщения
 
-    Формирует файл сообщения, записывает его в каталог для отправки и возвращает имя сформированного файла
+    Формирует почтовое сообщение без заголовка получателя и сериализует его в байты в том виде, в котором оно
+    передается серверу. Если задан кеш тел, то одинаковое содержимое собирается один раз, а последующие вызовы
+    возвращают тот же объект байтов
     :param from_sender:     Адрес отправителя
-    :param to_rcpt:         Адреса получателей
     :param subject:         Тема письма
     :param plain:           Тест без разметки (замещающий)
     :param html:            Текст в разметке html (основной)
     :param files_directory: Директория c прикрепляемыми файлами
-    :param mail_directory:  Директория для сохранения файла почтового сообщения
     :param images:          Словарь изображений
     :param attachments:     Словарь вложений
-    :return: Имя файла сформированного почтового сообщения
+    :param assets:          Кеш закодированных вложений (если не задан, файлы читаются заново)
+    :param bodies:          Кеш тел сообщений (services.bodies.BodyCache)
+    :return: Пара (хеш содержимого или None без кеша тел, байты тела)
     """
 
+    # Ищем собранное тело с тем же содержимым
+    digest = None
+    if bodies is not None:
+        digest = bodies.key(from_sender, subject, plain, html, files_directory, images, attachments)
+        data = bodies.get(digest)
+        if data is not None:
+            return digest, data
+
+    # Без общего кеша файлы вложений читаются и кодируются заново
+    if assets is None:
+        assets = AssetCache(0)
+
     # Создаем контейнер письма
     message = EmailMessage()
     # Указываем кодировку
     message.set_charset("utf-8")
-    # Формируем заголовок письма
+    # Формируем заголовок письма (заголовок получателя добавляется к каждому сообщению отдельно)
     message['From'] = from_sender
-    message['To'] = to_rcpt
     message['Subject'] = subject
 
     # Прикрепляем текстовое содержимое тела письма
     message.set_content(plain)
 
-    # Внедряем в тело письма изображения (если они есть)
+    # Внедряем в html содержимое ид изображений (если они есть)
+    image_cids = dict()
     if not images is None:
         for cid, image_name in images.items():
             # Генерируем ид изображения
-            image_cid = make_msgid(domain="prointegra.ru")
-            # Внедряем ид в содержимое html сообщения
-            html = html.replace('{' + cid + '}', image_cid[1:-1])
-            message.add_alternative(html, subtype="html")
-            # Читаем файл изображения
-            with open(files_directory + image_name, "r+b") as img_file:
-                # Определяем по заголовку тип файла
-                _maintype, _subtype = mimetypes.guess_type(img_file.name)[0].split('/')
-                # Прикрепляем файл изображения
-                message.get_payload()[1].add_related(img_file.read(), maintype=_maintype, subtype=_subtype, cid=image_cid)
-    else:
-        # Встроенных изображений нет - просто прикрепляем html содержимое Без файлов
-        message.add_alternative(html, subtype="html")
-
-    # Прикрепляем файлы (если есть)
-    if not attachments is None:
-        for alt, attach_name in attachments.items():
-
-            # Читаем файл вложения
-            with open(files_directory + attach_name, "r+b") as attach_file:
-                # Определяем по заголовку тип файла
-                _maintype, _subtype = mimetypes.guess_type(attach_file.name)[0].split('/')
-                # Прикрепляем файл изображения
-                message.get_payload()[1].add_related(attach_file.read(), maintype=_maintype, subtype=_subtype)
+            image_cids[cid] = make_msgid(domain="prointegra.ru")
+            html = html.replace('{' + cid + '}', image_cids[cid][1:-1])
+    # Прикрепляем html содержимое
+    message.add_alternative(html, subtype="html")
+
+    # Встраиваем закодированные изображения и вложения (если есть) из общего кеша
+    if image_cids or attachments:
+        html_part = message.get_payload()[1]
+        html_part.make_related()
+        for cid, image_cid in image_cids.items():
+            html_part.attach(assets.part(files_directory + images[cid], image_cid))
+        for attach_name in (attachments or dict()).values():
+            html_part.attach(assets.part(files_directory + attach_name))
+
+    # Сериализуем сообщение один раз в формат передачи
+    data = message.as_bytes(policy=POLICY)
+    if bodies is not None:
+        bodies.put(digest, data)
+    return digest, data
+
+def header(to_rcpt: str):
+    """
+    Заголовок получателя
+
+    :param to_rcpt: Адрес получателя
+    :return: Байты заголовка To в формате передачи
+    """
+
+    return POLICY.header_factory('To', to_rcpt).fold(policy=POLICY).encode()
+
+def assemble(from_sender: str, to_rcpt: str, head: bytes, digest: str, data: bytes):
+    """
+    Соединение заголовка получателя и тела сообщения
+
+    :param from_sender: Адрес отправителя
+    :param to_rcpt:     Адрес получателя
+    :param head:        Байты заголовка получателя
+    :param digest:      Хеш содержимого тела (None, если тело не кешируется)
+    :param data:        Байты тела
+    :return: Сообщение в виде словаря {file: имя файла, from: отправитель, to: получатель, data: байты сообщения,
+             head: длина заголовка получателя в начале data, body: хеш содержимого тела}
+    """
 
     # Генерируем имя файла сообщения в виде UUID
-    filename = str(uuid.uuid4()) + ".msg"
+    return {'file': str(uuid.uuid4()) + ".msg", 'from': from_sender, 'to': to_rcpt, 'data': head + data,
+            'head': len(head), 'body': digest}
+
+def build(from_sender:str, to_rcpt:str, subject:str, plain: str, html: str,
+          files_directory: str, images: dict = None, attachments: dict = None, assets: AssetCache = None,
+          bodies = None):
+    """
+    Сборка сообщения
+
+    Формирует почтовое сообщение и сериализует его в байты в том виде, в котором оно передается серверу (с
+    окончаниями строк CRLF). Сообщение состоит из заголовка получателя и тела, общего для получателей с одинаковым
+    содержимым
+    :param from_sender:     Адрес отправителя
+    :param to_rcpt:         Адреса получателей
+    :param subject:         Тема письма
+    :param plain:           Тест без разметки (замещающий)
+    :param html:            Текст в разметке html (основной)
+    :param files_directory: Директория c прикрепляемыми файлами
+    :param images:          Словарь изображений
+    :param attachments:     Словарь вложений
+    :param assets:          Кеш закодированных вложений (если не задан, файлы читаются заново)
+    :param bodies:          Кеш тел сообщений (если не задан, тело собирается заново)
+    :return: Сообщение в виде словаря {file: имя файла, from: отправитель, to: получатель, data: байты сообщения,
+             head: длина заголовка получателя, body: хеш содержимого тела}
+    """
+
+    digest, data = body(from_sender, subject, plain, html, files_directory, images, attachments, assets, bodies)
+    return assemble(from_sender, to_rcpt, header(to_rcpt), digest, data)
+
+def make(from_sender:str, to_rcpt:str, subject:str, plain: str, html: str,
+         files_directory: str, mail_directory: str, images: dict = None, attachments: dict = None):
+    """
+    Создание сообщения
+
+    Формирует файл сообщения, записывает его в каталог для отправки и возвращает имя сформированного файла
+    :param from_sender:     Адрес отправителя
+    :param to_rcpt:         Адреса получателей
+    :param subject:         Тема письма
+    :param plain:           Тест без разметки (замещающий)
+    :param html:            Текст в разметке html (основной)
+    :param files_directory: Директория c прикрепляемыми файлами
+    :param mail_directory:  Директория для сохранения файла почтового сообщения
+    :param images:          Словарь изображений
+    :param attachments:     Словарь вложений
+    :return: Имя файла сформированного почтового сообщения
+    """
+
+    # Собираем сообщение
+    message = build(from_sender, to_rcpt, subject, plain, html, files_directory, images, attachments)
     # Запись сообщения в файл
-    with open(mail_directory + filename, 'w+b') as msg_file:
-        msg_file.write(message.as_bytes())
+    with open(mail_directory + message['file'], 'w+b') as msg_file:
+        msg_file.write(message['data'])
 
     # Возвращаем имя сгенерированного файла
-    return filename
+    return message['file']
+
+class SendResult:
+    """
+    Класс результата отправки
+
+    Объект класса описывает результат отправки сообщения: признак успеха, код ответа сервера и текст ошибки.
+    Временные ошибки (коды 4xx, разрыв соединения) отличаются от постоянных (коды 5xx). В логическом контексте
+    объект истинен в случае успешной отправки
+
+    Методы
+    ----------------
+        __init__(self, ok: bool, code: int = None, error: str = None, transient: bool = False)
+            Конструктор: Инициализация
+        __bool__(self)
+            Признак успешной отправки
+        __repr__(self)
+            Строковое представление
+        from_error(error: Exception)
+            Результат по исключению
+    Атрибуты
+    ----------------
+        :ivar {bool} ok:            Признак успешной отправки
+        :ivar {int} code:           Код ответа сервера (None, если ответа не было)
+        :ivar {str} error:          Текст ошибки
+        :ivar {bool} transient:     Признак временной ошибки (отправку можно повторить)
+        :ivar {str} relay:          Имя сервера, через который выполнялась отправка (при пуле серверов)
+    """
+
+    def __init__(self, ok: bool, code: int = None, error: str = None, transient: bool = False):
+        """
+        Конструктор: Инициализация
+
+        :param ok:          Признак успешной отправки
+        :param code:        Код ответа сервера
+        :param error:       Текст ошибки
+        :param transient:   Признак временной ошибки
+        """
+
+        self.ok = ok
+        self.code = code
+        self.error = error
+        self.transient = transient
+        self.relay = None
+
+    def __bool__(self):
+        """
+        Признак успешной отправки
+
+        :return: True в случае успешной отправки
+        """
+
+        return self.ok
+
+    def __repr__(self):
+        """
+        Строковое представление
+
+        :return: Строка с кодом и текстом ошибки
+        """
+
+        return f"SendResult(ok={self.ok}, code={self.code}, transient={self.transient}, error={self.error!r})"
+
+    @staticmethod
+    def from_error(error: Exception):
+        """
+        Результат по исключению
+
+        Извлекает из исключения smtplib код ответа сервера. Ошибки без кода (разрыв соединения, сетевые ошибки)
+        считаются временными
+        :param error: Исключение
+        :return: Результат отправки
+        """
+
+        code, text = None, str(error)
+        if isinstance(error, smtplib.SMTPResponseException):
+            code = error.smtp_code
+            text = error.smtp_error.decode(errors='replace') if isinstance(error.smtp_error, bytes) \
+                else str(error.smtp_error)
+        elif isinstance(error, smtplib.SMTPRecipientsRefused) and error.recipients:
+            code, reply = next(iter(error.recipients.values()))
+            text = reply.decode(errors='replace') if isinstance(reply, bytes) else str(reply)
+        return SendResult(False, code, text, code is None or 400 <= code < 500)
+
+class SMTPSession:
+    """
+    Класс сессии SMTP
+
+    Объект класса хранит открытое и авторизованное соединение с сервером отправки почты, а также счетчик
+    отправленных через него сообщений и время последнего использования
+
+    Методы
+    ----------------
+        __init__(self, server: smtplib.SMTP)
+            Конструктор: Инициализация
+    Атрибуты
+    ----------------
+        :ivar {smtplib.SMTP} server:    Соединение с сервером
+        :ivar {int} count:              Количество отправленных сообщений
+        :ivar {float} used:             Время последнего использования (монотонное)
+    """
+
+    def __init__(self, server: smtplib.SMTP):
+        """
+        Конструктор: Инициализация
+
+        Инициализирует объект класса открытым соединением с сервером
+        :param server:  Соединение с сервером
+        """
+
+        self.server = server
+        self.count = 0
+        self.used = time.monotonic()
+
+class RateLimiter:
+    """
+    Класс ограничителя скорости отправки
+
+    Объект класса ограничивает скорость отправки сообщений корзиной маркеров (не более заданного количества сообщений
+    в секунду) и скользящим окном за последний час. Скорость подстраивается под сервер: при ответах 421/450/451
+    ("попробуйте позже") она уменьшается в несколько раз, после каждой успешной отправки - понемногу растет до
+    заданного предела. Снижение выполняется не чаще одного раза за интервал, чтобы ответы на сообщения, отправленные
+    еще на прежней скорости, не снизили ее до минимума
+
+    Методы
+    ----------------
+        __init__(self, rate: float = 0, hourly: int = 0, min_rate: float = None, increase: float = None,
+                 decrease: float = 0.5)
+            Конструктор: Инициализация
+        acquire(self)
+            Ожидание разрешения на отправку
+        update(self, result: SendResult)
+            Подстройка скорости по результату отправки
+        rate(self)
+            Текущая скорость
+    Атрибуты
+    ----------------
+        :cvar {set} THROTTLE:           Коды ответа сервера, требующие снижения скорости
+        :ivar {float} __ceiling:        Максимальная скорость в сообщениях в секунду (0 - без ограничения)
+        :ivar {float} __rate:           Текущая скорость в сообщениях в секунду
+        :ivar {float} __min_rate:       Минимальная скорость в сообщениях в секунду
+        :ivar {float} __increase:       Прирост скорости после успешной отправки
+        :ivar {float} __decrease:       Множитель скорости при ответе "попробуйте позже"
+        :ivar {float} __tokens:         Количество маркеров в корзине
+        :ivar {float} __stamp:          Время последнего пополнения корзины (монотонное)
+        :ivar {float} __hold:           Время, до которого скорость повторно не снижается (монотонное)
+        :ivar {int} __hourly:           Максимальное количество сообщений в час (0 - без ограничения)
+        :ivar {any} __sent:             Время отправки сообщений за последний час (монотонное)
+        :ivar {any} __lock:             Блокировка доступа к состоянию
+    """
+
+    THROTTLE = {421, 450, 451}
+
+    def __init__(self, rate: float = 0, hourly: int = 0, min_rate: float = None, increase: float = None,
+                 decrease: float = 0.5):
+        """
+        Конструктор: Инициализация
+
+        :param rate:        Максимальная скорость в сообщениях в секунду (0 - без ограничения)
+        :param hourly:      Максимальное количество сообщений в час (0 - без ограничения)
+        :param min_rate:    Минимальная скорость (по умолчанию - 1/32 максимальной)
+        :param increase:    Прирост скорости после успешной отправки (по умолчанию - 1/50 максимальной)
+        :param decrease:    Множитель скорости при ответе "попробуйте позже"
+        """
+
+        self.__ceiling = rate
+        self.__rate = rate
+        self.__min_rate = min_rate if min_rate is not None else rate / 32
+        self.__increase = increase if increase is not None else rate / 50
+        self.__decrease = decrease
+        self.__tokens = 1.0
+        self.__stamp = time.monotonic()
+        self.__hold = 0.0
+        self.__hourly = hourly
+        self.__sent = deque()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Ожидание разрешения на отправку
+
+        Блокируется, пока в корзине нет маркера или исчерпан часовой лимит
+        :return: None
+        """
+
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                wait = 0.0
+                # Часовой лимит
+                if self.__hourly:
+                    while self.__sent and self.__sent[0] <= now - 3600:
+                        self.__sent.popleft()
+                    if len(self.__sent) >= self.__hourly:
+                        wait = self.__sent[0] + 3600 - now
+                # Корзина маркеров (объем - не менее одного сообщения и не более секунды отправки)
+                if self.__rate and not wait:
+                    self.__tokens = min(max(1.0, self.__rate), self.__tokens + (now - self.__stamp) * self.__rate)
+                    self.__stamp = now
+                    if self.__tokens >= 1:
+                        self.__tokens -= 1
+                    else:
+                        wait = (1 - self.__tokens) / self.__rate
+                if not wait:
+                    if self.__hourly:
+                        self.__sent.append(now)
+                    return
+            time.sleep(wait)
+
+    def update(self, result: SendResult):
+        """
+        Подстройка скорости по результату отправки
+
+        После успешной отправки скорость увеличивается на постоянную величину, после ответа 421/450/451 -
+        уменьшается в несколько раз
+        :param result: Результат отправки
+        :return: None
+        """
+
+        if not self.__ceiling:
+            return
+        with self.__lock:
+            if result:
+                self.__rate = min(self.__ceiling, self.__rate + self.__increase)
+            elif result.code in self.THROTTLE:
+                now = time.monotonic()
+                if now < self.__hold:
+                    return
+                self.__rate = max(self.__min_rate, self.__rate * self.__decrease)
+                self.__tokens = min(self.__tokens, 1.0)
+                self.__hold = now + max(1.0, 1 / self.__rate)
+                logging.warning(f"SMTP server replied {result.code}, sending rate lowered to "
+                                f"{self.__rate:.2f} messages/s")
+
+    def rate(self):
+        """
+        Текущая скорость
+
+        :return: Текущая скорость в сообщениях в секунду (0 - без ограничения)
+        """
+
+        return self.__rate
 
 class Mailer:
     """
     Класс для отправки почтовых сообщений
 
-    Объекты класса отправляют почтовые сообщения в виде чистого текста и текста HTML-разметки
+    Объекты класса отправляют почтовые сообщения в виде чистого текста и текста HTML-разметки. Соединения с сервером
+    хранятся в пуле и переиспользуются между вызовами отправки
 
     Методы
     ----------------
-        __init__(self, address:str, port:int, user:str, password:str, tls:bool = False, ssl:bool = True)
+        __init__(self, address:str, port:int, user:str, password:str, tls:bool = False, ssl:bool = True,
+                 pool_size: int = 1, session_limit: int = 100, idle_timeout: float = 10, rate: float = 0,
+                 hourly_limit: int = 0)
             Конструктор: Инициализация
+        __enter__(self)
+            Вход в контекстный менеджер
+        __exit__(self, exc_type, exc_val, exc_tb)
+            Выход из контекстного менеджера
         send(self, msg_path: str)
             Отправка почты
+        send_raw(self, sender: str, recipients, data: bytes)
+            Отправка сериализованного сообщения
+        rate(self)
+            Текущая скорость отправки
+        close(self)
+            Закрытие пула соединений
+        __transmit(self, action)
+            Передача сообщения серверу
+        __connect(self)
+            Открытие новой сессии
+        __acquire(self)
+            Получение сессии из пула
+        __release(self, session: SMTPSession, reusable: bool)
+            Возврат сессии в пул
+        __drop(self, session: SMTPSession)
+            Закрытие сессии
+        __is_disconnect(error: Exception)
+            Проверка ошибки на разрыв соединения
     Атрибуты
     ----------------
-        :ivar {str} __address:      Адрес сервера
-        :ivar {int} __port:         Порт сервера
-        :ivar {str} __user:         Пользователь сервера
-        :ivar {str} __password:     Пароль пользователя
-        :ivar {bool} __starttls:    Признак использования протокола STARTTLS
-        :ivar {bool} __ssl:         Признак использования протокола SSL
+        :ivar {str} __address:          Адрес сервера
+        :ivar {int} __port:             Порт сервера
+        :ivar {str} __user:             Пользователь сервера
+        :ivar {str} __password:         Пароль пользователя
+        :ivar {bool} __starttls:        Признак использования протокола STARTTLS
+        :ivar {bool} __ssl:             Признак использования протокола SSL
+        :ivar {int} __session_limit:    Максимальное количество сообщений на одну сессию
+        :ivar {float} __idle_timeout:   Время простоя сессии, после которого она проверяется командой NOOP
+        :ivar {any} __idle:             Очередь простаивающих сессий
+        :ivar {any} __slots:            Семафор, ограничивающий количество открытых сессий размером пула
+        :ivar {RateLimiter} __limiter:  Ограничитель скорости отправки
     """
 
-    def __init__(self, address:str, port:int, user:str, password:str, logs_directory: str, tls:bool = False, ssl:bool = True, ):
+    def __init__(self, address:str, port:int, user:str, password:str, logs_directory: str, tls:bool = False, ssl:bool = True,
+                 pool_size: int = 1, session_limit: int = 100, idle_timeout: float = 10, rate: float = 0,
+                 hourly_limit: int = 0):
         """
         Конструктор: Инициализация
 
-        Инициализирует объект класса настройками подключения к серверу отправки электронной почты. Создает очередь
-        сообщений
+        Инициализирует объект класса настройками подключения к серверу отправки электронной почты. Создает пул
+        соединений
         :param address:         Адрес сервера
         :param port:            Порт сервера
         :param user:            Пользователь сервера
@@ -114,16 +476,24 @@ class Mailer:
         :param logs_directory:  Директория для лога
         :param tls:             Сообщения шифруются
         :param ssl:             Соединение происходит через протокол SSL
+        :param pool_size:       Максимальное количество одновременно открытых сессий
+        :param session_limit:   Максимальное количество сообщений на одну сессию
+        :param idle_timeout:    Время простоя сессии в секундах, после которого она проверяется перед отправкой
+        :param rate:            Максимальная скорость отправки в сообщениях в секунду (0 - без ограничения)
+        :param hourly_limit:    Максимальное количество сообщений в час (0 - без ограничения)
         """
 
         # Настраиваем логгер
         self.logs_directory = logs_directory
         self.__logger = logging.getLogger(__name__)
         self.__logger.setLevel(logging.INFO)
-        logger_handler = logging.FileHandler(f"{logs_directory}/{__name__}.log", mode='a')
-        logger_formatter = logging.Formatter("%(name)s %(asctime)s %(levelname)s %(message)s")
-        logger_handler.setFormatter(logger_formatter)
-        self.__logger.addHandler(logger_handler)
+        # Логгер модуля общий для всех объектов - обработчик файла добавляется только один раз
+        log_filename = os.path.abspath(f"{logs_directory}/{__name__}.log")
+        if not any(getattr(handler, 'baseFilename', None) == log_filename for handler in self.__logger.handlers):
+            logger_handler = logging.FileHandler(log_filename, mode='a')
+            logger_formatter = logging.Formatter("%(name)s %(asctime)s %(levelname)s %(message)s")
+            logger_handler.setFormatter(logger_formatter)
+            self.__logger.addHandler(logger_handler)
 
         # Устанавливаем переменные объекта
         self.__address = address
@@ -132,44 +502,255 @@ class Mailer:
         self.__password = password
         self.__tls = tls
         self.__ssl = ssl
+        self.__session_limit = session_limit
+        self.__idle_timeout = idle_timeout
+        # Создаем пул соединений (последняя возвращенная сессия выдается первой, пока она "горячая")
+        self.__idle = queue.LifoQueue()
+        self.__slots = threading.BoundedSemaphore(pool_size)
+        # Создаем ограничитель скорости отправки
+        self.__limiter = RateLimiter(rate, hourly_limit)
+
+    def __enter__(self):
+        """
+        Вход в контекстный менеджер
+
+        :return: Объект класса
+        """
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Выход из контекстного менеджера
+
+        Закрывает все сессии пула
+        :return: None
+        """
+
+        self.close()
 
     def send(self, msg_path: str):
         """
         Отправка почты
 
-        Отправляет почту из файла почтового сообщения
+        Отправляет почту из файла почтового сообщения через сессию из пула
         :param msg_path: Путь до файла почтового сообщения
-        :return: True в случае успешной отправки и объект SMTPException в случае ошибки
+        :return: Результат отправки (истинен в случае успешной отправки)
         """
 
         try:
             # Загрузка сообщения из файла
             with open(msg_path, "r+b") as file:
                 message = BytesParser(policy=default).parse(file)
+        except FileNotFoundError as error:
+            self.__logger.error("File not found", exc_info=True)
+            return SendResult(False, error=str(error))
+        except IOError as error:
+            self.__logger.error(f"An error occurred while reading the file {msg_path}", exc_info=True)
+            return SendResult(False, error=str(error))
+
+        return self.__transmit(lambda server: server.send_message(message, message["From"], message["To"]))
+
+    def send_raw(self, sender: str, recipients, data: bytes):
+        """
+        Отправка сериализованного сообщения
+
+        Отправляет уже сериализованное сообщение (с окончаниями строк CRLF) без повторного разбора через сессию
+        из пула
+        :param sender:      Адрес отправителя (конверт)
+        :param recipients:  Адрес или список адресов получателей (конверт)
+        :param data:        Байты сообщения
+        :return: Результат отправки (истинен в случае успешной отправки)
+        """
+
+        return self.__transmit(lambda server: server.sendmail(sender, recipients, data))
 
-            # Установлен флаг SSL
+    def __transmit(self, action):
+        """
+        Передача сообщения серверу
+
+        Выполняет передачу сообщения через сессию из пула с учетом ограничителя скорости. При разрыве соединения
+        или ответе сервера 421 сессия закрывается и передача повторяется один раз через новое соединение
+        :param action: Функция передачи, принимающая соединение с сервером
+        :return: Результат отправки (истинен в случае успешной отправки)
+        """
+
+        for attempt in range(2):
+            # Дожидаемся разрешения ограничителя скорости
+            with metrics.timer('rate_wait'):
+                self.__limiter.acquire()
+            # Получаем сессию из пула
+            try:
+                session = self.__acquire()
+            except (smtplib.SMTPException, OSError) as error:
+                self.__logger.error("SMTP connection error occurred", exc_info=True)
+                result = SendResult.from_error(error)
+                self.__limiter.update(result)
+                return result
+
+            try:
+                # Отправка сообщения
+                with metrics.timer('smtp_send'):
+                    action(session.server)
+            except (smtplib.SMTPException, OSError) as error:
+                result = SendResult.from_error(error)
+                self.__limiter.update(result)
+                if self.__is_disconnect(error):
+                    # Соединение потеряно - закрываем сессию и повторяем отправку через новую
+                    self.__release(session, False)
+                    if attempt == 0:
+                        continue
+                    self.__logger.error("SMTP connection lost", exc_info=True)
+                    return result
+                # Ошибка транзакции - сессия остается рабочей
+                self.__release(session, True)
+                self.__logger.error("SMTP error occurred", exc_info=True)
+                return result
+
+            # Возвращаем сессию в пул
+            session.count += 1
+            self.__release(session, True)
+            result = SendResult(True, 250)
+            self.__limiter.update(result)
+            return result
+
+        return SendResult(False, transient=True)
+
+    def rate(self):
+        """
+        Текущая скорость отправки
+
+        :return: Текущая скорость в сообщениях в секунду (0 - без ограничения)
+        """
+
+        return self.__limiter.rate()
+
+    def close(self):
+        """
+        Закрытие пула соединений
+
+        Закрывает все простаивающие сессии пула
+        :return: None
+        """
+
+        while True:
+            try:
+                session = self.__idle.get_nowait()
+            except queue.Empty:
+                break
+            self.__drop(session)
+
+    def __connect(self):
+        """
+        Открытие новой сессии
+
+        Подключается к серверу и проходит авторизацию
+        :return: Новая сессия
+        """
+
+        # Установлен флаг SSL
+        with metrics.timer('smtp_connect'):
             if self.__ssl:
                 server = smtplib.SMTP_SSL(self.__address, self.__port)
             else:
                 server = smtplib.SMTP(self.__address, self.__port)
+        try:
             # Установлен флаг STARTTLS
             if self.__tls:
-                server.starttls()
-
+                with metrics.timer('smtp_starttls'):
+                    server.starttls()
             # Вход на сервер
-            server.login(self.__user, self.__password)
-            # Отправка сообщения
-            server.send_message(message, message["From"], message["To"])
-            # Выход
-            server.quit()
+            with metrics.timer('smtp_login'):
+                server.login(self.__user, self.__password)
+        except BaseException:
+            server.close()
+            raise
+
+        return SMTPSession(server)
 
+    def __acquire(self):
+        """
+        Получение сессии из пула
+
+        Выдает простаивающую сессию из пула или открывает новую, если свободных сессий нет. Сессия, простаивавшая
+        дольше допустимого времени, проверяется командой NOOP. Блокируется, пока количество открытых сессий равно
+        размеру пула
+        :return: Сессия
+        """
+
+        self.__slots.acquire()
+        try:
+            while True:
+                try:
+                    session = self.__idle.get_nowait()
+                except queue.Empty:
+                    return self.__connect()
+                # Проверяем сессию, если она долго простаивала
+                if time.monotonic() - session.used < self.__idle_timeout:
+                    return session
+                try:
+                    if session.server.noop()[0] == 250:
+                        return session
+                except (smtplib.SMTPException, OSError):
+                    pass
+                self.__drop(session)
+        except BaseException:
+            self.__slots.release()
+            raise
+
+    def __release(self, session: SMTPSession, reusable: bool):
+        """
+        Возврат сессии в пул
+
+        Сбрасывает состояние транзакции командой RSET и возвращает сессию в пул. Сессия закрывается, если она
+        непригодна для дальнейшей работы или исчерпала лимит сообщений
+        :param session:     Сессия
+        :param reusable:    Признак пригодности сессии для дальнейшей работы
+        :return: None
+        """
+
+        try:
+            if reusable and session.count < self.__session_limit:
+                try:
+                    session.server.rset()
+                    session.used = time.monotonic()
+                    self.__idle.put(session)
+                    return
+                except (smtplib.SMTPException, OSError):
+                    pass
+            self.__drop(session)
+        finally:
+            self.__slots.release()
+
+    def __drop(self, session: SMTPSession):
+        """
+        Закрытие сессии
+
+        Завершает сессию командой QUIT, а если сервер недоступен - просто закрывает сокет
+        :param session: Сессия
+        :return: None
+        """
+
+        try:
+            session.server.quit()
+        except (smtplib.SMTPException, OSError):
+            session.server.close()
+
+    @staticmethod
+    def __is_disconnect(error: Exception):
+        """
+        Проверка ошибки на разрыв соединения
+
+        Определяет, вызвана ли ошибка потерей соединения (обрыв связи или ответ сервера 421)
+        :param error: Исключение
+        :return: True, если соединение больше не пригодно для работы
+        """
+
+        if isinstance(error, smtplib.SMTPServerDisconnected):
             return True
-        except smtplib.SMTPException:
-            self.__logger.error("SMTP error occurred", exc_info=True)
-            return False
-        except FileNotFoundError:
-            self.__logger.error("File not found", exc_info=True)
-            return False
-        except IOError:
-            self.__logger.error(f"An error occurred while reading the file {msg_path}", exc_info=True)
-            return False
\ No newline at end of file
+        if isinstance(error, smtplib.SMTPResponseException):
+            return error.smtp_code == 421
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return any(code == 421 for code, _ in error.recipients.values())
+        # Прочие ошибки сокета
+        return not isinstance(error, smtplib.SMTPException)
@@ -0,0 +1,445 @@
+# Imports
+import bisect
+import contextlib
+import http.server
+import logging
+import os
+import threading
+import time
+
+# Defines
+class Histogram:
+    """
+    Класс гистограммы времени этапа
+
+    Объект класса накапливает количество и сумму замеров и распределение по фиксированным границам (как гистограмма
+    Prometheus). Перцентили оцениваются линейной интерполяцией внутри интервала
+
+    Методы
+    ----------------
+        __init__(self)
+            Конструктор: Инициализация
+        observe(self, value: float)
+            Добавление замера
+        quantile(self, q: float)
+            Оценка перцентиля
+    Атрибуты
+    ----------------
+        :cvar {tuple} BUCKETS:  Верхние границы интервалов в секундах
+        :ivar {list} buckets:   Количество замеров в каждом интервале (последний - сверх верхней границы)
+        :ivar {int} count:      Количество замеров
+        :ivar {float} sum:      Сумма замеров в секундах
+        :ivar {float} max:      Наибольший замер в секундах
+    """
+
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        """
+        Конструктор: Инициализация
+        """
+
+        self.buckets = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        """
+        Добавление замера
+
+        :param value: Время в секундах
+        :return: None
+        """
+
+        self.buckets[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float):
+        """
+        Оценка перцентиля
+
+        :param q: Уровень (0..1)
+        :return: Оценка времени в секундах
+        """
+
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            if seen + count >= rank and count:
+                lower = self.BUCKETS[i - 1] if i > 0 else 0.0
+                upper = self.BUCKETS[i] if i < len(self.BUCKETS) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+class Metrics:
+    """
+    Класс метрик работы
+
+    Объект класса собирает время этапов обработки (гистограммы) и счетчики событий (отправлено, ошибки, повторы,
+    попадания в кеши). Выключенный объект ничего не считает: таймер возвращает общий пустой контекстный менеджер,
+    а обертка итератора возвращает сам итератор. Метрики выгружаются в текстовом формате Prometheus в файл (для
+    textfile collector) или через локальный HTTP-сервер, по завершении работы выводится сводная таблица.
+    Значения, которые удобнее получить в момент выгрузки (например, счетчики хранилища шаблонов), задаются
+    функциями-сборщиками
+
+    Методы
+    ----------------
+        __init__(self)
+            Конструктор: Инициализация
+        enable(self)
+            Включение сбора метрик
+        reset(self)
+            Сброс накопленных метрик
+        timer(self, stage: str)
+            Замер времени этапа
+        observe(self, stage: str, seconds: float)
+            Добавление замера времени этапа
+        timed(self, iterable, stage: str)
+            Замер времени получения элементов итератора
+        __timed(self, iterator, stage: str)
+            Генератор замера времени получения элементов
+        inc(self, event: str, value: int = 1)
+            Увеличение счетчика события
+        collector(self, function)
+            Добавление функции-сборщика
+        export(self)
+            Выгрузка в текстовом формате Prometheus
+        write(self, filename: str)
+            Запись выгрузки в файл
+        serve(self, port: int, address: str = "127.0.0.1")
+            Запуск HTTP-сервера выгрузки
+        summary(self)
+            Сводная таблица
+        stats(self)
+            Значения метрик
+        close(self)
+            Остановка HTTP-сервера
+        __snapshot(self)
+            Копия метрик
+    Атрибуты
+    ----------------
+        :cvar {str} PREFIX:         Префикс имен метрик
+        :cvar {any} NULL:           Пустой контекстный менеджер выключенного таймера
+        :ivar {bool} enabled:       Признак включенного сбора метрик
+        :ivar {dict} __stages:      Гистограммы этапов {этап: Histogram}
+        :ivar {dict} __events:      Счетчики событий {событие: значение}
+        :ivar {list} __collectors:  Функции-сборщики, возвращающие словарь {событие: значение}
+        :ivar {float} __started:    Время включения
+        :ivar {any} __lock:         Блокировка доступа к метрикам
+        :ivar {any} __server:       HTTP-сервер выгрузки
+    """
+
+    PREFIX = "mailer"
+    NULL = contextlib.nullcontext()
+
+    def __init__(self):
+        """
+        Конструктор: Инициализация
+        """
+
+        self.enabled = False
+        self.__stages = dict()
+        self.__events = dict()
+        self.__collectors = list()
+        self.__started = time.time()
+        self.__lock = threading.Lock()
+        self.__server = None
+
+    def enable(self):
+        """
+        Включение сбора метрик
+
+        :return: None
+        """
+
+        self.enabled = True
+        self.__started = time.time()
+
+    def reset(self):
+        """
+        Сброс накопленных метрик
+
+        Очищает гистограммы этапов и счетчики событий (например, между прогонами замера)
+        :return: None
+        """
+
+        with self.__lock:
+            self.__stages.clear()
+            self.__events.clear()
+        self.__started = time.time()
+
+    def timer(self, stage: str):
+        """
+        Замер времени этапа
+
+        :param stage: Имя этапа
+        :return: Контекстный менеджер, замеряющий время выполнения блока
+        """
+
+        if not self.enabled:
+            return self.NULL
+        return _Timer(self, stage)
+
+    def observe(self, stage: str, seconds: float):
+        """
+        Добавление замера времени этапа
+
+        :param stage:   Имя этапа
+        :param seconds: Время в секундах
+        :return: None
+        """
+
+        with self.__lock:
+            histogram = self.__stages.get(stage)
+            if histogram is None:
+                histogram = self.__stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def timed(self, iterable, stage: str):
+        """
+        Замер времени получения элементов итератора
+
+        Используется для генераторов, работа которых выполняется при запросе очередного элемента
+        :param iterable:    Итерируемый объект
+        :param stage:       Имя этапа
+        :return: Итератор с замером или исходный объект, если сбор метрик выключен
+        """
+
+        if not self.enabled:
+            return iterable
+        return self.__timed(iter(iterable), stage)
+
+    def __timed(self, iterator, stage: str):
+        """
+        Генератор замера времени получения элементов
+
+        :param iterator:    Итератор
+        :param stage:       Имя этапа
+        :return: Элементы итератора
+        """
+
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(stage, time.perf_counter() - started)
+            yield item
+
+    def inc(self, event: str, value: int = 1):
+        """
+        Увеличение счетчика события
+
+        :param event:   Имя события
+        :param value:   Приращение
+        :return: None
+        """
+
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.__events[event] = self.__events.get(event, 0) + value
+
+    def collector(self, function):
+        """
+        Добавление функции-сборщика
+
+        :param function: Функция без аргументов, возвращающая словарь {событие: значение}
+        :return: None
+        """
+
+        self.__collectors.append(function)
+
+    def export(self):
+        """
+        Выгрузка в текстовом формате Prometheus
+
+        :return: Текст выгрузки
+        """
+
+        stages, events = self.__snapshot()
+        lines = [f"# HELP {self.PREFIX}_stage_seconds Time spent in a pipeline stage",
+                 f"# TYPE {self.PREFIX}_stage_seconds histogram"]
+        for stage, histogram in sorted(stages.items()):
+            cumulative = 0
+            for bound, count in zip(Histogram.BUCKETS + ("+Inf",), histogram.buckets):
+                cumulative += count
+                lines.append(f'{self.PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.PREFIX}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'{self.PREFIX}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        lines += [f"# HELP {self.PREFIX}_events_total Pipeline events",
+                  f"# TYPE {self.PREFIX}_events_total counter"]
+        for event, value in sorted(events.items()):
+            lines.append(f'{self.PREFIX}_events_total{{event="{event}"}} {value}')
+        lines += [f"# HELP {self.PREFIX}_start_time_seconds Start time of the run",
+                  f"# TYPE {self.PREFIX}_start_time_seconds gauge",
+                  f"{self.PREFIX}_start_time_seconds {self.__started}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename: str):
+        """
+        Запись выгрузки в файл
+
+        Файл заменяется атомарно, чтобы сборщик не прочитал его частично
+        :param filename: Имя файла
+        :return: None
+        """
+
+        try:
+            with open(filename + ".tmp", 'w', encoding='utf-8') as file:
+                file.write(self.export())
+            os.replace(filename + ".tmp", filename)
+        except OSError:
+            logging.error(f"Metrics file {filename} could not be written", exc_info=True)
+
+    def serve(self, port: int, address: str = "127.0.0.1"):
+        """
+        Запуск HTTP-сервера выгрузки
+
+        Сервер отдает выгрузку по любому пути GET-запроса (обычно /metrics)
+        :param port:    Порт
+        :param address: Адрес
+        :return: None
+        """
+
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.export().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = http.server.ThreadingHTTPServer((address, port), Handler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, name="metrics", daemon=True).start()
+
+    def summary(self):
+        """
+        Сводная таблица
+
+        :return: Текст таблицы этапов (количество, сумма, среднее, p50, p99, максимум) и счетчиков событий
+        """
+
+        stages, events = self.__snapshot()
+        lines = [f"{'stage':<16} {'count':>9} {'total, s':>10} {'mean, ms':>10} {'p50, ms':>9} {'p99, ms':>9} "
+                 f"{'max, ms':>9}"]
+        for stage, histogram in sorted(stages.items(), key=lambda item: -item[1].sum):
+            lines.append(f"{stage:<16} {histogram.count:>9} {histogram.sum:>10.3f} "
+                         f"{histogram.sum / histogram.count * 1000:>10.3f} {histogram.quantile(0.5) * 1000:>9.3f} "
+                         f"{histogram.quantile(0.99) * 1000:>9.3f} {histogram.max * 1000:>9.3f}")
+        for event, value in sorted(events.items()):
+            lines.append(f"{event:<16} {value:>9}")
+        return "\n".join(lines)
+
+    def stats(self):
+        """
+        Значения метрик
+
+        :return: Словарь {stages: {этап: {count, mean, p50, p99, max}}, events: {событие: значение}}, время в
+                 миллисекундах
+        """
+
+        stages, events = self.__snapshot()
+        return {'stages': {stage: {'count': histogram.count, 'mean': histogram.sum / histogram.count * 1000,
+                                   'p50': histogram.quantile(0.5) * 1000, 'p99': histogram.quantile(0.99) * 1000,
+                                   'max': histogram.max * 1000}
+                           for stage, histogram in stages.items() if histogram.count},
+                'events': events}
+
+    def close(self):
+        """
+        Остановка HTTP-сервера
+
+        :return: None
+        """
+
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def __snapshot(self):
+        """
+        Копия метрик
+
+        :return: Кортеж (гистограммы этапов, счетчики событий с учетом функций-сборщиков)
+        """
+
+        with self.__lock:
+            stages = dict(self.__stages)
+            events = dict(self.__events)
+        for function in self.__collectors:
+            events.update(function())
+        return stages, events
+
+class _Timer:
+    """
+    Класс таймера этапа
+
+    Контекстный менеджер, добавляющий время выполнения блока в гистограмму этапа
+
+    Методы
+    ----------------
+        __init__(self, metrics: Metrics, stage: str)
+            Конструктор: Инициализация
+        __enter__(self)
+            Начало замера
+        __exit__(self, exc_type, exc_val, exc_tb)
+            Окончание замера
+    Атрибуты
+    ----------------
+        :ivar {Metrics} __metrics:  Метрики
+        :ivar {str} __stage:        Имя этапа
+        :ivar {float} __started:    Время начала замера
+    """
+
+    __slots__ = ('__metrics', '__stage', '__started')
+
+    def __init__(self, metrics: Metrics, stage: str):
+        """
+        Конструктор: Инициализация
+
+        :param metrics: Метрики
+        :param stage:   Имя этапа
+        """
+
+        self.__metrics = metrics
+        self.__stage = stage
+        self.__started = 0.0
+
+    def __enter__(self):
+        """
+        Начало замера
+
+        :return: Объект класса
+        """
+
+        self.__started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Окончание замера
+
+        :return: None
+        """
+
+        self.__metrics.observe(self.__stage, time.perf_counter() - self.__started)
+
+# Общий объект метрик (выключен, пока не вызван enable)
+metrics = Metrics()
@@ -0,0 +1,229 @@
+# Imports
+import json
+import logging
+import threading
+import time
+from services.mailer import Mailer, SendResult
+
+
+# Defines
+class RelayPool:
+    """
+    Класс пула серверов отправки
+
+    Объект класса распределяет сообщения между несколькими серверами (учетными записями) отправки почты
+    пропорционально их весам (плавный взвешенный циклический выбор). У каждого сервера свой пул соединений и свои
+    ограничения скорости. Сервер, подряд отвечающий ошибками уровня сервера (разрыв соединения, коды 4xx, ошибка
+    авторизации), исключается из выбора на время охлаждения, а сообщение отправляется через следующий сервер.
+    Отказ конкретному получателю (коды 5xx) на другой сервер не переносится. Интерфейс отправки совпадает с Mailer
+
+    Методы
+    ----------------
+        __init__(self, relays: list, logs_directory: str, pool_size: int = 1, session_limit: int = 100,
+                 max_failures: int = 3, cooldown: float = 60)
+            Конструктор: Инициализация
+        load(filename: str, logs_directory: str, pool_size: int = 1, session_limit: int = 100)
+            Создание пула по файлу настроек
+        __enter__(self)
+            Вход в контекстный менеджер
+        __exit__(self, exc_type, exc_val, exc_tb)
+            Выход из контекстного менеджера
+        send(self, msg_path: str)
+            Отправка почты
+        send_raw(self, sender: str, recipients, data: bytes)
+            Отправка сериализованного сообщения
+        rate(self)
+            Текущая суммарная скорость отправки
+        close(self)
+            Закрытие пулов соединений всех серверов
+        __dispatch(self, send)
+            Отправка через выбранные серверы с переходом на следующий при отказе
+        __select(self, tried: set)
+            Выбор сервера
+        __report(self, relay: dict, result: SendResult)
+            Учет результата отправки через сервер
+    Атрибуты
+    ----------------
+        :cvar {set} RELAY_CODES:        Постоянные коды ответа, означающие отказ сервера, а не получателя
+        :ivar {list} __relays:          Серверы {name, mailer, weight, current, failures, down}
+        :ivar {int} __max_failures:     Количество ошибок подряд, после которого сервер исключается из выбора
+        :ivar {float} __cooldown:       Время исключения сервера из выбора в секундах
+        :ivar {any} __lock:             Блокировка доступа к состоянию серверов
+    """
+
+    RELAY_CODES = {530, 534, 535, 554}
+
+    def __init__(self, relays: list, logs_directory: str, pool_size: int = 1, session_limit: int = 100,
+                 max_failures: int = 3, cooldown: float = 60):
+        """
+        Конструктор: Инициализация
+
+        Создает объект отправки почты для каждого сервера. Настройки сервера: address, port, login, password,
+        tls, ssl, name, weight, pool_size, session_limit, rate, hourly_limit (обязателен только address)
+        :param relays:          Список настроек серверов
+        :param logs_directory:  Директория для лога
+        :param pool_size:       Размер пула соединений сервера по умолчанию
+        :param session_limit:   Максимальное количество сообщений на одну сессию по умолчанию
+        :param max_failures:    Количество ошибок подряд, после которого сервер исключается из выбора
+        :param cooldown:        Время исключения сервера из выбора в секундах
+        """
+
+        if not relays:
+            raise ValueError("Relay pool is empty")
+        self.__relays = list()
+        for config in relays:
+            mailer = Mailer(config['address'], config.get('port', 465), config.get('login', ""),
+                            config.get('password', ""), logs_directory, config.get('tls', False),
+                            config.get('ssl', True), config.get('pool_size', pool_size),
+                            config.get('session_limit', session_limit),
+                            rate=config.get('rate', 0), hourly_limit=config.get('hourly_limit', 0))
+            name = config.get('name', f"{config.get('login', '')}@{config['address']}:{config.get('port', 465)}")
+            self.__relays.append({'name': name, 'mailer': mailer, 'weight': max(1, config.get('weight', 1)),
+                                  'current': 0, 'failures': 0, 'down': 0.0})
+        self.__max_failures = max_failures
+        self.__cooldown = cooldown
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def load(filename: str, logs_directory: str, pool_size: int = 1, session_limit: int = 100):
+        """
+        Создание пула по файлу настроек
+
+        :param filename:        Файл JSON со списком настроек серверов
+        :param logs_directory:  Директория для лога
+        :param pool_size:       Размер пула соединений сервера по умолчанию
+        :param session_limit:   Максимальное количество сообщений на одну сессию по умолчанию
+        :return: Пул серверов
+        """
+
+        with open(filename, 'r', encoding='utf-8') as file:
+            relays = json.load(file)
+        return RelayPool(relays, logs_directory, pool_size, session_limit)
+
+    def __enter__(self):
+        """
+        Вход в контекстный менеджер
+
+        :return: Объект класса
+        """
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Выход из контекстного менеджера
+
+        Закрывает пулы соединений всех серверов
+        :return: None
+        """
+
+        self.close()
+
+    def send(self, msg_path: str):
+        """
+        Отправка почты
+
+        :param msg_path: Путь до файла почтового сообщения
+        :return: Результат отправки с именем сервера
+        """
+
+        return self.__dispatch(lambda mailer: mailer.send(msg_path))
+
+    def send_raw(self, sender: str, recipients, data: bytes):
+        """
+        Отправка сериализованного сообщения
+
+        :param sender:      Адрес отправителя (конверт)
+        :param recipients:  Адрес или список адресов получателей (конверт)
+        :param data:        Байты сообщения
+        :return: Результат отправки с именем сервера
+        """
+
+        return self.__dispatch(lambda mailer: mailer.send_raw(sender, recipients, data))
+
+    def rate(self):
+        """
+        Текущая суммарная скорость отправки
+
+        :return: Сумма текущих скоростей серверов в сообщениях в секунду (0 - без ограничения)
+        """
+
+        rates = [relay['mailer'].rate() for relay in self.__relays]
+        return 0 if not all(rates) else sum(rates)
+
+    def close(self):
+        """
+        Закрытие пулов соединений всех серверов
+
+        :return: None
+        """
+
+        for relay in self.__relays:
+            relay['mailer'].close()
+
+    def __dispatch(self, send):
+        """
+        Отправка через выбранные серверы с переходом на следующий при отказе
+
+        Каждый сервер пробуется не более одного раза
+        :param send: Функция отправки, принимающая объект отправки почты сервера
+        :return: Результат последней попытки отправки
+        """
+
+        tried = set()
+        result = SendResult(False, error="No relay available", transient=True)
+        while (relay := self.__select(tried)) is not None:
+            tried.add(relay['name'])
+            result = send(relay['mailer'])
+            result.relay = relay['name']
+            if not self.__report(relay, result):
+                return result
+            if len(tried) < len(self.__relays):
+                logging.warning(f"Relay {relay['name']} failed with code {result.code}, trying the next one")
+        return result
+
+    def __select(self, tried: set):
+        """
+        Выбор сервера
+
+        Плавный взвешенный циклический выбор среди доступных серверов, которые еще не пробовались для этого
+        сообщения. Если доступных серверов не осталось, выбираются серверы на охлаждении
+        :param tried: Имена серверов, уже опробованных для сообщения
+        :return: Настройки сервера или None, если все серверы опробованы
+        """
+
+        now = time.monotonic()
+        with self.__lock:
+            candidates = [relay for relay in self.__relays if relay['name'] not in tried]
+            candidates = [relay for relay in candidates if relay['down'] <= now] or candidates
+            if not candidates:
+                return None
+            total = 0
+            for relay in candidates:
+                relay['current'] += relay['weight']
+                total += relay['weight']
+            selected = max(candidates, key=lambda relay: relay['current'])
+            selected['current'] -= total
+            return selected
+
+    def __report(self, relay: dict, result: SendResult):
+        """
+        Учет результата отправки через сервер
+
+        Считает ошибки сервера подряд и при превышении порога исключает сервер из выбора на время охлаждения
+        :param relay:   Настройки сервера
+        :param result:  Результат отправки
+        :return: True, если ошибка относится к серверу и сообщение нужно отправить через другой
+        """
+
+        relay_failure = not result and (result.transient or result.code in self.RELAY_CODES)
+        with self.__lock:
+            if not relay_failure:
+                relay['failures'] = 0
+                return False
+            relay['failures'] += 1
+            if relay['failures'] >= self.__max_failures and relay['down'] <= time.monotonic():
+                relay['down'] = time.monotonic() + self.__cooldown
+                logging.error(f"Relay {relay['name']} failed {relay['failures']} times in a row, "
+                              f"excluded for {self.__cooldown} s")
+        return True
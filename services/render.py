@@ -0,0 +1,254 @@
+# Imports
+import itertools
+import logging
+import multiprocessing
+from collections import deque
+from services.assets import AssetCache
+from services.bodies import BodyCache
+from services.mailer import build, body, header, assemble
+from services.metrics import metrics
+
+# Defines
+# Кеш закодированных вложений и кеш тел сообщений рабочего процесса
+worker_assets = None
+worker_bodies = None
+
+def init_worker(assets_capacity: int, bodies_capacity: int = 0):
+    """
+    Инициализация рабочего процесса
+
+    Создает кеш закодированных вложений и кеш тел сообщений рабочего процесса
+    :param assets_capacity: Максимальный объем кеша вложений в байтах
+    :param bodies_capacity: Максимальный объем кеша тел в байтах (0 - тела не кешируются)
+    :return: None
+    """
+
+    global worker_assets, worker_bodies
+    worker_assets = AssetCache(assets_capacity)
+    worker_bodies = BodyCache(bodies_capacity) if bodies_capacity else None
+
+def build_batch(items: list):
+    """
+    Сборка пакета сообщений
+
+    Выполняется в рабочем процессе: собирает тела и заголовки получателей из пакета заданий на сборку. Одинаковые
+    тела - это один объект, поэтому в основной процесс каждое тело пакета передается один раз
+    :param items: Список аргументов функции build
+    :return: Список троек (заголовок получателя, хеш тела, тело) в том же порядке
+    """
+
+    return [(header(item[1]), *body(item[0], *item[2:], assets=worker_assets, bodies=worker_bodies))
+            for item in items]
+
+class RenderPool:
+    """
+    Класс стадии сборки сообщений
+
+    Объект класса собирает почтовые сообщения из обработанных текстов получателей. В последовательном режиме
+    сборка выполняется в текущем процессе, в параллельном - пакетами в пуле рабочих процессов. Количество пакетов
+    в работе ограничено, поэтому получатели считываются по мере сборки, а порядок сообщений сохраняется.
+    Параллельный режим доступен только на платформах с запуском процессов через fork - иначе используется
+    последовательный
+
+    Методы
+    ----------------
+        __init__(self, files_directory: str, assets: AssetCache, workers: int = 0, batch_size: int = 32,
+                 bodies: BodyCache = None)
+            Конструктор: Инициализация
+        __enter__(self)
+            Вход в контекстный менеджер
+        __exit__(self, exc_type, exc_val, exc_tb)
+            Выход из контекстного менеджера (остановка рабочих процессов)
+        render(self, task: dict, recipients)
+            Сборка сообщений задания (генератор)
+        mix(self, items, fail = None)
+            Сборка сообщений нескольких заданий (генератор)
+        close(self)
+            Остановка рабочих процессов
+        __arguments(self, task: dict, rcpt: str, content: dict)
+            Аргументы сборки сообщения
+        __build(self, key, arguments: tuple, failed: set, fail)
+            Сборка сообщения в текущем процессе
+        __collect(self, result, arguments: list, contents: list, failed: set, fail)
+            Получение собранного пакета (генератор)
+    Атрибуты
+    ----------------
+        :ivar {str} __files_directory:  Директория c прикрепляемыми файлами
+        :ivar {any} __assets:           Кеш закодированных вложений (последовательный режим)
+        :ivar {any} __bodies:           Кеш тел сообщений (последовательный режим, None - без кеша)
+        :ivar {int} __workers:          Количество рабочих процессов
+        :ivar {int} __batch_size:       Количество сообщений в пакете
+        :ivar {any} __pool:             Пул рабочих процессов (None в последовательном режиме)
+    """
+
+    def __init__(self, files_directory: str, assets: AssetCache, workers: int = 0, batch_size: int = 32,
+                 bodies: BodyCache = None):
+        """
+        Конструктор: Инициализация
+
+        Запускает рабочие процессы. Объект следует создавать до запуска потоков программы
+        :param files_directory: Директория c прикрепляемыми файлами
+        :param assets:          Кеш закодированных вложений
+        :param workers:         Количество рабочих процессов (0 - последовательная сборка)
+        :param batch_size:      Количество сообщений в пакете
+        :param bodies:          Кеш тел сообщений (получатели с одинаковым содержимым получают одно тело)
+        """
+
+        self.__files_directory = files_directory
+        self.__assets = assets
+        self.__bodies = bodies
+        self.__workers = workers
+        self.__batch_size = batch_size
+        self.__pool = None
+
+        if workers > 0:
+            if "fork" in multiprocessing.get_all_start_methods():
+                self.__pool = multiprocessing.get_context("fork").Pool(workers, init_worker,
+                                                                       (assets.capacity(),
+                                                                        bodies.capacity() if bodies else 0))
+            else:
+                logging.warning("Render workers require fork start method, messages are built serially")
+
+    def __enter__(self):
+        """
+        Вход в контекстный менеджер
+
+        :return: Объект класса
+        """
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Выход из контекстного менеджера
+
+        :return: None
+        """
+
+        self.close()
+
+    def render(self, task: dict, recipients):
+        """
+        Сборка сообщений задания (генератор)
+
+        :param task:        Задание почтовой рассылки
+        :param recipients:  Обработанные получатели в виде пар (адрес, {subject, replaces, txt_body, html_body})
+        :return: Пары (сообщение, блок получателя) в порядке получателей
+        """
+
+        for _, message, content in self.mix((None, task, rcpt, content) for rcpt, content in recipients):
+            if message is not None:
+                yield message, content
+
+    def mix(self, items, fail = None):
+        """
+        Сборка сообщений нескольких заданий (генератор)
+
+        Получатели разных заданий могут идти вперемешку: параметры сборки (отправитель, изображения, вложения)
+        берутся из задания каждого получателя. Ошибка сборки сообщения завершает только его задание: остальные
+        сообщения этого задания не собираются (вместо них выдается None), а сборка сообщений других заданий
+        продолжается
+        :param items:   Четверки (метка, задание, адрес, {subject, replaces, txt_body, html_body}), метка
+                        (например, имя файла задания) возвращается вместе с сообщением
+        :param fail:    Функция, которая вызывается при ошибке сборки с меткой и описанием ошибки
+        :return: Тройки (метка, сообщение или None, блок получателя) в порядке получателей
+        """
+
+        # Обработка шаблонов выполняется при запросе очередного получателя
+        items = metrics.timed(items, 'render')
+        # Метки заданий, сборка сообщений которых завершилась ошибкой
+        failed = set()
+
+        # Последовательная сборка
+        if self.__pool is None:
+            for key, task, rcpt, content in items:
+                if key in failed:
+                    yield key, None, content
+                    continue
+                with metrics.timer('build'):
+                    message = self.__build(key, self.__arguments(task, rcpt, content), failed, fail)
+                yield key, message, content
+            return
+
+        # Параллельная сборка пакетами с ограниченным количеством пакетов в работе
+        window = deque()
+        for batch in itertools.batched(items, self.__batch_size):
+            arguments = [self.__arguments(task, rcpt, content) for _, task, rcpt, content in batch]
+            window.append((self.__pool.apply_async(build_batch, (arguments,)), arguments,
+                           [(key, content) for key, _, _, content in batch]))
+            if len(window) > self.__workers * 2:
+                yield from self.__collect(*window.popleft(), failed, fail)
+        while window:
+            yield from self.__collect(*window.popleft(), failed, fail)
+
+    def close(self):
+        """
+        Остановка рабочих процессов
+
+        :return: None
+        """
+
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+    def __arguments(self, task: dict, rcpt: str, content: dict):
+        """
+        Аргументы сборки сообщения
+
+        :param task:    Задание
+        :param rcpt:    Адрес получателя
+        :param content: Блок получателя {subject, replaces, txt_body, html_body}
+        :return: Кортеж аргументов функции build
+        """
+
+        return (task['from'], rcpt, content['subject'], content['txt_body'], content['html_body'],
+                self.__files_directory, task.get('images'), task.get('attachments'))
+
+    def __build(self, key, arguments: tuple, failed: set, fail):
+        """
+        Сборка сообщения в текущем процессе
+
+        :param key:         Метка задания
+        :param arguments:   Аргументы функции build
+        :param failed:      Метки заданий, сборка сообщений которых завершилась ошибкой (дополняется)
+        :param fail:        Функция, которая вызывается при ошибке сборки с меткой и описанием ошибки
+        :return: Сообщение или None при ошибке сборки
+        """
+
+        try:
+            return build(*arguments, assets=self.__assets, bodies=self.__bodies)
+        except Exception as error:
+            logging.error(f"Task {key}: message to {arguments[1]} could not be built, task skipped", exc_info=True)
+            failed.add(key)
+            if fail is not None:
+                fail(key, f"{type(error).__name__}: {error}")
+            return None
+
+    def __collect(self, result, arguments: list, contents: list, failed: set, fail):
+        """
+        Получение собранного пакета (генератор)
+
+        Если сборка пакета в рабочем процессе завершилась ошибкой, то сообщения пакета собираются заново в текущем
+        процессе по одному, чтобы ошибка затронула только задание сообщения, при сборке которого она произошла
+        :param result:      Результат сборки пакета в пуле
+        :param arguments:   Аргументы функции build для сообщений пакета
+        :param contents:    Пары (метка, блок получателя) для сообщений пакета
+        :param failed:      Метки заданий, сборка сообщений которых завершилась ошибкой
+        :param fail:        Функция, которая вызывается при ошибке сборки с меткой и описанием ошибки
+        :return: Тройки (метка, сообщение или None, блок получателя)
+        """
+
+        try:
+            with metrics.timer('build_wait'):
+                messages = result.get()
+        except Exception:
+            messages = None
+        for i, (key, content) in enumerate(contents):
+            if key in failed:
+                yield key, None, content
+            elif messages is not None:
+                yield key, assemble(arguments[i][0], arguments[i][1], *messages[i]), content
+            else:
+                yield key, self.__build(key, arguments[i], failed, fail), content
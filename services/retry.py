@@ -0,0 +1,178 @@
+# Imports
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+# Defines
+class RetryQueue:
+    """
+    Класс очереди повторной отправки
+
+    Объект класса хранит в базе SQLite сообщения из каталога bad/, отправка которых завершилась временной ошибкой
+    (коды 4xx, разрыв соединения), и время следующей попытки. Интервал между попытками растет экспоненциально и
+    случайно сокращается до половины (чтобы повторы не приходили на сервер одновременно). После исчерпания попыток
+    сообщение исключается из очереди. Сообщения с постоянной ошибкой (коды 5xx) в очередь не попадают. Вместе с
+    сообщением хранится его ключ истории отправки, чтобы успешный повтор был записан в историю
+
+    Методы
+    ----------------
+        __init__(self, mail_directory: str, max_attempts: int = 5, delay: float = 60, max_delay: float = 3600)
+            Конструктор: Инициализация
+        schedule(self, message: dict, result)
+            Планирование повторной отправки
+        complete(self, message_file: str)
+            Исключение отправленного сообщения
+        due(self, lease: float = 3600, read = None)
+            Сообщения, время повторной отправки которых наступило
+        count(self)
+            Количество сообщений в очереди
+        close(self)
+            Закрытие очереди
+        __backoff(self, attempt: int)
+            Интервал до следующей попытки
+    Атрибуты
+    ----------------
+        :cvar {str} INDEX:              Имя файла базы очереди
+        :ivar {str} __mail_directory:   Директория почтовых сообщений
+        :ivar {int} __max_attempts:     Максимальное количество повторных попыток
+        :ivar {float} __delay:          Интервал перед первой повторной попыткой в секундах
+        :ivar {float} __max_delay:      Максимальный интервал между попытками в секундах
+        :ivar {any} __db:               Соединение с базой очереди
+        :ivar {any} __lock:             Блокировка доступа к соединению
+    """
+
+    INDEX = "retry.db"
+
+    def __init__(self, mail_directory: str, max_attempts: int = 5, delay: float = 60, max_delay: float = 3600):
+        """
+        Конструктор: Инициализация
+
+        :param mail_directory:  Директория почтовых сообщений
+        :param max_attempts:    Максимальное количество повторных попыток
+        :param delay:           Интервал перед первой повторной попыткой в секундах
+        :param max_delay:       Максимальный интервал между попытками в секундах
+        """
+
+        self.__mail_directory = mail_directory
+        self.__max_attempts = max_attempts
+        self.__delay = delay
+        self.__max_delay = max_delay
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(mail_directory + self.INDEX, check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS retry (file TEXT PRIMARY KEY, sender TEXT NOT NULL, "
+                          "rcpt TEXT NOT NULL, attempt INTEGER NOT NULL, due REAL NOT NULL, code INTEGER)")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS retry_due ON retry (due)")
+        # База, созданная до хранения ключей истории, дополняется ключом
+        if "history" not in [column[1] for column in self.__db.execute("PRAGMA table_info(retry)")]:
+            self.__db.execute("ALTER TABLE retry ADD COLUMN history TEXT")
+        self.__db.commit()
+
+    def schedule(self, message: dict, result):
+        """
+        Планирование повторной отправки
+
+        Ставит сообщение в очередь после временной ошибки. При постоянной ошибке или исчерпании попыток сообщение
+        исключается из очереди и остается в каталоге bad/
+        :param message: Сообщение {file, from, to, attempt, history}
+        :param result:  Результат последней отправки
+        :return: True, если отправка будет повторена
+        """
+
+        attempt = message.get('attempt', 0) + 1
+        if not result.transient or attempt > self.__max_attempts:
+            if result.transient:
+                logging.error(f"Message file {message['file']} to {message['to']} was not sent after "
+                              f"{attempt} attempts, code {result.code}, retries exhausted")
+            self.complete(message['file'])
+            return False
+
+        due = time.time() + self.__backoff(attempt)
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO retry (file, sender, rcpt, attempt, due, code, history) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (message['file'], message['from'], message['to'], attempt, due, result.code,
+                               json.dumps(message['history']) if message.get('history') else None))
+            self.__db.commit()
+        return True
+
+    def complete(self, message_file: str):
+        """
+        Исключение отправленного сообщения
+
+        :param message_file: Имя файла почтового сообщения
+        :return: None
+        """
+
+        with self.__lock:
+            self.__db.execute("DELETE FROM retry WHERE file = ?", (message_file,))
+            self.__db.commit()
+
+    def due(self, lease: float = 3600, read = None):
+        """
+        Сообщения, время повторной отправки которых наступило
+
+        Читает сообщения из каталога bad/. Выданные сообщения откладываются на время аренды, чтобы не быть выданными
+        повторно, пока их отправка не завершится
+        :param lease:   Время аренды в секундах
+        :param read:    Функция чтения сообщения по имени файла и каталогу (services.spool.Spool.read), по умолчанию
+                        файл читается из каталога bad/ напрямую
+        :return: Список сообщений {file, from, to, data, attempt, source, history}
+        """
+
+        now = time.time()
+        with self.__lock:
+            rows = self.__db.execute("SELECT file, sender, rcpt, attempt, history FROM retry WHERE due <= ? "
+                                     "ORDER BY due", (now,)).fetchall()
+            self.__db.executemany("UPDATE retry SET due = ? WHERE file = ?", [(now + lease, row[0]) for row in rows])
+            self.__db.commit()
+
+        messages = list()
+        for message_file, sender, rcpt, attempt, history in rows:
+            try:
+                if read is not None:
+                    data = read(message_file, "bad/")
+                else:
+                    with open(self.__mail_directory + "bad/" + message_file, 'rb') as file:
+                        data = file.read()
+            except FileNotFoundError:
+                logging.error(f"Message file {message_file} not found in bad/, retry dropped")
+                self.complete(message_file)
+                continue
+            messages.append({'file': message_file, 'from': sender, 'to': rcpt, 'data': data, 'attempt': attempt,
+                             'source': "bad/", 'history': tuple(json.loads(history)) if history else None})
+        return messages
+
+    def count(self):
+        """
+        Количество сообщений в очереди
+
+        :return: Количество сообщений
+        """
+
+        with self.__lock:
+            return self.__db.execute("SELECT COUNT(*) FROM retry").fetchone()[0]
+
+    def close(self):
+        """
+        Закрытие очереди
+
+        :return: None
+        """
+
+        with self.__lock:
+            self.__db.close()
+
+    def __backoff(self, attempt: int):
+        """
+        Интервал до следующей попытки
+
+        Экспоненциальный интервал, ограниченный максимальным, со случайным сокращением до половины
+        :param attempt: Номер попытки (с 1)
+        :return: Интервал в секундах
+        """
+
+        delay = min(self.__max_delay, self.__delay * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
@@ -0,0 +1,476 @@
+# Imports
+import hashlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from services.metrics import metrics
+
+
+# Defines
+class Spool:
+    """
+    Класс каталога почтовых сообщений (спула)
+
+    Объект класса записывает копии почтовых сообщений в каталог out/ и переносит их в send/ или bad/ по результату
+    отправки. Операции выполняются фоновым потоком в порядке поступления, поэтому перенос файла всегда следует за
+    его записью, а поток отправки не ждет диска. Спул может быть выключен - тогда операции игнорируются.
+    Файлы раскладываются по подкаталогам по хешу имени (out/ab/cd/<файл>), чтобы каталоги не разрастались, и
+    записываются атомарно: во временный файл с последующим переименованием.
+    В режиме сегментов сообщения дописываются подряд в файлы сегментов (segments/<номер>.seg, новый сегмент
+    начинается по достижении размера), а положение и каталог каждого сообщения хранятся в индексе SQLite, поэтому
+    перенос сообщения - это изменение записи индекса. Сегмент сбрасывается на диск (fsync) и индекс фиксируется
+    один раз на пачку операций; запись индекса появляется только после сброса данных.
+    Тело, общее для получателей с одинаковым содержимым (services.bodies.BodyCache), хранится один раз: в файле
+    bodies/<хеш>.body или в сегменте с записью в таблице bodies индекса. Сообщение в этом случае хранится в виде
+    ссылки на тело и заголовка получателя, а при чтении собирается обратно
+
+    Методы
+    ----------------
+        __init__(self, mail_directory: str, enabled: bool = True, segments: bool = False,
+                 segment_size: int = 67108864, batch_size: int = 256)
+            Конструктор: Инициализация
+        __enter__(self)
+            Вход в контекстный менеджер (запуск фонового потока)
+        __exit__(self, exc_type, exc_val, exc_tb)
+            Выход из контекстного менеджера (остановка фонового потока)
+        start(self)
+            Запуск фонового потока
+        stop(self)
+            Остановка фонового потока
+        store(self, message_filename: str, data: bytes, body: str = None, head: int = 0)
+            Запись сообщения
+        move(self, message_filename: str, folder: str, source: str = "out/")
+            Перенос сообщения
+        read(self, message_filename: str, folder: str)
+            Чтение сообщения
+        path(self, folder: str, message_filename: str)
+            Путь к файлу сообщения
+        __work(self)
+            Цикл фонового потока
+        __apply(self, action: str, message_filename: str, argument)
+            Выполнение операции
+        __write(self, message_filename: str, data: bytes, body: str = None, head: int = 0)
+            Запись файла сообщения
+        __rename(self, message_filename: str, source: str, folder: str)
+            Перенос файла сообщения
+        __append(self, message_filename: str, data: bytes, body: str = None, head: int = 0)
+            Запись сообщения в сегмент
+        __body(self, body: str, data: bytes)
+            Запись тела в сегмент
+        __sync(self)
+            Сброс сегмента и фиксация индекса
+        __roll(self)
+            Начало нового сегмента
+        __directory(self, path: str)
+            Создание подкаталога
+    Атрибуты
+    ----------------
+        :cvar {str} INDEX:              Имя файла индекса сегментов
+        :cvar {bytes} REFERENCE:        Начало файла сообщения, хранящего ссылку на тело
+        :ivar {str} __mail_directory:   Директория почтовых сообщений
+        :ivar {bool} __enabled:         Признак включенного спула
+        :ivar {bool} __segments:        Признак режима сегментов
+        :ivar {int} __segment_size:     Размер сегмента в байтах, по достижении которого начинается новый
+        :ivar {int} __batch_size:       Максимальное количество операций в пачке
+        :ivar {any} __queue:            Очередь операций
+        :ivar {any} __worker:           Фоновый поток
+        :ivar {set} __directories:      Созданные подкаталоги
+        :ivar {any} __db:               Соединение с индексом сегментов (None в режиме файлов)
+        :ivar {any} __lock:             Блокировка доступа к индексу
+        :ivar {any} __segment:          Файл текущего сегмента
+        :ivar {int} __segment_id:       Номер текущего сегмента
+        :ivar {dict} __added:           Записи индекса, ожидающие фиксации
+                                        {файл: [сегмент, смещение, длина, каталог, хеш тела]}
+        :ivar {dict} __bodies:          Записи тел, ожидающие фиксации {хеш тела: (сегмент, смещение, длина)}
+        :ivar {set} __stored:           Хеши тел, уже записанных в спул
+        :ivar {list} __moved:           Переносы, ожидающие фиксации [(каталог, файл)]
+    """
+
+    INDEX = "spool.db"
+    REFERENCE = b"#body "
+
+    def __init__(self, mail_directory: str, enabled: bool = True, segments: bool = False,
+                 segment_size: int = 67108864, batch_size: int = 256):
+        """
+        Конструктор: Инициализация
+
+        :param mail_directory:  Директория почтовых сообщений (с подкаталогами out/, send/, bad/)
+        :param enabled:         Признак включенного спула
+        :param segments:        Признак режима сегментов
+        :param segment_size:    Размер сегмента в байтах
+        :param batch_size:      Максимальное количество операций, сбрасываемых на диск вместе
+        """
+
+        self.__mail_directory = mail_directory
+        self.__enabled = enabled
+        self.__segments = segments
+        self.__segment_size = segment_size
+        self.__batch_size = batch_size
+        self.__queue = queue.Queue()
+        self.__worker = None
+        self.__directories = set()
+        self.__db = None
+        self.__lock = threading.Lock()
+        self.__segment = None
+        self.__segment_id = 0
+        self.__added = dict()
+        self.__moved = list()
+        self.__bodies = dict()
+        self.__stored = set()
+
+        if enabled and segments:
+            os.makedirs(mail_directory + "segments/", exist_ok=True)
+            self.__db = sqlite3.connect(mail_directory + self.INDEX, check_same_thread=False)
+            self.__db.execute("CREATE TABLE IF NOT EXISTS messages (file TEXT PRIMARY KEY, segment INTEGER NOT NULL, "
+                              "offset INTEGER NOT NULL, length INTEGER NOT NULL, folder TEXT NOT NULL)")
+            self.__db.execute("CREATE INDEX IF NOT EXISTS messages_folder ON messages (folder)")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS bodies (digest TEXT PRIMARY KEY, segment INTEGER NOT NULL, "
+                              "offset INTEGER NOT NULL, length INTEGER NOT NULL)")
+            # Индекс, созданный до хранения общих тел, дополняется ссылкой на тело
+            if "body" not in [column[1] for column in self.__db.execute("PRAGMA table_info(messages)")]:
+                self.__db.execute("ALTER TABLE messages ADD COLUMN body TEXT")
+            self.__db.commit()
+            # Запись продолжается в новый сегмент: хвост прошлого мог остаться недописанным
+            self.__segment_id = max([int(name.removesuffix(".seg"))
+                                     for name in os.listdir(mail_directory + "segments/")
+                                     if name.endswith(".seg")], default=0)
+
+    def __enter__(self):
+        """
+        Вход в контекстный менеджер
+
+        :return: Объект класса
+        """
+
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Выход из контекстного менеджера
+
+        Дожидается выполнения всех операций и останавливает фоновый поток
+        :return: None
+        """
+
+        self.stop()
+
+    def start(self):
+        """
+        Запуск фонового потока
+
+        :return: None
+        """
+
+        if self.__enabled and self.__worker is None:
+            self.__worker = threading.Thread(target=self.__work, name="spool", daemon=True)
+            self.__worker.start()
+
+    def stop(self):
+        """
+        Остановка фонового потока
+
+        :return: None
+        """
+
+        if self.__worker is not None:
+            self.__queue.put(None)
+            self.__worker.join()
+            self.__worker = None
+        if self.__segment is not None:
+            self.__segment.close()
+            self.__segment = None
+        if self.__db is not None:
+            with self.__lock:
+                self.__db.close()
+            self.__db = None
+
+    def store(self, message_filename: str, data: bytes, body: str = None, head: int = 0):
+        """
+        Запись сообщения
+
+        Ставит в очередь запись копии сообщения в каталог out/. Если задан хеш тела, то тело (data без первых head
+        байт) записывается один раз для всех сообщений с этим хешем
+        :param message_filename:    Имя файла почтового сообщения
+        :param data:                Байты сообщения
+        :param body:                Хеш общего тела сообщения (None - сообщение хранится целиком)
+        :param head:                Длина заголовка получателя в начале сообщения
+        :return: None
+        """
+
+        if self.__enabled:
+            self.__queue.put(('store', message_filename, (data, body, head)))
+
+    def move(self, message_filename: str, folder: str, source: str = "out/"):
+        """
+        Перенос сообщения
+
+        Ставит в очередь перенос файла сообщения из исходного каталога (по умолчанию out/) в указанный каталог
+        :param message_filename:    Имя файла почтового сообщения
+        :param folder:              Каталог назначения (send/ или bad/)
+        :param source:              Исходный каталог (bad/ для повторной отправки)
+        :return: None
+        """
+
+        if self.__enabled and folder != source:
+            self.__queue.put(('move', message_filename, (source, folder)))
+
+    def read(self, message_filename: str, folder: str):
+        """
+        Чтение сообщения
+
+        Читает сообщение, запись и перенос которого уже выполнены фоновым потоком
+        :param message_filename:    Имя файла почтового сообщения
+        :param folder:              Каталог сообщения
+        :return: Байты сообщения
+        """
+
+        if self.__db is None:
+            try:
+                with open(self.path(folder, message_filename), 'rb') as file:
+                    data = file.read()
+            except FileNotFoundError:
+                # Файл, записанный до разбиения каталогов на подкаталоги
+                with open(self.__mail_directory + folder + message_filename, 'rb') as file:
+                    data = file.read()
+            if not data.startswith(self.REFERENCE):
+                return data
+            # Ссылка на общее тело: первая строка - хеш тела, далее заголовок получателя
+            reference, head = data.split(b"\n", 1)
+            body = reference.removeprefix(self.REFERENCE).decode()
+            with open(self.path("bodies/", body + ".body"), 'rb') as file:
+                return head + file.read()
+
+        with self.__lock:
+            row = self.__db.execute("SELECT segment, offset, length, body FROM messages WHERE file = ? AND folder = ?",
+                                    (message_filename, folder)).fetchone()
+            body = None
+            if row is not None and row[3] is not None:
+                body = self.__db.execute("SELECT segment, offset, length FROM bodies WHERE digest = ?",
+                                         (row[3],)).fetchone()
+        if row is None or row[3] is not None and body is None:
+            raise FileNotFoundError(f"Message {message_filename} not found in {folder} index")
+        data = b""
+        for segment, offset, length in (row[:3], body) if body else (row[:3],):
+            with open(self.__mail_directory + f"segments/{segment:08d}.seg", 'rb') as file:
+                file.seek(offset)
+                data += file.read(length)
+        return data
+
+    def path(self, folder: str, message_filename: str):
+        """
+        Путь к файлу сообщения
+
+        :param folder:              Каталог (out/, send/, bad/)
+        :param message_filename:    Имя файла почтового сообщения
+        :return: Путь вида <каталог>/ab/cd/<файл>, где ab и cd - начало хеша имени файла
+        """
+
+        digest = hashlib.blake2b(message_filename.encode(), digest_size=2).hexdigest()
+        return f"{self.__mail_directory}{folder}{digest[:2]}/{digest[2:]}/{message_filename}"
+
+    def __work(self):
+        """
+        Цикл фонового потока
+
+        Выполняет операции из очереди пачками до получения признака завершения. После каждой пачки сегмент
+        сбрасывается на диск, а индекс фиксируется
+        :return: None
+        """
+
+        running = True
+        while running:
+            operations = [self.__queue.get()]
+            while len(operations) < self.__batch_size:
+                try:
+                    operations.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+            for operation in operations:
+                if operation is None:
+                    running = False
+                    break
+                self.__apply(*operation)
+            if self.__db is not None:
+                self.__sync()
+
+    def __apply(self, action: str, message_filename: str, argument):
+        """
+        Выполнение операции
+
+        :param action:              Операция (store, move)
+        :param message_filename:    Имя файла почтового сообщения
+        :param argument:            Тройка (байты сообщения, хеш тела, длина заголовка) (store) или пара
+                                    (исходный каталог, каталог назначения) (move)
+        :return: None
+        """
+
+        try:
+            if action == 'store':
+                with metrics.timer('spool_write'):
+                    if self.__db is None:
+                        self.__write(message_filename, *argument)
+                    else:
+                        self.__append(message_filename, *argument)
+            else:
+                source, folder = argument
+                with metrics.timer('spool_move'):
+                    if self.__db is None:
+                        self.__rename(message_filename, source, folder)
+                    elif message_filename in self.__added:
+                        self.__added[message_filename][3] = folder
+                    else:
+                        self.__moved.append((folder, message_filename))
+        except OSError:
+            logging.error(f"Spool operation {action} failed for message file {message_filename}", exc_info=True)
+
+    def __write(self, message_filename: str, data: bytes, body: str = None, head: int = 0):
+        """
+        Запись файла сообщения
+
+        Сообщение записывается во временный файл рядом с итоговым и переименовывается, поэтому в каталоге не бывает
+        недописанных сообщений. Общее тело записывается в каталог bodies/ до первой ссылки на него
+        :param message_filename:    Имя файла почтового сообщения
+        :param data:                Байты сообщения
+        :param body:                Хеш общего тела сообщения
+        :param head:                Длина заголовка получателя в начале сообщения
+        :return: None
+        """
+
+        if body is not None:
+            path = self.path("bodies/", body + ".body")
+            if body not in self.__stored and not os.path.exists(path):
+                self.__directory(path)
+                with open(path + ".tmp", 'wb') as body_file:
+                    body_file.write(data[head:])
+                os.replace(path + ".tmp", path)
+                metrics.inc('spool_bodies')
+            self.__stored.add(body)
+            data = self.REFERENCE + body.encode() + b"\n" + data[:head]
+
+        path = self.path("out/", message_filename)
+        self.__directory(path)
+        with open(path + ".tmp", 'wb') as msg_file:
+            msg_file.write(data)
+        os.replace(path + ".tmp", path)
+
+    def __rename(self, message_filename: str, source: str, folder: str):
+        """
+        Перенос файла сообщения
+
+        :param message_filename:    Имя файла почтового сообщения
+        :param source:              Исходный каталог
+        :param folder:              Каталог назначения
+        :return: None
+        """
+
+        path = self.path(folder, message_filename)
+        self.__directory(path)
+        try:
+            os.rename(self.path(source, message_filename), path)
+        except FileNotFoundError:
+            # Файл, записанный до разбиения каталогов на подкаталоги
+            os.rename(self.__mail_directory + source + message_filename, path)
+
+    def __append(self, message_filename: str, data: bytes, body: str = None, head: int = 0):
+        """
+        Запись сообщения в сегмент
+
+        :param message_filename:    Имя файла почтового сообщения
+        :param data:                Байты сообщения
+        :param body:                Хеш общего тела сообщения
+        :param head:                Длина заголовка получателя в начале сообщения
+        :return: None
+        """
+
+        if body is not None:
+            self.__body(body, data[head:])
+            data = data[:head]
+        if self.__segment is None or self.__segment.tell() >= self.__segment_size:
+            self.__roll()
+        offset = self.__segment.tell()
+        self.__segment.write(data)
+        self.__added[message_filename] = [self.__segment_id, offset, len(data), "out/", body]
+
+    def __body(self, body: str, data: bytes):
+        """
+        Запись тела в сегмент
+
+        Тело записывается, только если его еще нет в индексе
+        :param body:    Хеш общего тела сообщения
+        :param data:    Байты тела
+        :return: None
+        """
+
+        if body in self.__stored:
+            return
+        with self.__lock:
+            known = self.__db.execute("SELECT 1 FROM bodies WHERE digest = ?", (body,)).fetchone()
+        if known is None:
+            if self.__segment is None or self.__segment.tell() >= self.__segment_size:
+                self.__roll()
+            offset = self.__segment.tell()
+            self.__segment.write(data)
+            self.__bodies[body] = (self.__segment_id, offset, len(data))
+            metrics.inc('spool_bodies')
+        self.__stored.add(body)
+
+    def __sync(self):
+        """
+        Сброс сегмента и фиксация индекса
+
+        :return: None
+        """
+
+        if not self.__added and not self.__moved and not self.__bodies:
+            return
+        try:
+            with metrics.timer('spool_sync'):
+                if self.__segment is not None:
+                    self.__segment.flush()
+                    os.fsync(self.__segment.fileno())
+                with self.__lock:
+                    self.__db.executemany("INSERT OR REPLACE INTO bodies VALUES (?, ?, ?, ?)",
+                                          [(body, *entry) for body, entry in self.__bodies.items()])
+                    self.__db.executemany("INSERT OR REPLACE INTO messages (file, segment, offset, length, folder, "
+                                          "body) VALUES (?, ?, ?, ?, ?, ?)",
+                                          [(message_filename, *entry) for message_filename, entry in
+                                           self.__added.items()])
+                    self.__db.executemany("UPDATE messages SET folder = ? WHERE file = ?", self.__moved)
+                    self.__db.commit()
+        except (OSError, sqlite3.Error):
+            logging.error(f"Spool index could not be written, {len(self.__added)} messages lost", exc_info=True)
+            # Тела, не попавшие в индекс, при следующей ссылке записываются заново
+            self.__stored.difference_update(self.__bodies)
+        self.__added.clear()
+        self.__bodies.clear()
+        self.__moved.clear()
+
+    def __roll(self):
+        """
+        Начало нового сегмента
+
+        Предыдущий сегмент сбрасывается на диск вместе с индексом
+        :return: None
+        """
+
+        if self.__segment is not None:
+            self.__sync()
+            self.__segment.close()
+        self.__segment_id += 1
+        self.__segment = open(self.__mail_directory + f"segments/{self.__segment_id:08d}.seg", 'ab')
+
+    def __directory(self, path: str):
+        """
+        Создание подкаталога
+
+        :param path: Путь к файлу сообщения
+        :return: None
+        """
+
+        directory = os.path.dirname(path)
+        if directory not in self.__directories:
+            os.makedirs(directory, exist_ok=True)
+            self.__directories.add(directory)
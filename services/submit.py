@@ -0,0 +1,353 @@
+# Imports
+import http.server
+import json
+import os
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+
+# Defines
+class SubmitHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Класс обработчика запросов интерфейса постановки заданий
+
+    POST /tasks - постановка задания (тело запроса - задание в формате файла задания), ответ 202 с именем задания.
+    GET /tasks/<имя задания> - состояние задания
+
+    Методы
+    ----------------
+        do_POST(self)
+            Постановка задания
+        do_GET(self)
+            Состояние задания
+        log_message(self, format, *args)
+            Запись в лог запроса (отключена)
+        __reply(self, code: int, body: dict)
+            Отправка ответа
+    """
+
+    def do_POST(self):
+        """
+        Постановка задания
+
+        :return: None
+        """
+
+        if self.path.rstrip('/') != "/tasks":
+            self.__reply(404, {'error': "not found"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if not 0 < length <= self.server.max_size:
+            self.__reply(413 if length > 0 else 411, {'error': "invalid request size"})
+            return
+        try:
+            task = json.loads(self.rfile.read(length))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            self.__reply(400, {'error': "request body is not JSON"})
+            return
+        error = self.server.validate(task, self.server.templates_directory)
+        if error is not None:
+            self.__reply(400, {'error': error})
+            return
+        task_id = self.server.submit(task)
+        self.__reply(202, {'id': task_id, 'status': f"/tasks/{task_id}"})
+
+    def do_GET(self):
+        """
+        Состояние задания
+
+        :return: None
+        """
+
+        parts = self.path.strip('/').split('/')
+        status = self.server.status(parts[1]) if len(parts) == 2 and parts[0] == "tasks" else None
+        if status is None:
+            self.__reply(404, {'error': "unknown task"})
+        else:
+            self.__reply(200, status)
+
+    def log_message(self, format, *args):
+        """
+        Запись в лог запроса (отключена)
+
+        :return: None
+        """
+
+        pass
+
+    def __reply(self, code: int, body: dict):
+        """
+        Отправка ответа
+
+        :param code:    Код ответа HTTP
+        :param body:    Тело ответа
+        :return: None
+        """
+
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class SubmitServer(http.server.ThreadingHTTPServer):
+    """
+    Класс локального интерфейса постановки заданий
+
+    Объект класса - HTTP-сервер на локальном адресе, принимающий задания в формате файла задания без записи файла в
+    каталог заданий. Задание сохраняется в журнал доставки (сброс на диск выполняется пачками для всех одновременных
+    запросов, ответ отправляется после сброса) и помещается во входящую очередь, из которой основной цикл передает
+    его обработчику заданий. В ответ возвращается имя задания (api-<uuid>), по которому запрашивается состояние:
+    queued (ожидает), running (количество получателей по состояниям из журнала), complete (итоговые количества,
+    хранятся в памяти для последних завершенных заданий) или failed (задание не удалось выполнить, с описанием
+    ошибки). Задание, шаблон или файл получателей которого не существует, отклоняется до записи в журнал
+
+    Методы
+    ----------------
+        __init__(self, journal, port: int, address: str = "127.0.0.1", wakeup = None, keep: int = 10000,
+                 max_size: int = 10485760, templates_directory: str = "templates/")
+            Конструктор: Инициализация
+        __enter__(self)
+            Вход в контекстный менеджер (запуск сервера)
+        __exit__(self, exc_type, exc_val, exc_tb)
+            Выход из контекстного менеджера (остановка сервера)
+        start(self)
+            Запуск сервера в фоновом потоке
+        stop(self)
+            Остановка сервера
+        validate(task, templates_directory: str = None)
+            Проверка задания
+        submit(self, task: dict)
+            Постановка задания
+        restore(self, task_id: str)
+            Учет задания, восстановленного из журнала
+        take(self)
+            Получение заданий из входящей очереди
+        complete(self, task_id: str, counts: dict)
+            Отметка о завершении задания
+        fail(self, task_id: str, error: str)
+            Отметка об ошибке задания
+        status(self, task_id: str)
+            Состояние задания
+    Атрибуты
+    ----------------
+        :cvar {str} PREFIX:             Префикс имен заданий
+        :ivar {int} max_size:           Максимальный размер запроса в байтах
+        :ivar {str} templates_directory: Директория шаблонов
+        :ivar {any} __journal:          Журнал доставки
+        :ivar {any} __wakeup:           Функция пробуждения основного цикла (None - не вызывается)
+        :ivar {int} __keep:             Количество завершенных заданий, состояние которых хранится
+        :ivar {any} __inbox:            Входящая очередь заданий
+        :ivar {set} __pending:          Задания, которые еще не завершены
+        :ivar {any} __complete:         Итоги завершенных заданий {имя задания: {state, rendered, sent, failed} или
+                                        {state, error}}
+        :ivar {any} __lock:             Блокировка доступа к состояниям
+        :ivar {any} __thread:           Фоновый поток сервера
+    """
+
+    PREFIX = "api-"
+    daemon_threads = True
+
+    def __init__(self, journal, port: int, address: str = "127.0.0.1", wakeup = None, keep: int = 10000,
+                 max_size: int = 10485760, templates_directory: str = "templates/"):
+        """
+        Конструктор: Инициализация
+
+        :param journal:     Журнал доставки (services.journal.Journal)
+        :param port:        Порт сервера
+        :param address:     Адрес сервера
+        :param wakeup:      Функция пробуждения основного цикла в режиме демона
+        :param keep:        Количество завершенных заданий, состояние которых хранится
+        :param max_size:    Максимальный размер запроса в байтах
+        :param templates_directory: Директория шаблонов
+        """
+
+        super().__init__((address, port), SubmitHandler)
+        self.max_size = max_size
+        self.templates_directory = templates_directory
+        self.__journal = journal
+        self.__wakeup = wakeup
+        self.__keep = keep
+        self.__inbox = queue.SimpleQueue()
+        self.__pending = set()
+        self.__complete = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def __enter__(self):
+        """
+        Вход в контекстный менеджер
+
+        :return: Объект класса
+        """
+
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Выход из контекстного менеджера
+
+        :return: None
+        """
+
+        self.stop()
+
+    def start(self):
+        """
+        Запуск сервера в фоновом потоке
+
+        :return: None
+        """
+
+        self.__thread = threading.Thread(target=self.serve_forever, name="submit", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Остановка сервера
+
+        Задания, принятые до остановки, сохранены в журнале и будут выполнены при следующем запуске
+        :return: None
+        """
+
+        if self.__thread is not None:
+            self.shutdown()
+            self.__thread = None
+        self.server_close()
+
+    @staticmethod
+    def validate(task, templates_directory: str = None):
+        """
+        Проверка задания
+
+        Если задана директория шаблонов, то проверяется и наличие файлов шаблонов и файла получателей
+        :param task:                Задание
+        :param templates_directory: Директория шаблонов
+        :return: Описание ошибки или None, если задание корректно
+        """
+
+        if not isinstance(task, dict):
+            return "task must be a JSON object"
+        if task.get('service') != "mailer":
+            return "unsupported service"
+        for field in ('from', 'subject', 'template'):
+            if not isinstance(task.get(field), str) or not task[field]:
+                return f"field {field!r} is required"
+        if not isinstance(task.get('to'), str) and not isinstance(task.get('to-file'), str):
+            return "field 'to' or 'to-file' is required"
+        if 'replaces' in task and not isinstance(task['replaces'], dict):
+            return "field 'replaces' must be an object"
+        if templates_directory is None:
+            return None
+        # Задание с отсутствующим файлом не может быть выполнено - отклоняем его до записи в журнал
+        templates = [task['template']]
+        if 'repeat' in task:
+            if not isinstance(task.get('repeat-template'), str) or not task['repeat-template']:
+                return "field 'repeat-template' is required for a repeated task"
+            templates.append(task['repeat-template'])
+        for template in templates:
+            for extension in ('.txt', '.html'):
+                if not os.path.isfile(templates_directory + template + extension):
+                    return f"template {template + extension!r} not found"
+        if isinstance(task.get('to-file'), str) and not os.path.isfile(task['to-file']):
+            return f"recipients file {task['to-file']!r} not found"
+        return None
+
+    def submit(self, task: dict):
+        """
+        Постановка задания
+
+        Вызывается из потока обработки запроса: сохраняет задание в журнал, дожидается сброса журнала на диск и
+        помещает задание во входящую очередь
+        :param task: Задание
+        :return: Имя задания
+        """
+
+        task_id = f"{self.PREFIX}{uuid.uuid4().hex}"
+        self.__journal.submit(task_id, task)
+        self.__journal.wait()
+        with self.__lock:
+            self.__pending.add(task_id)
+        self.__inbox.put((task_id, task))
+        if self.__wakeup is not None:
+            self.__wakeup()
+        return task_id
+
+    def restore(self, task_id: str):
+        """
+        Учет задания, восстановленного из журнала
+
+        :param task_id: Имя задания
+        :return: None
+        """
+
+        with self.__lock:
+            self.__pending.add(task_id)
+
+    def take(self):
+        """
+        Получение заданий из входящей очереди
+
+        Вызывается только из основного цикла (единственный получатель очереди)
+        :return: Список пар (имя задания, задание)
+        """
+
+        tasks = list()
+        while not self.__inbox.empty():
+            tasks.append(self.__inbox.get())
+        return tasks
+
+    def complete(self, task_id: str, counts: dict):
+        """
+        Отметка о завершении задания
+
+        :param task_id: Имя задания
+        :param counts:  Итоговое количество получателей по состояниям {rendered, sent, failed}
+        :return: None
+        """
+
+        with self.__lock:
+            self.__pending.discard(task_id)
+            self.__complete[task_id] = {'state': "complete"} | counts
+            while len(self.__complete) > self.__keep:
+                self.__complete.popitem(last=False)
+
+    def fail(self, task_id: str, error: str):
+        """
+        Отметка об ошибке задания
+
+        :param task_id: Имя задания
+        :param error:   Описание ошибки
+        :return: None
+        """
+
+        with self.__lock:
+            self.__pending.discard(task_id)
+            self.__complete[task_id] = {'state': "failed", 'error': error}
+            while len(self.__complete) > self.__keep:
+                self.__complete.popitem(last=False)
+
+    def status(self, task_id: str):
+        """
+        Состояние задания
+
+        :param task_id: Имя задания
+        :return: Словарь {id, state, rendered, sent, failed} ({id, state, error} для задания с ошибкой) или None,
+                 если задание неизвестно
+        """
+
+        with self.__lock:
+            result = self.__complete.get(task_id)
+            pending = task_id in self.__pending
+        if result is not None:
+            return {'id': task_id} | result
+        if not pending:
+            return None
+        counts = self.__journal.status(task_id)
+        return {'id': task_id, 'state': "running" if any(counts.values()) else "queued"} | counts
@@ -0,0 +1,182 @@
+# Imports
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import threading
+import time
+
+# Defines
+class TaskWatcher:
+    """
+    Класс наблюдателя за каталогом заданий
+
+    Объект класса ожидает появления файлов заданий в каталоге. На Linux используется inotify (файл считается
+    появившимся после закрытия записи или переноса в каталог), на остальных платформах и при недоступности
+    inotify - периодический опрос каталога. Ожидание можно прервать из другого потока (например, при постановке
+    задания через интерфейс постановки)
+
+    Методы
+    ----------------
+        __init__(self, directory: str, poll_interval: float = 5)
+            Конструктор: Инициализация
+        __enter__(self)
+            Вход в контекстный менеджер
+        __exit__(self, exc_type, exc_val, exc_tb)
+            Выход из контекстного менеджера
+        wait(self, timeout: float)
+            Ожидание новых заданий
+        notify(self)
+            Прерывание ожидания
+        close(self)
+            Остановка наблюдения
+        __snapshot(self)
+            Список файлов заданий
+    Атрибуты
+    ----------------
+        :cvar {int} IN_CLOSE_WRITE:     Событие inotify: файл закрыт после записи
+        :cvar {int} IN_MOVED_TO:        Событие inotify: файл перенесен в каталог
+        :ivar {str} __directory:        Директория заданий
+        :ivar {float} __poll_interval:  Интервал опроса каталога в секундах
+        :ivar {int} __fd:               Дескриптор inotify (None в режиме опроса)
+        :ivar {set} __files:            Файлы заданий при последнем опросе
+        :ivar {any} __event:            Признак прерывания ожидания
+        :ivar {tuple} __pipe:           Канал прерывания select в режиме inotify (чтение, запись)
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+
+    def __init__(self, directory: str, poll_interval: float = 5):
+        """
+        Конструктор: Инициализация
+
+        Подключает inotify к каталогу заданий, а при его недоступности переходит в режим опроса
+        :param directory:       Директория заданий
+        :param poll_interval:   Интервал опроса каталога в секундах
+        """
+
+        self.__directory = directory
+        self.__poll_interval = poll_interval
+        self.__fd = None
+        self.__files = self.__snapshot()
+        self.__event = threading.Event()
+        self.__pipe = None
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            if libc.inotify_add_watch(fd, os.fsencode(directory), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.__fd = fd
+            self.__pipe = os.pipe()
+            os.set_blocking(self.__pipe[0], False)
+            os.set_blocking(self.__pipe[1], False)
+        except (OSError, AttributeError, TypeError):
+            logging.info(f"inotify is not available, tasks directory {directory} is polled "
+                         f"every {poll_interval} s")
+
+    def __enter__(self):
+        """
+        Вход в контекстный менеджер
+
+        :return: Объект класса
+        """
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Выход из контекстного менеджера
+
+        :return: None
+        """
+
+        self.close()
+
+    def wait(self, timeout: float):
+        """
+        Ожидание новых заданий
+
+        Блокируется, пока в каталоге не появится файл, ожидание не будет прервано или не истечет время ожидания
+        :param timeout: Время ожидания в секундах
+        :return: True, если в каталоге появились файлы или ожидание прервано
+        """
+
+        if self.__event.is_set():
+            self.__event.clear()
+            return True
+
+        if self.__fd is not None:
+            readable, _, _ = select.select([self.__fd, self.__pipe[0]], [], [], timeout)
+            if not readable:
+                return False
+            # Вычитываем все накопившиеся события - каталог все равно просматривается целиком
+            for fd in readable:
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            self.__event.clear()
+            return True
+
+        # Режим опроса
+        deadline = time.monotonic() + timeout
+        while True:
+            files = self.__snapshot()
+            if files - self.__files:
+                self.__files = files
+                return True
+            self.__files = files
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.__event.wait(min(self.__poll_interval, remaining)):
+                self.__event.clear()
+                return True
+
+    def notify(self):
+        """
+        Прерывание ожидания
+
+        Может вызываться из любого потока
+        :return: None
+        """
+
+        self.__event.set()
+        pipe = self.__pipe
+        if pipe is not None:
+            # Канал может быть заполнен непрочитанными прерываниями или уже закрыт
+            try:
+                os.write(pipe[1], b"\0")
+            except OSError:
+                pass
+
+    def close(self):
+        """
+        Остановка наблюдения
+
+        :return: None
+        """
+
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+        if self.__pipe is not None:
+            os.close(self.__pipe[0])
+            os.close(self.__pipe[1])
+            self.__pipe = None
+
+    def __snapshot(self):
+        """
+        Список файлов заданий
+
+        :return: Множество имен файлов заданий в каталоге
+        """
+
+        return {f for f in os.listdir(self.__directory) if f.endswith('.json')}